@@ -0,0 +1,99 @@
+"""
+Merging of frame level tags into video level tags: the NumPy run-length merge in `AVModel.from_frame_model` against
+the previous dict + sort + python loop implementation, on synthetic frame tags. Also checks that both give the same
+tags, and times the same merge over a TagTable, which skips building arrays from Tag objects.
+
+Usage (after `pip install .`): python benchmarks/bench_combine_adjacent.py [--count 1000000] [--labels 50]
+"""
+import argparse
+import gc
+import random
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from common_ml.tagging.messages import Tag, FrameInfo
+from common_ml.tagging.models.av import AVModel, TagWithPos, _combine_table
+from common_ml.tagging.models.frame_based import BatchFrameModel
+from common_ml.tagging.models.tag_types import TagTable
+
+class _NoopModel(BatchFrameModel):
+    def tag_frames(self, imgs: np.ndarray):
+        return [[] for _ in imgs]
+
+def legacy_combine_adjacent(tags: List[TagWithPos], allow_single_frame: bool, frame_time: int) -> List[Tag]:
+    tag_to_items: Dict[str, List[TagWithPos]] = {}
+    for twp in tags:
+        tag_to_items.setdefault(twp.tag.tag, []).append(twp)
+
+    result = []
+    for text, items in tag_to_items.items():
+        sorted_items = sorted(items, key=lambda x: x.pos)
+        left = right = sorted_items[0]
+        for item in sorted_items[1:]:
+            if item.pos == right.pos + 1:
+                right = item
+            else:
+                if allow_single_frame or right.pos > left.pos:
+                    result.append(Tag(tag=text, start_time=left.tag.start_time, end_time=right.tag.end_time + frame_time,
+                        source_media=left.tag.source_media, track=left.tag.track, frame_info=None))
+                left = right = item
+        if allow_single_frame or right.pos > left.pos:
+            result.append(Tag(tag=text, start_time=left.tag.start_time, end_time=right.tag.end_time + frame_time,
+                source_media=left.tag.source_media, track=left.tag.track, frame_info=None))
+    return result
+
+def make_tags(count: int, num_labels: int) -> List[TagWithPos]:
+    # each sampled frame has a few labels, which tend to persist for several frames
+    rng = random.Random(0)
+    tags, pos, active = [], 0, set()
+    while len(tags) < count:
+        active = {l for l in active if rng.random() < 0.9} | {rng.randrange(num_labels) for _ in range(rng.randrange(3))}
+        for label in sorted(active):
+            t = pos * 1000
+            tags.append(TagWithPos(pos=pos, tag=Tag(tag=f"label_{label}", start_time=t, end_time=t, source_media="1.mp4",
+                frame_info=FrameInfo(frame_idx=pos, box={"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4}))))
+        pos += 1
+    return tags[:count]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument("--labels", type=int, default=50)
+    args = parser.parse_args()
+
+    tags = make_tags(args.count, args.labels)
+    labels = sorted({twp.tag.tag for twp in tags})
+    label_index = {label: i for i, label in enumerate(labels)}
+    table = TagTable(
+        labels=labels,
+        label_ids=[label_index[twp.tag.tag] for twp in tags],
+        frames=[twp.pos for twp in tags],
+        boxes=np.zeros((len(tags), 4)),
+        times=[twp.tag.start_time for twp in tags],
+        source_media="1.mp4",
+    )
+    positions = table.frames
+    # collections traversing the million input tags would dominate the timings
+    gc.disable()
+    print(f"{'impl':<10}{'allow_single_frame':>20}{'seconds':>10}{'video tags':>12}")
+    for allow_single_frame in (True, False):
+        model = AVModel.from_frame_model(_NoopModel(), 1, allow_single_frame)
+        start = time.perf_counter()
+        legacy = legacy_combine_adjacent(tags, allow_single_frame, 1000)
+        legacy_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        combined = model._combine_adjacent(tags, allow_single_frame, 1)
+        elapsed = time.perf_counter() - start
+        assert combined == legacy, "outputs differ"
+        print(f"{'legacy':<10}{str(allow_single_frame):>20}{legacy_elapsed:>10.2f}{len(legacy):>12}")
+        print(f"{'numpy':<10}{str(allow_single_frame):>20}{elapsed:>10.2f}{len(combined):>12}")
+        start = time.perf_counter()
+        combined = _combine_table(table, positions, allow_single_frame, 1000, 0)
+        elapsed = time.perf_counter() - start
+        assert combined == legacy, "outputs differ"
+        print(f"{'table':<10}{str(allow_single_frame):>20}{elapsed:>10.2f}{len(combined):>12}")
+
+if __name__ == "__main__":
+    main()
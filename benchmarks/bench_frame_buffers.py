@@ -0,0 +1,64 @@
+"""
+Compares memory use and throughput of `iter_frame_batches` with fresh per-batch arrays against decoding into a
+pre-allocated `FrameBufferRing`.
+
+Each mode runs in a fresh process so that the RSS high-water mark (which includes the decoder's own frame buffers,
+invisible to tracemalloc) can be compared.
+
+Usage (after `pip install .`): python benchmarks/bench_frame_buffers.py [video] [--fps 5] [--batch-size 32]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+import tracemalloc
+
+from common_ml.video_processing import iter_frame_batches
+
+DEFAULT_VIDEO = os.path.join(os.path.dirname(__file__), "..", "tests", "test-data", "1.mp4")
+
+def run(video: str, fps: float, batch_size: int, reuse_buffers: int, out: multiprocessing.Queue):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+    n = 0
+    checksum = 0
+    for frames, _, _ in iter_frame_batches(video, fps, batch_size, reuse_buffers=reuse_buffers):
+        # touch the pixels like a model would
+        checksum += int(frames[:, ::64, ::64].sum())
+        n += len(frames)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    out.put((n, elapsed, peak, rss_growth * 1024, checksum))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", nargs="?", default=DEFAULT_VIDEO)
+    parser.add_argument("--fps", type=float, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("fork")
+    print(f"{'mode':<10}{'frames':>8}{'best s':>10}{'frames/s':>12}{'numpy peak MiB':>16}{'RSS growth MiB':>16}")
+    checksums = {}
+    # a serial consumer is done with a batch before pulling the next one, so a single buffer is enough
+    for mode, reuse in (("allocate", 0), ("ring", 1)):
+        runs = []
+        for _ in range(args.repeat):
+            out = ctx.Queue()
+            proc = ctx.Process(target=run, args=(args.video, args.fps, args.batch_size, reuse, out))
+            proc.start()
+            runs.append(out.get())
+            proc.join()
+        n, elapsed, peak, rss, checksum = min(runs, key=lambda r: r[1])
+        checksums[mode] = checksum
+        print(f"{mode:<10}{n:>8}{elapsed:>10.3f}{n / elapsed:>12.1f}{peak / 1024**2:>16.1f}{rss / 1024**2:>16.1f}")
+
+    assert checksums["allocate"] == checksums["ring"], "ring buffer decode produced different frames"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares the single pass PyAV `get_key_frames` against the previous ffprobe + ffmpeg implementation.
+
+Use --loop to benchmark on a long file, built by remuxing the input back to back (no re-encoding).
+
+Usage (after `pip install .`): python benchmarks/bench_key_frames.py [video] [--loop 20]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import av
+import numpy as np
+
+from common_ml.video_processing import get_key_frames
+
+DEFAULT_VIDEO = os.path.join(os.path.dirname(__file__), "..", "tests", "test-data", "1.mp4")
+
+def legacy_get_key_frames(video_file: str):
+    """The ffprobe + ffmpeg implementation that get_key_frames replaced."""
+    cmd = ["ffprobe", "-v", "quiet", "-select_streams", "v", "-show_frames",
+            "-show_entries", "frame=width,height,pict_type,pkt_pts_time,pts_time",
+            "-print_format", "json", video_file]
+    output = json.loads(subprocess.check_output(cmd, stderr=subprocess.STDOUT))
+    w, h = output["frames"][0]["width"], output["frames"][0]["height"]
+    timestamp_key = "pkt_pts_time" if "pkt_pts_time" in output["frames"][0] else "pts_time"
+    timestamps = [float(f[timestamp_key]) for f in output["frames"] if f["pict_type"] == 'I']
+    f_pos = [i for i, f in enumerate(output["frames"]) if f["pict_type"] == 'I']
+
+    cmd = ["ffmpeg", "-nostdin", "-i", video_file,
+            "-vf", "select='eq(pict_type,I)'", "-vsync", "2",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{w}x{h}", "pipe:"]
+    process = subprocess.Popen(cmd, stderr=-1, stdout=-1)
+    out, _ = process.communicate()
+    frames = np.frombuffer(out, np.uint8).reshape((-1, h, w, 3))
+
+    sorted_frames = sorted(((frame, pos, ts) for frame, pos, ts in zip(frames, f_pos, timestamps)), key=lambda x: x[1])
+    frames, f_pos, timestamps = zip(*sorted_frames)
+    return np.stack(frames), list(f_pos), list(timestamps)
+
+def make_long_video(video: str, loops: int, out_path: str) -> None:
+    with av.open(video) as src, av.open(out_path, "w") as dst:
+        in_stream = src.streams.video[0]
+        out_stream = dst.add_stream_from_template(in_stream)
+        offset = 0
+        for _ in range(loops):
+            src.seek(0)
+            last = 0
+            for packet in src.demux(in_stream):
+                if packet.size == 0 or packet.pts is None:
+                    continue
+                last = max(last, packet.pts + (packet.duration or 0))
+                packet.pts += offset
+                packet.dts += offset
+                packet.stream = out_stream
+                dst.mux(packet)
+            offset += last
+
+def measure(fn, video: str):
+    tracemalloc.start()
+    start = time.perf_counter()
+    frames, indices, _ = fn(video)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(indices), elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", nargs="?", default=DEFAULT_VIDEO)
+    parser.add_argument("--loop", type=int, default=1, help="concatenate the video this many times")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        video = args.video
+        if args.loop > 1:
+            video = os.path.join(tmpdir, "long.mp4")
+            make_long_video(args.video, args.loop, video)
+
+        impls = [("pyav", get_key_frames)]
+        if shutil.which("ffprobe") and shutil.which("ffmpeg"):
+            impls.append(("ffprobe+ffmpeg", legacy_get_key_frames))
+        else:
+            print("ffprobe/ffmpeg not found, skipping the legacy implementation")
+
+        print(f"{'impl':<16}{'keyframes':>10}{'seconds':>10}{'python peak MiB':>18}")
+        for name, fn in impls:
+            n, elapsed, peak = measure(fn, video)
+            print(f"{name:<16}{n:>10}{elapsed:>10.3f}{peak / 1024**2:>18.1f}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compares serial decoding of a single video against decoding segments of it in several processes with `decode_workers`.
+
+Use --loop to benchmark on a long file, built by remuxing the input back to back (no re-encoding).
+
+Usage (after `pip install .`): python benchmarks/bench_parallel_decode.py [video] [--loop 20] [--fps 2] [--workers 2 4]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from bench_key_frames import make_long_video
+from common_ml.video_processing import iter_frame_batches
+
+DEFAULT_VIDEO = os.path.join(os.path.dirname(__file__), "..", "tests", "test-data", "1.mp4")
+
+def measure(video: str, fps: float, decode_workers: int):
+    start = time.perf_counter()
+    n = 0
+    for frames, _, _ in iter_frame_batches(video, fps, sampling="sequential", decode_workers=decode_workers):
+        n += len(frames)
+    return n, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", nargs="?", default=DEFAULT_VIDEO)
+    parser.add_argument("--loop", type=int, default=1, help="concatenate the video this many times")
+    parser.add_argument("--fps", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4])
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        video = args.video
+        if args.loop > 1:
+            video = os.path.join(tmpdir, "long.mp4")
+            make_long_video(args.video, args.loop, video)
+
+        # the first parallel run pays for starting the worker processes
+        for workers in args.workers:
+            measure(video, args.fps, workers)
+
+        print(f"{'workers':<10}{'frames':>10}{'seconds':>10}{'speedup':>10}")
+        n, serial = measure(video, args.fps, 0)
+        print(f"{'serial':<10}{n:>10}{serial:>10.3f}{1:>10.2f}")
+        for workers in args.workers:
+            n, elapsed = measure(video, args.fps, workers)
+            print(f"{workers:<10}{n:>10}{elapsed:>10.3f}{serial / elapsed:>10.2f}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compares handing (N, 1080, 1920, 3) frame batches to a worker process by pickling them through a multiprocessing queue
+against sending `SlabPool` descriptors, the frames staying in shared memory.
+
+The worker reads every frame (sums a subsampled view), so both paths pay for making the frames visible to it.
+
+Usage (after `pip install .`): python benchmarks/bench_shared_frames.py [--batch 8] [--batches 50] [--slabs 4]
+"""
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from common_ml.utils.shared_frames import SlabPool
+
+def pickled_worker(batches, done):
+    while True:
+        frames = batches.get()
+        if frames is None:
+            break
+        done.put(int(frames[:, ::8, ::8].sum()))
+
+def shared_worker(pool: SlabPool, handles, done):
+    while True:
+        handle = handles.get()
+        if handle is None:
+            break
+        frames = pool.get(handle)
+        total = int(frames[:, ::8, ::8].sum())
+        pool.release(handle)
+        done.put(total)
+
+def run(ctx, frames: np.ndarray, num_batches: int, slabs: int, shared: bool) -> float:
+    batches, done = ctx.Queue(maxsize=slabs), ctx.Queue()
+    pool = SlabPool(slabs, frames.nbytes, ctx=ctx) if shared else None
+    args = (pool, batches, done) if shared else (batches, done)
+    worker = ctx.Process(target=shared_worker if shared else pickled_worker, args=args)
+    worker.start()
+    try:
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            if shared:
+                # copying stands in for decoding into the slab (SlabPool.allocate), which the pickled path pays too
+                batches.put(pool.put(frames))
+            else:
+                batches.put(frames)
+        batches.put(None)
+        for _ in range(num_batches):
+            done.get()
+        elapsed = time.perf_counter() - start
+        worker.join()
+        return elapsed
+    finally:
+        if pool is not None:
+            pool.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8, help="frames per batch")
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--slabs", type=int, default=4, help="batches in flight")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("fork")
+    frames = np.random.default_rng(0).integers(0, 256, (args.batch, 1080, 1920, 3), dtype=np.uint8)
+    mib = frames.nbytes * args.batches / 1024**2
+
+    print(f"{'transport':<12}{'batches/s':>12}{'MiB/s':>10}")
+    for name, shared in [("pickle", False), ("shared", True)]:
+        elapsed = run(ctx, frames, args.batches, args.slabs, shared)
+        print(f"{name:<12}{args.batches / elapsed:>12.1f}{mib / elapsed:>10.0f}")
+
+if __name__ == "__main__":
+    main()
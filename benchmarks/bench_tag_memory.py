@@ -0,0 +1,79 @@
+"""
+Memory and construction time of frame level tags: the slotted Tag/FrameInfo/TagWithPos against equivalent dataclasses
+with a per instance __dict__ (the previous representation).
+
+Usage (after `pip install .`): python benchmarks/bench_tag_memory.py [--count 1000000]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from common_ml.tagging.messages import Tag, FrameInfo
+from common_ml.tagging.models.av import TagWithPos
+
+@dataclass(frozen=True)
+class DictFrameInfo:
+    frame_idx: int
+    box: Dict[str, float]
+
+@dataclass(frozen=True)
+class DictTag:
+    start_time: int
+    end_time: int
+    tag: str
+    source_media: str
+    track: str = ""
+    additional_info: Optional[Dict] = None
+    frame_info: Optional[DictFrameInfo] = None
+
+@dataclass
+class DictTagWithPos:
+    pos: int
+    tag: DictTag
+
+def build(count: int, tag_cls, frame_info_cls, with_pos_cls):
+    # boxes and additional info are shared so that only the tag objects themselves are measured
+    box = {"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4}
+    tags = []
+    for i in range(count):
+        tag = tag_cls(
+            start_time=i,
+            end_time=i + 1,
+            tag="person",
+            source_media="1.mp4",
+            frame_info=frame_info_cls(frame_idx=i, box=box),
+        )
+        tags.append(with_pos_cls(pos=i, tag=tag))
+    return tags
+
+def measure(count: int, *classes):
+    # timed without tracemalloc, which slows down allocations considerably
+    gc.collect()
+    start = time.perf_counter()
+    tags = build(count, *classes)
+    elapsed = time.perf_counter() - start
+    del tags
+
+    gc.collect()
+    tracemalloc.start()
+    tags = build(count, *classes)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tags
+    return elapsed, current
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(f"{'impl':<10}{'seconds':>10}{'MiB':>10}{'bytes / tag':>14}")
+    for name, classes in [("__dict__", (DictTag, DictFrameInfo, DictTagWithPos)), ("slots", (Tag, FrameInfo, TagWithPos))]:
+        elapsed, size = measure(args.count, *classes)
+        print(f"{name:<10}{elapsed:>10.2f}{size / 1024**2:>10.1f}{size / args.count:>14.0f}")
+
+if __name__ == "__main__":
+    main()
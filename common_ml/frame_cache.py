@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from typing import Hashable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from common_ml.media_info import file_key
+from common_ml.utils.memory import MemoryGovernor
+from common_ml.video_processing import iter_frame_batches
+
+_SUFFIX = ".frames"
+
+class FrameCache:
+    """
+    Decoded frames kept in raw memory-mapped files in a local directory, so that several models tagging the same file
+    at the same fps and frame size, possibly in different processes, only decode it once.
+
+    Entries are keyed by the file's (path, size, mtime), the sampling rate and the resize parameters. A file is written
+    while it is first decoded and replaced atomically once complete, later readers map it without copying. The total
+    size of the entries is kept under `max_bytes` by evicting the least recently used ones, and a video whose frames
+    alone exceed `max_bytes` is not cached.
+
+    Each entry is a single file: the (N, H, W, 3) uint8 frames, then a JSON trailer with their shape, indices and
+    timestamps, then the trailer's length as an 8 byte little endian integer.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be > 0")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def iter_frame_batches(
+        self,
+        video_file: str,
+        fps: float,
+        batch_size: int=32,
+        reuse_buffers: int=0,
+        size: Optional[Tuple[int, int]]=None,
+        max_side: Optional[int]=None,
+        interpolation: Optional[str]=None,
+        sampling: str="auto",
+        decode_workers: int=0,
+        memory_governor: Optional[MemoryGovernor]=None,
+        memory_owner: Hashable=None,
+    ) -> Iterator[Tuple[np.ndarray, List[int], List[float]]]:
+        """
+        Same as `video_processing.iter_frame_batches`, reading the frames from the cache if present and caching them
+        otherwise. Frames read from the cache are read-only views of the memory-mapped file.
+        """
+        path = self._entry_path(video_file, fps, size, max_side, interpolation)
+        cached = self._load(path) if path is not None else None
+        if cached is not None:
+            frames, indices, times = cached
+            for i in range(0, len(frames), batch_size):
+                yield frames[i:i + batch_size], indices[i:i + batch_size], times[i:i + batch_size]
+            return
+
+        batches = iter_frame_batches(
+            video_file,
+            fps,
+            batch_size,
+            reuse_buffers=reuse_buffers,
+            size=size,
+            max_side=max_side,
+            interpolation=interpolation,
+            sampling=sampling,
+            decode_workers=decode_workers,
+            memory_governor=memory_governor,
+            memory_owner=memory_owner,
+        )
+        if path is None:
+            yield from batches
+            return
+        yield from self._write_through(path, batches)
+
+    def _entry_path(
+        self,
+        video_file: str,
+        fps: float,
+        size: Optional[Tuple[int, int]],
+        max_side: Optional[int],
+        interpolation: Optional[str],
+    ) -> Optional[str]:
+        key = file_key(video_file)
+        if key is None:
+            return None
+        params = json.dumps([list(key), fps, list(size) if size is not None else None, max_side, interpolation])
+        return os.path.join(self.directory, hashlib.sha1(params.encode("utf-8")).hexdigest() + _SUFFIX)
+
+    def _load(self, path: str) -> Optional[Tuple[np.ndarray, List[int], List[float]]]:
+        try:
+            with open(path, "rb") as f:
+                f.seek(-8, os.SEEK_END)
+                (trailer_len,) = struct.unpack("<Q", f.read(8))
+                f.seek(-8 - trailer_len, os.SEEK_END)
+                trailer = json.loads(f.read(trailer_len))
+            frames = np.memmap(path, dtype=np.uint8, mode="r", shape=tuple(trailer["shape"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning(f"Ignoring frame cache entry {path}: {e}")
+            return None
+        try:
+            # the access time drives eviction, and may not be updated by the filesystem itself
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process since, the mapping stays valid
+            pass
+        return frames, trailer["indices"], trailer["times"]
+
+    def _write_through(
+        self,
+        path: str,
+        batches: Iterator[Tuple[np.ndarray, List[int], List[float]]],
+    ) -> Iterator[Tuple[np.ndarray, List[int], List[float]]]:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                shape, indices, times = None, [], []
+                written = 0
+                caching = True
+                for frames, batch_indices, batch_times in batches:
+                    if caching:
+                        if shape is None:
+                            shape = frames.shape[1:]
+                        written += frames.nbytes
+                        if frames.shape[1:] != shape or written > self.max_bytes:
+                            caching = False
+                        else:
+                            tmp.write(memoryview(np.ascontiguousarray(frames)).cast("B"))
+                            indices.extend(batch_indices)
+                            times.extend(batch_times)
+                    yield frames, batch_indices, batch_times
+
+                if caching and shape is not None:
+                    # the number of frames is only known at the end, so it goes in a trailer after them
+                    trailer = json.dumps({"shape": [len(indices), *shape], "indices": indices, "times": times}).encode("utf-8")
+                    tmp.write(trailer)
+                    tmp.write(struct.pack("<Q", len(trailer)))
+                    complete = True
+            if complete:
+                os.replace(tmp_path, path)
+        finally:
+            if not complete:
+                os.remove(tmp_path)
+        if complete:
+            self._evict(keep=path)
+
+    def total_bytes(self) -> int:
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self) -> List[Tuple[str, float, int]]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, max(st.st_atime, st.st_mtime), st.st_size))
+        return entries
+
+    def _evict(self, keep: str) -> None:
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                # processes that already mapped the entry keep reading it
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
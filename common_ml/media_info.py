@@ -0,0 +1,221 @@
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, asdict
+from fractions import Fraction
+from typing import List, Optional, Tuple
+
+import av
+from loguru import logger
+
+from common_ml.utils.cache import DiskCache, LRUCache
+
+# directory of the persistent probe cache shared between processes, disabled if unset
+CACHE_DIR_ENV = "COMMON_ML_PROBE_CACHE_DIR"
+
+@dataclass(frozen=True)
+class StreamInfo:
+    index: int
+    type: str                               # "video", "audio", "subtitle", "data", ...
+    codec: Optional[str]
+    time_base: Optional[Fraction]
+    duration: Optional[float]               # seconds
+    # video streams only
+    width: Optional[int] = None
+    height: Optional[int] = None
+    avg_fps: Optional[float] = None         # ffprobe's avg_frame_rate
+    base_fps: Optional[float] = None        # ffprobe's r_frame_rate
+    # audio streams only
+    sample_rate: Optional[int] = None
+    channels: Optional[int] = None
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """
+    Everything the tagging code needs to know about a media file, gathered by opening the container once.
+    """
+    path: str
+    duration: float                         # container duration in seconds
+    start_time: float                       # container start time in seconds
+    streams: List[StreamInfo]
+
+    @property
+    def video(self) -> Optional[StreamInfo]:
+        """The first video stream, which is the one decoded by `video_processing`."""
+        return next((s for s in self.streams if s.type == "video"), None)
+
+    @property
+    def audio(self) -> Optional[StreamInfo]:
+        return next((s for s in self.streams if s.type == "audio"), None)
+
+    @property
+    def fps(self) -> Optional[float]:
+        return self.video.avg_fps if self.video else None
+
+    @property
+    def resolution(self) -> Optional[Tuple[int, int]]:
+        """(width, height) of the first video stream."""
+        return (self.video.width, self.video.height) if self.video else None
+
+    @property
+    def time_base(self) -> Optional[Fraction]:
+        return self.video.time_base if self.video else None
+
+    @property
+    def is_vfr(self) -> bool:
+        return self.video is not None and self.video.avg_fps != self.video.base_fps
+
+def _to_json(info: MediaInfo) -> bytes:
+    data = asdict(info)
+    for s in data["streams"]:
+        if s["time_base"] is not None:
+            s["time_base"] = str(s["time_base"])
+    return json.dumps(data).encode("utf-8")
+
+def _from_json(raw: bytes) -> MediaInfo:
+    data = json.loads(raw)
+    streams = []
+    for s in data.pop("streams"):
+        if s["time_base"] is not None:
+            s["time_base"] = Fraction(s["time_base"])
+        streams.append(StreamInfo(**s))
+    return MediaInfo(streams=streams, **data)
+
+def _rate(rate: Optional[Fraction]) -> Optional[float]:
+    return float(rate) if rate else None
+
+def _seconds(value: Optional[int], time_base: Optional[Fraction]) -> Optional[float]:
+    if value is None or time_base is None:
+        return None
+    return float(value * time_base)
+
+def _probe(path: str) -> MediaInfo:
+    with av.open(path) as container:
+        streams = []
+        for s in container.streams:
+            info = dict(
+                index=s.index,
+                type=s.type,
+                codec=s.codec_context.name if s.codec_context else None,
+                time_base=s.time_base,
+                duration=_seconds(s.duration, s.time_base),
+            )
+            if s.type == "video":
+                info.update(
+                    width=s.codec_context.width,
+                    height=s.codec_context.height,
+                    avg_fps=_rate(s.average_rate),
+                    base_fps=_rate(s.base_rate),
+                )
+            elif s.type == "audio":
+                info.update(sample_rate=s.codec_context.sample_rate, channels=s.codec_context.channels)
+            streams.append(StreamInfo(**info))
+
+        if container.duration is not None:
+            duration = container.duration / av.time_base
+        else:
+            duration = max((s.duration for s in streams if s.duration is not None), default=0.0)
+        start_time = container.start_time / av.time_base if container.start_time is not None else 0.0
+
+    return MediaInfo(path=path, duration=duration, start_time=start_time, streams=streams)
+
+def file_key(path: str) -> Optional[Tuple[str, int, int]]:
+    """
+    (absolute path, size, mtime in ns) of a local file, None if `path` is not a local file (e.g. a url).
+
+    Used as a cache key that changes whenever the file is rewritten, so stale results are never served for reused paths.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+_cache = LRUCache(maxsize=2048)
+
+_disk_cache: Optional[DiskCache] = None
+_disk_cache_configured = False
+_disk_cache_lock = threading.Lock()
+
+def configure_disk_cache(directory: Optional[str], max_bytes: int=64 * 1024**2) -> None:
+    """
+    Enables the persistent probe cache in `directory`, shared by every process configured with the same directory and
+    surviving restarts. Pass None to disable it.
+
+    If this is never called, the cache is enabled on first use if the COMMON_ML_PROBE_CACHE_DIR environment variable is set.
+    If the cache can't be opened (e.g. the directory is not writable), it is disabled and files are probed every time.
+    """
+    global _disk_cache, _disk_cache_configured
+    with _disk_cache_lock:
+        try:
+            _disk_cache = DiskCache(directory, max_bytes, name="probe.sqlite") if directory else None
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Disabling the probe cache, could not open it in {directory}: {e}")
+            _disk_cache = None
+        _disk_cache_configured = True
+
+def _get_disk_cache() -> Optional[DiskCache]:
+    if not _disk_cache_configured:
+        configure_disk_cache(os.environ.get(CACHE_DIR_ENV))
+    return _disk_cache
+
+def _disk_get(key: str) -> Optional[MediaInfo]:
+    cache = _get_disk_cache()
+    if cache is None:
+        return None
+    try:
+        raw = cache.get(key)
+        return _from_json(raw) if raw is not None else None
+    except (sqlite3.Error, ValueError, TypeError, KeyError) as e:
+        logger.warning(f"Ignoring probe cache entry for {key}: {e}")
+        return None
+
+def _disk_put(key: str, info: MediaInfo) -> None:
+    cache = _get_disk_cache()
+    if cache is None:
+        return
+    try:
+        cache.put(key, _to_json(info))
+    except sqlite3.Error as e:
+        logger.warning(f"Failed to write probe cache entry for {key}: {e}")
+
+def probe(path: str) -> MediaInfo:
+    """
+    Opens the container once with PyAV and returns fps, duration, stream layout, resolution and time base together.
+
+    Results for local files are cached in process and, if configured (see `configure_disk_cache`), on disk. Both are
+    keyed by (path, size, mtime) so that a path reused for different content is probed again. Other inputs (e.g. urls)
+    are only cached in process, by path.
+    """
+    key = file_key(path)
+    if key is None:
+        info = _cache.get(path)
+        if info is not None:
+            return info
+    else:
+        info = _cache.get(key)
+        if info is not None:
+            return info
+        disk_key = "|".join(str(k) for k in key)
+        info = _disk_get(disk_key)
+        if info is not None:
+            _cache.put(key, info)
+            return info
+
+    info = _probe(path)
+
+    if len([s for s in info.streams if s.type == "video"]) > 1:
+        logger.warning(f"Found multiple video streams in {path}... using the first one")
+    if info.is_vfr:
+        logger.warning(f"{path} has variable frame rate, get_fps returns its average fps.")
+
+    if key is None:
+        _cache.put(path, info)
+    else:
+        _cache.put(key, info)
+        _disk_put(disk_key, info)
+    return info
+
+def clear_cache() -> None:
+    _cache.clear()
@@ -1,41 +1,177 @@
 from abc import ABC, abstractmethod
-from typing import List, Union
+from itertools import groupby
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 import cv2
 import numpy as np
 
 from common_ml.utils.files import get_file_type
 from common_ml.tagging.models.frame_based import FrameModel, BatchFrameModel
 from common_ml.tagging.models.av import AVModel
-from common_ml.tagging.models.tag_types import FrameInfo, Tag
+from common_ml.tagging.models.tag_types import FrameInfo, Tag, TagList, TagTable
+from common_ml.tagging.messages import Stat
+from common_ml.tagging.result_cache import ResultCache
+from common_ml.frame_cache import FrameCache
+from common_ml.utils.memory import MemoryGovernor
+from common_ml.video_processing import check_interpolation, resize_dims
+
+# closest OpenCV equivalents of the swscale interpolations used when decoding videos, for every one of INTERPOLATIONS
+_CV2_INTERPOLATION = {
+    "FAST_BILINEAR": cv2.INTER_LINEAR,
+    "BILINEAR": cv2.INTER_LINEAR,
+    "BICUBIC": cv2.INTER_CUBIC,
+    "POINT": cv2.INTER_NEAREST,
+    "AREA": cv2.INTER_AREA,
+    "LANCZOS": cv2.INTER_LANCZOS4,
+}
 
 class FileTagger(ABC):
     @abstractmethod
-    def tag(self, file: str) -> List[Tag]:
-        pass
+    def tag(self, file: str) -> TagList:
+        """
+        Tags a file, see `AVModel.tag`: frame level tags may be given as a single TagTable rather than as Tags.
+        """
+
+    def tag_files(self, files: List[str]) -> Iterator[Tuple[str, TagList]]:
+        """
+        Tags several files, yielding (file, tags) for each of them in input order.
+
+        Implementations can override this to share work between the files, by default they are tagged one by one.
+        """
+        for file in files:
+            yield file, self.tag(file)
+
+    def tag_files_with_stats(self, files: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+        """
+        Same as `tag_files`, along with Stat messages on how each file was tagged, see `AVModel.tag_files_with_stats`.
+        """
+        for file, tags in self.tag_files(files):
+            yield file, tags, []
+
+    @staticmethod
+    def with_result_cache(
+        file_tagger: 'FileTagger',
+        result_cache: ResultCache,
+        model_id: str,
+        params: Dict[str, Any],
+    ) -> 'FileTagger':
+        """
+        Serves the tags of files whose content was already tagged by `model_id` with the same `params` from
+        `result_cache`, and stores the tags of the others. The stats of every file in `tag_files_with_stats` include
+        a Stat reporting whether its tags came from the cache.
+        """
+        class NewFileTagger(FileTagger):
+            def tag(self, file: str) -> TagList:
+                return list(self.tag_files([file]))[0][1]
+
+            def tag_files(self, files: List[str]) -> Iterator[Tuple[str, TagList]]:
+                for file, tags, _ in self.tag_files_with_stats(files):
+                    yield file, tags
+
+            def tag_files_with_stats(self, files: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                keys = [result_cache.key(file, model_id, params) for file in files]
+                cached, cache_stats = [], []
+                for key, file in zip(keys, files):
+                    tags = result_cache.get(key, file)
+                    cached.append(tags)
+                    # the counts as of this file's lookup, the lookups of the whole batch are done up front
+                    cache_stats.append(result_cache.stat(file, tags is not None))
+                # only the misses are tagged, together so that frames can still be batched across them
+                misses = file_tagger.tag_files_with_stats([file for file, tags in zip(files, cached) if tags is None])
+                for file, key, tags, cache_stat in zip(files, keys, cached, cache_stats):
+                    stats = []
+                    if tags is None:
+                        _, tags, stats = next(misses)
+                        result_cache.put(key, tags)
+                    yield file, tags, stats + [cache_stat]
+
+        return NewFileTagger()
 
     @staticmethod
-    def from_video_model(video_model: AVModel) -> 'FileTagger':
+    def from_video_model(
+        video_model: AVModel,
+        result_cache: Optional[ResultCache]=None,
+        model_version: str="",
+    ) -> 'FileTagger':
+        """
+        Args:
+            video_model: Tags a single file.
+            result_cache: Reuse the tags of files with the same content, see `with_result_cache`.
+            model_version: Part of the result cache key along with the model class, change it when the model's output
+                changes (e.g. new weights).
+        """
         class NewFileTagger(FileTagger):
-            def tag(self, file: str) -> List[Tag]:
+            def tag(self, file: str) -> TagList:
                 return video_model.tag(file)
+
+            def tag_files(self, files: List[str]) -> Iterator[Tuple[str, TagList]]:
+                return video_model.tag_files(files)
+
+            def tag_files_with_stats(self, files: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                return video_model.tag_files_with_stats(files)
     
+        if result_cache is not None:
+            return FileTagger.with_result_cache(NewFileTagger(), result_cache, _model_id(video_model, model_version), {})
         return NewFileTagger()
 
     @staticmethod
     def from_frame_model(
         frame_model: Union[FrameModel, BatchFrameModel], 
         fps: float=1.0, 
-        allow_single_frame: bool=False
+        allow_single_frame: bool=False,
+        batch_size: int=32,
+        queue_depth: int=2,
+        reuse_frame_buffers: bool=False,
+        frame_size: Optional[Tuple[int, int]]=None,
+        max_side: Optional[int]=None,
+        interpolation: Optional[str]=None,
+        sampling: str="auto",
+        decode_workers: int=0,
+        cross_file_batching: bool=False,
+        max_batch_latency: float=1.0,
+        max_gap: int=0,
+        dedup_threshold: Optional[float]=None,
+        frame_cache: Optional[FrameCache]=None,
+        memory_governor: Optional[MemoryGovernor]=None,
+        result_cache: Optional[ResultCache]=None,
+        model_version: str="",
     ) -> 'FileTagger':
+        """
+        Tags images with `frame_model` directly and videos with `AVModel.from_frame_model`, see there for the arguments.
+
+        Args:
+            result_cache: Reuse the tags of files with the same content, see `with_result_cache`. Cached results are
+                keyed by the model class, `model_version` and the arguments affecting the tags.
+            model_version: Change it when the model's output changes (e.g. new weights).
+        """
+        check_interpolation(interpolation)
+        cv2_interpolation = _CV2_INTERPOLATION[interpolation or "BILINEAR"]
         if isinstance(frame_model, FrameModel):
             batched_frame_model = BatchFrameModel.from_frame_model(frame_model)
         else:
             batched_frame_model = frame_model
 
-        video_model = AVModel.from_frame_model(batched_frame_model, fps, allow_single_frame)
+        video_model = AVModel.from_frame_model(
+            batched_frame_model,
+            fps,
+            allow_single_frame,
+            batch_size=batch_size,
+            queue_depth=queue_depth,
+            reuse_frame_buffers=reuse_frame_buffers,
+            frame_size=frame_size,
+            max_side=max_side,
+            interpolation=interpolation,
+            sampling=sampling,
+            decode_workers=decode_workers,
+            cross_file_batching=cross_file_batching,
+            max_batch_latency=max_batch_latency,
+            max_gap=max_gap,
+            dedup_threshold=dedup_threshold,
+            frame_cache=frame_cache,
+            memory_governor=memory_governor,
+        )
 
         class NewFileTagger(FileTagger):
-            def tag(self, file: str) -> List[Tag]:
+            def tag(self, file: str) -> TagList:
                 file_type = get_file_type(file)
                 if file_type == "image":
                     # use the frame model directly for images
@@ -43,7 +179,18 @@ class FileTagger(ABC):
                     if img is None:
                         raise ValueError(f"Could not read image file {file}")
                     img = img[:, :, ::-1]
-                    frametags = batched_frame_model.tag_frames(np.array([img]))[0]
+                    if frame_size is not None or max_side is not None:
+                        # match the resizing applied to video frames while decoding
+                        h, w = img.shape[:2]
+                        img = cv2.resize(
+                            img,
+                            resize_dims(w, h, frame_size, max_side),
+                            interpolation=cv2_interpolation,
+                        )
+                    frametags = batched_frame_model.tag_frames(np.array([img]))
+                    if isinstance(frametags, TagTable):
+                        frametags = frametags.to_frame_tags(1)
+                    frametags = frametags[0]
 
                     tags = []
                     for ftag in frametags:
@@ -63,5 +210,33 @@ class FileTagger(ABC):
                     return video_model.tag(file)
                 else:
                     raise ValueError(f"Unsupported file type for {file}.")
-            
-        return NewFileTagger()
\ No newline at end of file
+
+            def tag_files(self, files: List[str]) -> Iterator[Tuple[str, TagList]]:
+                for file, tags, _ in self.tag_files_with_stats(files):
+                    yield file, tags
+
+            def tag_files_with_stats(self, files: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                # consecutive videos go to the video model together so it can batch frames across them
+                for is_video, group in groupby(files, key=lambda f: get_file_type(f) == "video"):
+                    if is_video:
+                        yield from video_model.tag_files_with_stats(list(group))
+                    else:
+                        for file in group:
+                            yield file, self.tag(file), []
+
+        if result_cache is not None:
+            params = dict(
+                fps=fps,
+                allow_single_frame=allow_single_frame,
+                frame_size=list(frame_size) if frame_size is not None else None,
+                max_side=max_side,
+                interpolation=interpolation,
+                sampling=sampling,
+                max_gap=max_gap,
+                dedup_threshold=dedup_threshold,
+            )
+            return FileTagger.with_result_cache(NewFileTagger(), result_cache, _model_id(frame_model, model_version), params)
+        return NewFileTagger()
+
+def _model_id(model: Any, model_version: str) -> str:
+    return f"{type(model).__module__}.{type(model).__qualname__}:{model_version}"
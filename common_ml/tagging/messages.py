@@ -1,14 +1,40 @@
+import sys
+from abc import ABC, abstractmethod
 from typing import Optional, Dict
 from dataclasses import dataclass
 
-class Message: ...
+import ujson
 
-@dataclass(frozen=True)
+# tags are created per frame detection, slots keep them small. frozen dataclasses with slots only pickle correctly
+# (which the process worker pool relies on) from python 3.11
+_SLOTS = {"slots": True} if sys.version_info >= (3, 11) else {}
+
+class Message(ABC):
+    __slots__ = ()
+
+    @abstractmethod
+    def to_dict(self) -> dict:
+        """
+        The fields of the message as a dict, equal to `dataclasses.asdict` but without copying nested dicts, which are
+        shared with the message.
+        """
+
+    def to_json(self) -> str:
+        return ujson.dumps(self.to_dict(), escape_forward_slashes=False)
+
+@dataclass(frozen=True, **_SLOTS)
 class FrameInfo:
     frame_idx: int
     box: Dict[str, float]
 
-@dataclass(frozen=True)
+    def to_dict(self) -> dict:
+        return {"frame_idx": self.frame_idx, "box": self.box}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'FrameInfo':
+        return FrameInfo(frame_idx=data["frame_idx"], box=data["box"])
+
+@dataclass(frozen=True, **_SLOTS)
 class Tag(Message):
     start_time: int
     end_time: int
@@ -18,15 +44,74 @@ class Tag(Message):
     additional_info: Optional[Dict] = None
     frame_info: Optional[FrameInfo] = None
 
-@dataclass(frozen=True)
+    def to_dict(self) -> dict:
+        return {
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "tag": self.tag,
+            "source_media": self.source_media,
+            "track": self.track,
+            "additional_info": self.additional_info,
+            "frame_info": self.frame_info.to_dict() if self.frame_info is not None else None,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Tag':
+        frame_info = data.get("frame_info")
+        return Tag(
+            start_time=data["start_time"],
+            end_time=data["end_time"],
+            tag=data["tag"],
+            source_media=data["source_media"],
+            track=data.get("track", ""),
+            additional_info=data.get("additional_info"),
+            frame_info=FrameInfo.from_dict(frame_info) if frame_info is not None else None,
+        )
+
+@dataclass(frozen=True, **_SLOTS)
 class Progress(Message):
     source_media: str
 
-@dataclass(frozen=True)
+    def to_dict(self) -> dict:
+        return {"source_media": self.source_media}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Progress':
+        return Progress(source_media=data["source_media"])
+
+@dataclass(frozen=True, **_SLOTS)
 class ProgressRatio(Message):
     progress: float
 
-@dataclass(frozen=True)
+    def to_dict(self) -> dict:
+        return {"progress": self.progress}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'ProgressRatio':
+        return ProgressRatio(progress=data["progress"])
+
+@dataclass(frozen=True, **_SLOTS)
 class Error(Message):
     message: str
-    source_media: Optional[str] = None
\ No newline at end of file
+    source_media: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {"message": self.message, "source_media": self.source_media}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Error':
+        return Error(message=data["message"], source_media=data.get("source_media"))
+
+@dataclass(frozen=True, **_SLOTS)
+class Stat(Message):
+    """Counters reported by the tagging pipeline itself, e.g. result cache hits."""
+    name: str
+    stats: Dict[str, float]
+    source_media: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "stats": self.stats, "source_media": self.source_media}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Stat':
+        return Stat(name=data["name"], stats=data["stats"], source_media=data.get("source_media"))
@@ -1,44 +1,296 @@
-from dataclasses import dataclass
-from functools import lru_cache
-from typing import Dict, List
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
 from abc import ABC, abstractmethod
+from queue import Empty, Full, Queue
+import threading
+import time
 
-from common_ml.tagging.models.tag_types import FrameInfo, FrameTag, Tag
+import numpy as np
+
+from common_ml.tagging.models.tag_types import FrameInfo, FrameTag, Tag, TagList, TagTable
+from common_ml.tagging.messages import Stat, _SLOTS
 from common_ml.tagging.models.frame_based import BatchFrameModel
-from common_ml.video_processing import get_frames, get_fps
+from common_ml.video_processing import iter_frame_batches, iter_multi_rate_frame_batches, get_fps, start_decode_workers
+from common_ml.frame_cache import FrameCache
+from common_ml.media_info import probe
+from common_ml.utils.concurrency import IDLE, prefetch
+from common_ml.utils.memory import FrameLease, MemoryGovernor
 
 class AVModel(ABC):
     @abstractmethod
-    def tag(self, fpath: str) -> List[Tag]:
-        pass
+    def tag(self, fpath: str) -> TagList:
+        """
+        Tags a file. The frame level tags of frame models returning TagTables (see `BatchFrameModel.tag_frames`) are
+        given as a single TagTable, every other tag as a Tag.
+        """
+
+    def tag_files(self, fpaths: List[str]) -> Iterator[Tuple[str, TagList]]:
+        """
+        Tags several files, yielding (fpath, tags) for each of them in input order.
+
+        Implementations can override this to share work between the files, by default they are tagged one by one.
+        """
+        for fpath in fpaths:
+            yield fpath, self.tag(fpath)
+
+    def tag_files_with_stats(self, fpaths: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+        """
+        Same as `tag_files`, along with Stat messages on how each file was tagged (e.g. the frames skipped by
+        deduplication), which message producers write out after the file's tags. By default there are none.
+        """
+        for fpath, tags in self.tag_files(fpaths):
+            yield fpath, tags, []
 
     @staticmethod
     def from_frame_model(
         frame_model: BatchFrameModel,
         fps: float,
         allow_single_frame: bool,
+        batch_size: int=32,
+        queue_depth: int=2,
+        reuse_frame_buffers: bool=False,
+        frame_size: Optional[Tuple[int, int]]=None,
+        max_side: Optional[int]=None,
+        interpolation: Optional[str]=None,
+        sampling: str="auto",
+        decode_workers: int=0,
+        cross_file_batching: bool=False,
+        max_batch_latency: float=1.0,
+        max_gap: int=0,
+        dedup_threshold: Optional[float]=None,
+        frame_cache: Optional[FrameCache]=None,
+        track: str="",
+        memory_governor: Optional[MemoryGovernor]=None,
     ) -> 'AVModel':
-        assert fps > 0
+        """
+        Wraps a frame model so that it tags whole videos.
+
+        If `frame_model` returns a TagTable from `tag_frames`, the frame level tags of each file are returned as a single
+        TagTable (use `to_tags` to expand it) followed by the combined Tag objects.
 
-        @dataclass
-        class TagWithPos:
-            pos: int
-            tag: Tag
+        Args:
+            frame_model: The model used to tag the sampled frames.
+            fps: Rate at which frames are sampled from the video.
+            allow_single_frame: Whether a tag seen on a single sampled frame produces a video level tag.
+            batch_size: Maximum number of frames decoded ahead of and passed to a single `tag_frames` call.
+            queue_depth: Number of frame batches decoded on a background thread while the model runs on the current
+                one. 0 decodes and tags serially on the calling thread.
+            reuse_frame_buffers: Decode into a ring of pre-allocated buffers instead of allocating every batch. Only
+                safe if `frame_model` does not keep references to the frames it is given.
+            frame_size: Resize frames to this exact (width, height) while decoding.
+            max_side: Downscale frames while decoding so that their longest side is at most `max_side`.
+            interpolation: swscale interpolation used when resizing, e.g. "BILINEAR" (default), "AREA", "BICUBIC".
+            sampling: "sequential", "seek" or "auto", how sampled frames are reached in the stream. "auto" seeks
+                between keyframes when the sampling interval is longer than the GOP.
+            decode_workers: If > 1, split each video at keyframes into segments decoded in this many processes, which
+                speeds up long videos. The sampled frames are the same. The processes are started here, see
+                `video_processing.start_decode_workers`.
+            cross_file_batching: When tagging several files with `tag_files`, fill every `tag_frames` call with up to
+                `batch_size` frames regardless of which file they come from, instead of one call per file batch.
+            max_batch_latency: With `cross_file_batching`, seconds after which a partial batch is tagged anyway
+                rather than waiting for frames of the next files. Only enforced while the next file is being decoded
+                if decoding runs in the background (`queue_depth` > 0).
+            max_gap: Number of consecutive sampled frames a tag may be missing from and still be merged into a single
+                video level tag. 0 only merges tags on consecutive sampled frames.
+            dedup_threshold: Skip `tag_frames` for sampled frames that look like the last frame of the same file the
+                model ran on, and reuse its tags. Frames are compared by the mean absolute difference of their 16x16
+                grayscale thumbnails, in [0, 1], e.g. 0.01 only skips near identical frames. None disables it. The
+                returned model's `dedup_stats` counts the skipped frames, and `tag_files_with_stats` gives a "dedup"
+                Stat for each file ("<track>/dedup" with a `track`).
+            frame_cache: Read the sampled frames from this cache when another model already decoded the file with the
+                same fps and resizing, and cache them otherwise. Cached frames are read-only.
+            track: Track of the returned tags.
+            memory_governor: Bounds the bytes of decoded frames in flight, shared with the other models and workers
+                of the process. Decoding waits while the budget is used up, and `tag_files_with_stats` gives a
+                "frame_memory" Stat for each file with the peak bytes in flight while it was tagged.
+        """
+        assert fps > 0
+        assert max_gap >= 0
+        assert dedup_threshold is None or dedup_threshold >= 0
+        assert batch_size > 0
+        assert queue_depth >= 0
+        if decode_workers > 1:
+            # from the calling thread rather than the background decoding one
+            start_decode_workers(decode_workers)
 
         class NewModel(AVModel):
-            def tag(self, fpath: str) -> List[Tag]:
-                key_frames, frame_indices, _ = get_frames(video_file=fpath, fps=fps)
-                video_fps = get_fps(fpath)
-                tagged_w_pos: List[TagWithPos] = []
-                ftag_by_img = frame_model.tag_frames(key_frames)
-                for pos, (fidx, ftags) in enumerate(zip(frame_indices, ftag_by_img)):
-                    for t in ftags:
-                        converted_tag = self._frame_tag_to_video_tag(t, fidx, fpath)
-                        tagged_w_pos.append(TagWithPos(pos=pos, tag=converted_tag))
-
-                combined_tags = self._combine_adjacent(tagged_w_pos, allow_single_frame, video_fps)
-                frame_level_tags = [t.tag for t in tagged_w_pos]
-                return frame_level_tags + combined_tags
+            def __init__(self):
+                self.dedup_stats = DedupStats()
+
+            def tag(self, fpath: str) -> TagList:
+                return list(self.tag_files([fpath]))[0][1]
+
+            def tag_files(self, fpaths: List[str]) -> Iterator[Tuple[str, TagList]]:
+                for fpath, tags, _ in self.tag_files_with_stats(fpaths):
+                    yield fpath, tags
+
+            def tag_files_with_stats(self, fpaths: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                # one buffer per queued batch, plus the one being decoded and the one being tagged
+                reuse_buffers = queue_depth + 2 if reuse_frame_buffers else 0
+                # distinguishes the files of this call in the memory governor
+                run = object()
+
+                def decode() -> Iterator['_DecodedBatch']:
+                    source = frame_cache.iter_frame_batches if frame_cache is not None else iter_frame_batches
+                    for i, fpath in enumerate(fpaths):
+                        # tag timestamps are the decoded ones, relative to the start of the file
+                        start_time = probe(fpath).start_time
+                        batches = source(
+                            fpath,
+                            fps,
+                            batch_size,
+                            reuse_buffers=reuse_buffers,
+                            size=frame_size,
+                            max_side=max_side,
+                            interpolation=interpolation,
+                            sampling=sampling,
+                            decode_workers=decode_workers,
+                            memory_governor=memory_governor,
+                            memory_owner=(run, i),
+                        )
+                        for frames, frame_indices, times in batches:
+                            # waits for the model to catch up if too many frames are in flight
+                            lease = memory_governor.acquire(frames.nbytes, owner=(run, i)) if memory_governor else None
+                            yield i, frames, frame_indices, [self._to_milliseconds(t - start_time) for t in times], lease
+                        # end of file
+                        yield i, None, [], [], None
+
+                batcher = self._batcher()
+                batches = decode()
+                if queue_depth > 0:
+                    batches = prefetch(batches, queue_depth, batcher.wait_time)
+                try:
+                    yield from self._tag_batches(fpaths, batches, batcher)
+                finally:
+                    # stops decoding and drops the queued batches right away, along with their memory leases
+                    batches.close()
+                    if memory_governor is not None:
+                        # the files that weren't handed out, e.g. after a failure, never had their peak popped
+                        _discard_memory_peaks(memory_governor, run, len(fpaths))
+
+            def _batcher(self) -> '_FrameBatcher':
+                dedup = _FrameDeduplicator(dedup_threshold, self.dedup_stats) if dedup_threshold is not None else None
+                return _FrameBatcher(
+                    frame_model,
+                    batch_size,
+                    self._add_frame_tags,
+                    self._add_frame_table,
+                    dedup,
+                    max_latency=max_batch_latency if cross_file_batching else None,
+                )
+
+            def _tag_batches(
+                self,
+                fpaths: List[str],
+                batches: Iterator['_DecodedBatch'],
+                batcher: '_FrameBatcher',
+            ) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                """
+                Tags decoded frames given as (index in fpaths, frames, frame indices, timestamps in ms, memory lease),
+                files in order, each followed by an (index, None, [], [], None) end marker. `IDLE` items, when no frames
+                were decoded within the batcher's `wait_time`, tag the pending batch if it is due.
+                """
+                files = [_FileTags(fpath) for fpath in fpaths]
+                pending = deque(files)
+                try:
+                    for batch in batches:
+                        if batch is IDLE:
+                            # nothing was decoded in time, the pending batch may be due
+                            if batcher.age() >= max_batch_latency:
+                                batcher.flush()
+                        else:
+                            file_index, frames, frame_indices, times, lease = batch
+                            file = files[file_index]
+                            if frames is None:
+                                file.decoded = True
+                                if not cross_file_batching or batcher.age() >= max_batch_latency:
+                                    batcher.flush()
+                            else:
+                                owners = [(file, file.num_frames + i, fidx) for i, fidx in enumerate(frame_indices)]
+                                file.num_frames += len(owners)
+                                file.times.extend(times)
+                                if lease is not None:
+                                    file.memory_owner = lease.owner
+                                    lease.move("model")
+                                try:
+                                    if cross_file_batching:
+                                        # the batcher copies the frames
+                                        batcher.add(frames, owners)
+                                        if batcher.age() >= max_batch_latency:
+                                            batcher.flush()
+                                    else:
+                                        batcher.run(frames, owners)
+                                finally:
+                                    if lease is not None:
+                                        lease.release()
+
+                        while pending and pending[0].done:
+                            file = pending.popleft()
+                            yield (file.fpath, *self._finalize(file))
+                except Exception:
+                    # still hand out whatever was fully tagged before the failure
+                    batcher.flush()
+                    while pending and pending[0].done:
+                        file = pending.popleft()
+                        yield (file.fpath, *self._finalize(file))
+                    raise
+
+                batcher.flush()
+                for file in pending:
+                    yield (file.fpath, *self._finalize(file))
+
+            def _add_frame_tags(self, file: '_FileTags', pos: int, frame_idx: int, ftags: List[FrameTag]) -> None:
+                for t in ftags:
+                    converted_tag = self._frame_tag_to_video_tag(t, frame_idx, file.times[pos], file.fpath)
+                    file.tags.append(TagWithPos(pos=pos, tag=converted_tag))
+                file.num_tagged += 1
+
+            def _add_frame_table(self, owners: List['_Owner'], table: TagTable) -> None:
+                positions = np.array([pos for _, pos, _ in owners], dtype=np.int64)
+                frame_indices = np.array([fidx for _, _, fidx in owners], dtype=np.int64)
+                times = np.array([file.times[pos] for file, pos, _ in owners], dtype=np.int64)
+                # the frames of a file are contiguous within a batch
+                start = 0
+                while start < len(owners):
+                    file = owners[start][0]
+                    end = start
+                    while end < len(owners) and owners[end][0] is file:
+                        end += 1
+                    rows = np.flatnonzero((table.frames >= start) & (table.frames < end))
+                    rows = rows[np.argsort(table.frames[rows], kind="stable")]
+                    batch_rows = table.frames[rows]
+                    file_table = table.take(rows)
+                    file_table.frames = frame_indices[batch_rows]
+                    file_table.times = times[batch_rows]
+                    file_table.source_media = file.fpath
+                    file_table.track = track
+                    file.tables.append((file_table, positions[batch_rows]))
+                    file.num_tagged += end - start
+                    start = end
+
+            def _finalize(self, file: '_FileTags') -> Tuple[TagList, List[Stat]]:
+                stats = []
+                if dedup_threshold is not None:
+                    stats.append(Stat(
+                        name=f"{track}/dedup" if track else "dedup",
+                        stats={"frames": file.num_frames, "skipped": file.num_deduped},
+                        source_media=file.fpath,
+                    ))
+                video_fps = get_fps(file.fpath)
+                combined_tags = self._combine_adjacent(file.tags, allow_single_frame, video_fps)
+                frame_level_tags = [t.tag for t in file.tags]
+                if file.tables:
+                    # batches of a file are tagged in order, so the rows are already sorted by position
+                    table = TagTable.concatenate([t for t, _ in file.tables])
+                    positions = np.concatenate([p for _, p in file.tables])
+                    if len(table) > 0:
+                        frame_level_tags.append(table)
+                    frame_time = self._to_milliseconds(1 / video_fps)
+                    combined_tags += _combine_table(table, positions, allow_single_frame, frame_time, max_gap, track)
+                if memory_governor is not None:
+                    stats.append(_frame_memory_stat(memory_governor, file.memory_owner, file.fpath))
+                return frame_level_tags + combined_tags, stats
 
             def _combine_adjacent(self, tags: List[TagWithPos], allow_single_frame: bool, fps: float) -> List[Tag]:
                 if len(tags) == 0:
@@ -46,54 +298,32 @@ class AVModel(ABC):
 
                 frame_time = self._to_milliseconds(1 / fps)
 
-                tag_to_items: Dict[str, List[TagWithPos]] = {}
-                for twp in tags:
-                    text = twp.tag.tag
-                    if text not in tag_to_items:
-                        tag_to_items[text] = []
-                    tag_to_items[text].append(twp)
+                # label ids are assigned in order of first appearance, which is the order of the output
+                label_index: Dict[str, int] = {}
+                label_ids = np.fromiter((label_index.setdefault(twp.tag.tag, len(label_index)) for twp in tags), dtype=np.int64, count=len(tags))
+                positions = np.fromiter((twp.pos for twp in tags), dtype=np.int64, count=len(tags))
+                order, starts, ends = _adjacent_runs(label_ids, positions, allow_single_frame, max_gap)
 
                 result = []
-                for text, items in tag_to_items.items():
-                    sorted_items = sorted(items, key=lambda x: x.pos)
-                    left = sorted_items[0]
-                    right = sorted_items[0]
-                    for item in sorted_items[1:]:
-                        if item.pos == right.pos + 1:
-                            right = item
-                        else:
-                            if allow_single_frame or right.pos > left.pos:
-                                result.append(Tag(
-                                    tag=text,
-                                    start_time=left.tag.start_time,
-                                    end_time=right.tag.end_time + frame_time,
-                                    source_media=left.tag.source_media,
-                                    track=left.tag.track,
-                                    frame_info=None,
-                                ))
-                            left = item
-                            right = item
-
-                    if allow_single_frame or right.pos > left.pos:
-                        result.append(Tag(
-                            tag=text,
-                            start_time=left.tag.start_time,
-                            end_time=right.tag.end_time + frame_time,
-                            source_media=left.tag.source_media,
-                            track=left.tag.track,
-                            frame_info=None,
-                        ))
-
+                for s, e in zip(order[starts].tolist(), order[ends].tolist()):
+                    left, right = tags[s].tag, tags[e].tag
+                    result.append(Tag(
+                        tag=left.tag,
+                        start_time=left.start_time,
+                        end_time=right.end_time + frame_time,
+                        source_media=left.source_media,
+                        track=left.track,
+                        frame_info=None,
+                    ))
                 return result
 
-            def _frame_tag_to_video_tag(self, frame_tag: FrameTag, frame_idx: int, source_media: str) -> Tag:
-                ts = self._to_milliseconds(frame_idx / get_fps(source_media))
+            def _frame_tag_to_video_tag(self, frame_tag: FrameTag, frame_idx: int, ts: int, source_media: str) -> Tag:
                 return Tag(
                     tag=frame_tag.tag,
                     start_time=ts,
                     end_time=ts,
                     source_media=source_media,
-                    track="",
+                    track=track,
                     additional_info=frame_tag.additional_info,
                     frame_info=FrameInfo(frame_idx=frame_idx, box=frame_tag.box),
                 )
@@ -101,4 +331,527 @@ class AVModel(ABC):
             def _to_milliseconds(self, seconds: float) -> int:
                 return round(seconds * 1000)
 
-        return NewModel()
\ No newline at end of file
+        return NewModel()
+
+    @staticmethod
+    def from_frame_models(
+        frame_models: Dict[str, BatchFrameModel],
+        fps: Dict[str, float],
+        allow_single_frame: bool,
+        batch_size: int=32,
+        queue_depth: int=2,
+        frame_size: Optional[Tuple[int, int]]=None,
+        max_side: Optional[int]=None,
+        interpolation: Optional[str]=None,
+        cross_file_batching: bool=False,
+        max_batch_latency: float=1.0,
+        max_gap: int=0,
+        dedup_threshold: Optional[float]=None,
+        memory_governor: Optional[MemoryGovernor]=None,
+    ) -> 'AVModel':
+        """
+        Wraps several frame models, each sampling frames at its own rate, so that they tag whole videos while every
+        video is decoded only once.
+
+        Each model gets the frames `from_frame_model` would sample for it, on its own thread, and its tags get the
+        model's name as `track`. The tags of a file are those of each model in the order of `frame_models`.
+
+        Args:
+            frame_models: The models, by name.
+            fps: Rate at which frames are sampled for each model, by name.
+            queue_depth: Number of frame batches decoded ahead of each model, at least 1.
+            memory_governor: Bounds the bytes of decoded frames in flight for all the models together, see
+                `from_frame_model`.
+            The other arguments are the same as `from_frame_model` and apply to every model. Frames are always decoded
+            sequentially, as every frame is needed by some model or another.
+        """
+        assert set(fps) == set(frame_models), "fps must be given for every frame model"
+        assert len(frame_models) > 0
+
+        class NewModel(AVModel):
+            def __init__(self):
+                # the single model wrappers, which tag the frames decoded here
+                self.models = {
+                    name: AVModel.from_frame_model(
+                        frame_model,
+                        fps[name],
+                        allow_single_frame,
+                        batch_size=batch_size,
+                        queue_depth=0,
+                        cross_file_batching=cross_file_batching,
+                        max_batch_latency=max_batch_latency,
+                        max_gap=max_gap,
+                        dedup_threshold=dedup_threshold,
+                        track=name,
+                    )
+                    for name, frame_model in frame_models.items()
+                }
+
+            def tag(self, fpath: str) -> TagList:
+                return list(self.tag_files([fpath]))[0][1]
+
+            def tag_files(self, fpaths: List[str]) -> Iterator[Tuple[str, TagList]]:
+                for fpath, tags, _ in self.tag_files_with_stats(fpaths):
+                    yield fpath, tags
+
+            def tag_files_with_stats(self, fpaths: List[str]) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                fan_out = _FanOut(self.models, fpaths, max(queue_depth, 1), memory_governor)
+                # distinguishes the files of this call in the memory governor
+                run = object()
+                try:
+                    try:
+                        for i, fpath in enumerate(fpaths):
+                            # tag timestamps are the decoded ones, relative to the start of the file
+                            start_time = probe(fpath).start_time
+                            batches = iter_multi_rate_frame_batches(
+                                fpath,
+                                fps,
+                                batch_size,
+                                size=frame_size,
+                                max_side=max_side,
+                                interpolation=interpolation,
+                            )
+                            for name, frames, frame_indices, times in batches:
+                                ms = [self._to_milliseconds(t - start_time) for t in times]
+                                fan_out.put_frames(name, (i, frames, frame_indices, ms), owner=(run, i))
+                            # end of file
+                            fan_out.put_all((i, None, [], [], None))
+                            yield from self._with_stats(fan_out.ready(), run)
+                        fan_out.close()
+                    except _Stopped:
+                        # a model failed, ready() raises its error
+                        pass
+                    except Exception as e:
+                        fan_out.fail(e)
+                    yield from self._with_stats(fan_out.ready(wait=True), run)
+                finally:
+                    fan_out.stop()
+                    if memory_governor is not None:
+                        _discard_memory_peaks(memory_governor, run, len(fpaths))
+
+            def _with_stats(
+                self,
+                results: Iterator[Tuple[int, str, TagList, List[Stat]]],
+                run: object,
+            ) -> Iterator[Tuple[str, TagList, List[Stat]]]:
+                for i, fpath, tags, stats in results:
+                    if memory_governor is not None:
+                        stats = stats + [_frame_memory_stat(memory_governor, (run, i), fpath)]
+                    yield fpath, tags, stats
+
+            def _to_milliseconds(self, seconds: float) -> int:
+                return round(seconds * 1000)
+
+        return NewModel()
+
+class _Stopped(Exception):
+    pass
+
+_END = object()
+
+class _FanOut:
+    """
+    Feeds decoded frame batches to the `_tag_batches` of several single model wrappers, each running on its own
+    thread, and gathers their tags file by file.
+
+    When a model fails, or decoding does, the others are stopped: the files tagged by every model before that are
+    still handed out by `ready`, which then raises the error.
+    """
+    def __init__(
+        self,
+        models: Dict[str, AVModel],
+        fpaths: List[str],
+        queue_depth: int,
+        memory_governor: Optional[MemoryGovernor]=None,
+    ):
+        self.fpaths = fpaths
+        self.memory_governor = memory_governor
+        self.names = list(models)
+        self.queues = {name: Queue(maxsize=queue_depth) for name in models}
+        self.results: Queue = Queue()
+        self.tags: List[Dict[str, Tuple[TagList, List[Stat]]]] = [{} for _ in fpaths]
+        self.num_tagged = {name: 0 for name in models}
+        self.next_file = 0
+        self.error: Optional[BaseException] = None
+        self._stop = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._run, args=(name, model), daemon=True) for name, model in models.items()
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, name: str, model: AVModel) -> None:
+        try:
+            batcher = model._batcher()
+            for _, tags, stats in model._tag_batches(self.fpaths, self._batches(name, batcher), batcher):
+                self.results.put((name, (tags, stats)))
+        except BaseException as e:
+            if not isinstance(e, _Stopped):
+                # unblocks the decoder if it is waiting on this model's queue
+                self._stop.set()
+            self.results.put((name, e))
+
+    def _batches(self, name: str, batcher: '_FrameBatcher') -> Iterator[tuple]:
+        q = self.queues[name]
+        while True:
+            wait = batcher.wait_time()
+            try:
+                item = q.get(timeout=0.1 if wait is None else min(wait, 0.1))
+            except Empty:
+                if self._stop.is_set():
+                    raise _Stopped()
+                if wait is not None and wait <= 0.1:
+                    # the pending batch is due
+                    yield IDLE
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def put(self, name: str, item) -> None:
+        while not self._stop.is_set():
+            try:
+                self.queues[name].put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+        raise _Stopped()
+
+    def put_frames(self, name: str, batch: Tuple[int, np.ndarray, List[int], List[int]], owner: Hashable) -> None:
+        """Queues a decoded batch for a model along with its memory lease, which the queue holds the only reference to."""
+        lease = None
+        if self.memory_governor is not None:
+            # gives up if a model failed, since the budget may be held by the batches queued for it
+            while lease is None:
+                try:
+                    lease = self.memory_governor.acquire(batch[1].nbytes, owner=owner, timeout=0.1)
+                except TimeoutError:
+                    if self._stop.is_set():
+                        raise _Stopped()
+        self.put(name, (*batch, lease))
+
+    def put_all(self, item) -> None:
+        for name in self.names:
+            self.put(name, item)
+
+    def close(self) -> None:
+        self.put_all(_END)
+
+    def fail(self, error: BaseException) -> None:
+        if self.error is None:
+            self.error = error
+        self._stop.set()
+
+    def ready(self, wait: bool=False) -> Iterator[Tuple[int, str, TagList, List[Stat]]]:
+        """
+        Yields (index, fpath, tags, stats) for the next files tagged by every model, waiting for all of them if `wait`.
+        """
+        while self.next_file < len(self.fpaths):
+            try:
+                name, result = self.results.get(timeout=0.1) if wait else self.results.get_nowait()
+            except Empty:
+                if not wait:
+                    return
+                if any(t.is_alive() for t in self.threads) or not self.results.empty():
+                    continue
+                break
+            if isinstance(result, BaseException):
+                if not isinstance(result, _Stopped):
+                    self.fail(result)
+                continue
+            self.tags[self.num_tagged[name]][name] = result
+            self.num_tagged[name] += 1
+            while self.next_file < len(self.fpaths) and len(self.tags[self.next_file]) == len(self.names):
+                by_name = self.tags[self.next_file]
+                self.tags[self.next_file] = {}
+                tags = [t for name in self.names for t in by_name[name][0]]
+                stats = [s for name in self.names for s in by_name[name][1]]
+                yield self.next_file, self.fpaths[self.next_file], tags, stats
+                self.next_file += 1
+        if self.error is not None:
+            raise self.error
+
+    def stop(self) -> None:
+        self._stop.set()
+        for thread in self.threads:
+            thread.join()
+        # drops the batches that were never tagged, along with their memory leases
+        for q in self.queues.values():
+            while not q.empty():
+                q.get_nowait()
+
+@dataclass(**_SLOTS)
+class TagWithPos:
+    pos: int
+    tag: Tag
+
+class _FileTags:
+    """
+    Frame level tags of one file, filled in as the frames decoded from it get tagged.
+    """
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self.tags: List[TagWithPos] = []
+        self.tables: List[Tuple[TagTable, np.ndarray]] = []     # tags returned as tables, with each row's position
+        self.num_frames = 0         # frames decoded so far
+        self.times: List[int] = []  # timestamp in ms of each decoded frame, by position
+        self.num_tagged = 0         # frames tagged so far
+        self.decoded = False
+        # last frame the model ran on, see _FrameDeduplicator
+        self.dedup_signature: Optional[np.ndarray] = None
+        self.dedup_tags: Union[List[FrameTag], TagTable, None] = None
+        self.num_deduped = 0
+        # key of the file's frames in the memory governor
+        self.memory_owner: Optional[Hashable] = None
+
+    @property
+    def done(self) -> bool:
+        return self.decoded and self.num_tagged == self.num_frames
+
+# (index of the file, frames or None at the end of the file, frame indices, timestamps in ms, memory lease)
+_DecodedBatch = Tuple[int, Optional[np.ndarray], List[int], List[int], Optional[FrameLease]]
+
+def _frame_memory_stat(governor: MemoryGovernor, owner: Optional[Hashable], fpath: str) -> Stat:
+    high_water = governor.pop_high_water(owner) if owner is not None else 0
+    return Stat(
+        name="frame_memory",
+        stats={"high_water_bytes": high_water, "max_bytes": governor.max_bytes},
+        source_media=fpath,
+    )
+
+def _discard_memory_peaks(governor: MemoryGovernor, run: object, num_files: int) -> None:
+    """Forgets the peaks recorded for the files of a `tag_files_with_stats` call, once its frames are all released."""
+    for i in range(num_files):
+        governor.pop_high_water((run, i))
+
+# (file, position among the file's sampled frames, global frame index)
+_Owner = Tuple[_FileTags, int, int]
+
+class _FrameBatcher:
+    """
+    Accumulates frames, possibly from several files, into batches of `batch_size` for `tag_frames` and routes each
+    frame's tags back to the file and position it came from.
+
+    Frames of different sizes can't share a batch: the pending batch is flushed when the frame size changes.
+    """
+    def __init__(
+        self,
+        frame_model: BatchFrameModel,
+        batch_size: int,
+        on_tags: Callable[[_FileTags, int, int, List[FrameTag]], None],
+        on_table: Callable[[List[_Owner], TagTable], None],
+        dedup: Optional['_FrameDeduplicator']=None,
+        max_latency: Optional[float]=None,
+    ):
+        self.frame_model = frame_model
+        self.batch_size = batch_size
+        self.on_tags = on_tags
+        self.on_table = on_table
+        self.dedup = dedup
+        self.max_latency = max_latency
+        self.buf: Optional[np.ndarray] = None
+        self.owners: List[_Owner] = []
+        self.first_added: Optional[float] = None
+
+    def add(self, frames: np.ndarray, owners: List[_Owner]) -> None:
+        i = 0
+        while i < len(frames):
+            if self.buf is not None and self.buf.shape[1:] != frames.shape[1:]:
+                self.flush()
+                self.buf = None
+
+            n = len(self.owners)
+            if n == 0 and len(frames) - i >= self.batch_size:
+                # a full batch is already available, no need to copy it
+                self.run(frames[i:i + self.batch_size], owners[i:i + self.batch_size])
+                i += self.batch_size
+                continue
+
+            if self.buf is None:
+                self.buf = np.empty((self.batch_size, *frames.shape[1:]), dtype=frames.dtype)
+            if n == 0:
+                self.first_added = time.monotonic()
+            k = min(self.batch_size - n, len(frames) - i)
+            self.buf[n:n + k] = frames[i:i + k]
+            self.owners.extend(owners[i:i + k])
+            i += k
+
+            if len(self.owners) == self.batch_size:
+                self.flush()
+
+    def age(self) -> float:
+        """Seconds since the oldest frame of the pending batch was added."""
+        if not self.owners:
+            return 0.0
+        return time.monotonic() - self.first_added
+
+    def wait_time(self) -> Optional[float]:
+        """Seconds until the pending batch is `max_latency` old and due to be tagged, None if nothing is ever due."""
+        if self.max_latency is None or not self.owners:
+            return None
+        return max(0.0, self.max_latency - self.age())
+
+    def flush(self) -> None:
+        if self.owners:
+            owners = self.owners
+            self.owners = []
+            self.run(self.buf[:len(owners)], owners)
+
+    def run(self, frames: np.ndarray, owners: List[_Owner]) -> None:
+        if self.dedup is not None:
+            ftag_by_img = self.dedup.tag_frames(self.frame_model, frames, owners)
+        else:
+            ftag_by_img = self.frame_model.tag_frames(frames)
+        if isinstance(ftag_by_img, TagTable):
+            self.on_table(owners, ftag_by_img)
+            return
+        for (file, pos, fidx), ftags in zip(owners, ftag_by_img):
+            self.on_tags(file, pos, fidx, ftags)
+
+
+@dataclass
+class DedupStats:
+    frames: int = 0             # sampled frames checked
+    skipped: int = 0            # frames whose tags were reused instead of running the model
+    # files may be tagged on several threads at once
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def add(self, frames: int, skipped: int) -> None:
+        with self._lock:
+            self.frames += frames
+            self.skipped += skipped
+
+    @property
+    def hit_rate(self) -> float:
+        return self.skipped / self.frames if self.frames else 0.0
+
+def _frame_signatures(frames: np.ndarray, size: int=16) -> np.ndarray:
+    """(N, size, size) grayscale thumbnails of a batch of frames, averaged over blocks, with values in [0, 1]."""
+    n, h, w, _ = frames.shape
+    size = max(1, min(size, h, w))
+    bh, bw = h // size, w // size
+    blocks = frames[:, :bh * size, :bw * size].reshape(n, size, bh, size, bw, 3)
+    return blocks.mean(axis=(2, 4, 5), dtype=np.float32) / 255
+
+def _split_table(table: TagTable, num_frames: int) -> List[TagTable]:
+    """The rows of a table returned by `tag_frames` split by image."""
+    order = np.argsort(table.frames, kind="stable")
+    bounds = np.searchsorted(table.frames[order], np.arange(num_frames + 1))
+    return [table.take(order[bounds[i]:bounds[i + 1]]) for i in range(num_frames)]
+
+class _FrameDeduplicator:
+    """
+    Runs `tag_frames` only on the frames of a batch that differ from the last frame of the same file the model ran on
+    by more than `threshold`, and gives the other frames that frame's tags.
+
+    Frames are always compared to the last frame that was actually tagged rather than to the previous one, so that slow
+    changes (e.g. a fade) can't accumulate into a large difference without the model running again.
+    """
+    def __init__(self, threshold: float, stats: DedupStats):
+        self.threshold = threshold
+        self.stats = stats
+
+    def tag_frames(
+        self,
+        frame_model: BatchFrameModel,
+        frames: np.ndarray,
+        owners: List[_Owner],
+    ) -> Union[List[List[FrameTag]], TagTable]:
+        signatures = _frame_signatures(frames)
+        infer: List[int] = []
+        # for each frame, the index in `infer` of the frame whose tags it gets, or tags reused from a previous batch
+        sources: List[Union[int, List[FrameTag], TagTable]] = []
+        # index in `infer` of the last frame tagged for each file of the batch
+        last_inferred: Dict[_FileTags, int] = {}
+        for i, (file, _, _) in enumerate(owners):
+            sig = signatures[i]
+            if file.dedup_signature is not None and np.abs(sig - file.dedup_signature).mean() <= self.threshold:
+                sources.append(last_inferred.get(file, file.dedup_tags))
+                file.num_deduped += 1
+            else:
+                file.dedup_signature = sig
+                last_inferred[file] = len(infer)
+                sources.append(len(infer))
+                infer.append(i)
+        self.stats.add(len(owners), len(owners) - len(infer))
+
+        inferred = []
+        if infer:
+            result = frame_model.tag_frames(frames if len(infer) == len(frames) else frames[infer])
+            inferred = _split_table(result, len(infer)) if isinstance(result, TagTable) else result
+        for file, k in last_inferred.items():
+            file.dedup_tags = inferred[k]
+
+        tags = [inferred[src] if isinstance(src, int) else src for src in sources]
+        if not any(isinstance(t, TagTable) for t in tags):
+            return tags
+        pieces = []
+        for i, t in enumerate(tags):
+            piece = t.take(np.arange(len(t)))
+            piece.frames = np.full(len(t), i, dtype=np.int64)
+            pieces.append(piece)
+        return TagTable.concatenate(pieces)
+
+def _adjacent_runs(
+    label_ids: np.ndarray,
+    positions: np.ndarray,
+    allow_single_frame: bool,
+    max_gap: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Splits frame level detections into runs of the same label on nearby sampled frames.
+
+    Returns `order`, which sorts the detections by (label id, position), and the indices into `order` of the first and
+    last detection of each kept run. A run continues while the position advances by 1 to `max_gap + 1` frames, so a
+    label detected twice on the same frame starts a new run. Single frame runs are dropped unless `allow_single_frame`.
+    """
+    n = len(label_ids)
+    order = np.lexsort((positions, label_ids))
+    label_ids, positions = label_ids[order], positions[order]
+
+    step = np.diff(positions)
+    breaks = np.ones(n, dtype=bool)
+    breaks[1:] = (label_ids[1:] != label_ids[:-1]) | (step < 1) | (step > max_gap + 1)
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], n) - 1
+    if not allow_single_frame:
+        keep = positions[ends] > positions[starts]
+        starts, ends = starts[keep], ends[keep]
+    return order, starts, ends
+
+
+def _combine_table(
+    table: TagTable,
+    positions: np.ndarray,
+    allow_single_frame: bool,
+    frame_time: int,
+    max_gap: int,
+    track: str="",
+) -> List[Tag]:
+    """
+    `_combine_adjacent` over the rows of a file level TagTable sorted by `positions`, without going through a Tag per
+    row: each run of a label on nearby sampled frames becomes one tag, labels in order of first appearance.
+    """
+    n = len(table)
+    if n == 0:
+        return []
+
+    first_row = np.full(len(table.labels), n, dtype=np.int64)
+    np.minimum.at(first_row, table.label_ids, np.arange(n))
+    rank = np.empty_like(first_row)
+    rank[np.argsort(first_row, kind="stable")] = np.arange(len(first_row))
+
+    order, starts, ends = _adjacent_runs(rank[table.label_ids], positions, allow_single_frame, max_gap)
+    label_ids, times = table.label_ids[order], table.times[order]
+
+    return [
+        Tag(
+            tag=table.labels[label_id],
+            start_time=start_time,
+            end_time=end_time + frame_time,
+            source_media=table.source_media,
+            track=track,
+            frame_info=None,
+        )
+        for label_id, start_time, end_time in zip(label_ids[starts].tolist(), times[starts].tolist(), times[ends].tolist())
+    ]
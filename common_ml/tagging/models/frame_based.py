@@ -1,10 +1,10 @@
 
 
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Union
 import numpy as np
 
-from common_ml.tagging.models.tag_types import FrameTag
+from common_ml.tagging.models.tag_types import FrameTag, TagTable
     
 class FrameModel(ABC):
     @abstractmethod
@@ -19,12 +19,17 @@ class FrameModel(ABC):
 
 class BatchFrameModel(ABC):
     @abstractmethod
-    def tag_frames(self, imgs: np.ndarray) -> List[List[FrameTag]]:
+    def tag_frames(self, imgs: np.ndarray) -> Union[List[List[FrameTag]], TagTable]:
         """
         Parameters
         ----------
         imgs : np.ndarray, shape (N, H, W, 3), dtype uint8
             Batch of RGB images.
+
+        Returns
+        -------
+        The tags of each image, or a TagTable holding the tags of all the images, which avoids creating a FrameTag per
+        detection for models producing many of them.
         """
 
     @staticmethod
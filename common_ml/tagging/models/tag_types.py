@@ -1,11 +1,166 @@
 
 from dataclasses import dataclass
-from typing import Dict, Optional
+from typing import Dict, Iterator, List, Optional, Union
+
+import numpy as np
+
 # these used to be in this file and I don't want to break stuff
-from common_ml.tagging.messages import Tag, FrameInfo
+from common_ml.tagging.messages import Message, Tag, FrameInfo, _SLOTS
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **_SLOTS)
 class FrameTag:
     tag: str
     box: Dict[str, float]
     additional_info: Optional[Dict] = None
+
+# order of the box coordinates in TagTable.boxes
+BOX_KEYS = ("x1", "y1", "x2", "y2")
+
+@dataclass(eq=False)
+class TagTable(Message):
+    """
+    Frame level tags stored column-wise, avoiding one python object per detection for models that produce many.
+
+    A BatchFrameModel can return a TagTable from `tag_frames` instead of a list of FrameTag per image. Row i is then a
+    detection of `labels[label_ids[i]]` in image `frames[i]` of the batch, with box `boxes[i]` = (x1, y1, x2, y2).
+
+    Video models return the frame level tags of a file as a single TagTable, where `frames` holds the frame index in
+    the video, `times` the timestamps in milliseconds, `source_media` the file and `track` the track of every row. It is written out as one tag message
+    per row.
+    """
+    labels: List[str]                                   # interned label strings
+    label_ids: np.ndarray                               # (N,) index into labels
+    frames: np.ndarray                                  # (N,) image index in the batch, or frame index in the video
+    boxes: np.ndarray                                   # (N, 4) x1, y1, x2, y2
+    additional_info: Optional[List[Optional[Dict]]] = None
+    times: Optional[np.ndarray] = None                  # (N,) milliseconds
+    source_media: Optional[str] = None
+    track: str = ""
+
+    def __post_init__(self):
+        self.label_ids = np.asarray(self.label_ids, dtype=np.int64)
+        self.frames = np.asarray(self.frames, dtype=np.int64)
+        self.boxes = np.asarray(self.boxes, dtype=np.float64).reshape(-1, 4)
+        if self.times is not None:
+            self.times = np.asarray(self.times, dtype=np.int64)
+        n = len(self.label_ids)
+        if len(self.frames) != n or len(self.boxes) != n \
+                or (self.times is not None and len(self.times) != n) \
+                or (self.additional_info is not None and len(self.additional_info) != n):
+            raise ValueError("All TagTable columns must have the same length")
+
+    def __len__(self) -> int:
+        return len(self.label_ids)
+
+    @staticmethod
+    def from_frame_tags(frame_tags: List[List[FrameTag]]) -> 'TagTable':
+        """Builds a table from the per image output of `tag_frames`."""
+        index: Dict[str, int] = {}
+        label_ids, frames, boxes, additional_info = [], [], [], []
+        for i, ftags in enumerate(frame_tags):
+            for ftag in ftags:
+                label_ids.append(index.setdefault(ftag.tag, len(index)))
+                frames.append(i)
+                boxes.append([ftag.box[k] for k in BOX_KEYS])
+                additional_info.append(ftag.additional_info)
+        return TagTable(
+            labels=list(index),
+            label_ids=label_ids,
+            frames=frames,
+            boxes=boxes,
+            additional_info=additional_info if any(info is not None for info in additional_info) else None,
+        )
+
+    def to_frame_tags(self, num_frames: int) -> List[List[FrameTag]]:
+        """The inverse of `from_frame_tags`, for a table returned by `tag_frames` on `num_frames` images."""
+        out = [[] for _ in range(num_frames)]
+        for label_id, frame, box, info, _ in self._rows():
+            out[frame].append(FrameTag(tag=self.labels[label_id], box=box, additional_info=info))
+        return out
+
+    def take(self, indices: np.ndarray) -> 'TagTable':
+        """A table with the given rows."""
+        return TagTable(
+            labels=self.labels,
+            label_ids=self.label_ids[indices],
+            frames=self.frames[indices],
+            boxes=self.boxes[indices],
+            additional_info=[self.additional_info[i] for i in indices] if self.additional_info is not None else None,
+            times=self.times[indices] if self.times is not None else None,
+            source_media=self.source_media,
+            track=self.track,
+        )
+
+    @staticmethod
+    def concatenate(tables: List['TagTable']) -> 'TagTable':
+        """Concatenates the rows of `tables`, merging their labels. The tables must share `source_media` and `track`."""
+        index: Dict[str, int] = {}
+        label_ids = []
+        for t in tables:
+            remap = np.array([index.setdefault(label, len(index)) for label in t.labels], dtype=np.int64)
+            label_ids.append(remap[t.label_ids] if len(t) else t.label_ids)
+
+        additional_info = None
+        if any(t.additional_info is not None for t in tables):
+            additional_info = []
+            for t in tables:
+                additional_info.extend(t.additional_info if t.additional_info is not None else [None] * len(t))
+        with_times = len(tables) > 0 and all(t.times is not None for t in tables)
+
+        return TagTable(
+            labels=list(index),
+            label_ids=np.concatenate(label_ids) if tables else [],
+            frames=np.concatenate([t.frames for t in tables]) if tables else [],
+            boxes=np.concatenate([t.boxes for t in tables]) if tables else [],
+            additional_info=additional_info,
+            times=np.concatenate([t.times for t in tables]) if with_times else None,
+            source_media=tables[0].source_media if tables else None,
+            track=tables[0].track if tables else "",
+        )
+
+    def _rows(self) -> Iterator[tuple]:
+        # (label id, frame, box dict, additional info, time) per row, with plain python values
+        infos = self.additional_info if self.additional_info is not None else [None] * len(self)
+        times = self.times.tolist() if self.times is not None else [None] * len(self)
+        for label_id, frame, box, info, t in zip(self.label_ids.tolist(), self.frames.tolist(), self.boxes.tolist(), infos, times):
+            yield label_id, frame, dict(zip(BOX_KEYS, box)), info, t
+
+    def to_dict(self) -> dict:
+        """The columns as plain lists, `from_dict` rebuilds the table. Use `to_dicts` for the rows as tags."""
+        return {
+            "labels": self.labels,
+            "label_ids": self.label_ids.tolist(),
+            "frames": self.frames.tolist(),
+            "boxes": self.boxes.tolist(),
+            "additional_info": self.additional_info,
+            "times": self.times.tolist() if self.times is not None else None,
+            "source_media": self.source_media,
+            "track": self.track,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'TagTable':
+        return TagTable(**data)
+
+    def to_dicts(self) -> Iterator[dict]:
+        """The rows as Tag dicts, equal to `to_tags()[i].to_dict()` without creating the Tag objects."""
+        if self.times is None or self.source_media is None:
+            raise ValueError("times and source_media must be set to convert a TagTable to tags")
+        labels, source_media, track = self.labels, self.source_media, self.track
+        for label_id, frame, box, info, t in self._rows():
+            yield {
+                "start_time": t,
+                "end_time": t,
+                "tag": labels[label_id],
+                "source_media": source_media,
+                "track": track,
+                "additional_info": info,
+                "frame_info": {"frame_idx": frame, "box": box},
+            }
+
+    def to_tags(self) -> List[Tag]:
+        return [Tag.from_dict(d) for d in self.to_dicts()]
+
+# the tags of a file: Tag objects, along with a single TagTable holding the frame level tags for frame models that
+# return tables from `tag_frames`
+TagList = List[Union[Tag, TagTable]]
@@ -1,12 +1,19 @@
     
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 
-from typing import Union, Iterator
+from typing import Dict, Union, Iterator, Optional, Tuple
 
 from common_ml.tagging.messages import *
 from common_ml.tagging.models.frame_based import *
 from common_ml.tagging.models.av import AVModel
+from common_ml.tagging.models.tag_types import TagList
 from common_ml.tagging.file_tagger import FileTagger
+from common_ml.tagging.result_cache import ResultCache
+from common_ml.frame_cache import FrameCache
+from common_ml.utils.memory import MemoryGovernor, split_memory_budgets
+from common_ml.video_processing import configure_decode_budget, get_decode_budget, restart_decode_workers
 
 class TagMessageProducer(ABC):
     @abstractmethod
@@ -18,18 +25,70 @@ class TagMessageProducer(ABC):
         If specified this will run any finalization logic to be run when all files have been received
         """
         yield from ()
+
+    def close(self) -> None:
+        """
+        Releases the resources held by the producer (e.g. worker processes), it can't be used afterwards.
+        """
     
     @staticmethod
-    def from_file_tagger(file_tagger: FileTagger) -> "TagMessageProducer":
+    def from_file_tagger(
+        file_tagger: FileTagger,
+        num_workers: int=1,
+        worker_type: str="thread",
+    ) -> "TagMessageProducer":
+        """
+        Args:
+            file_tagger: Tags a single file.
+            num_workers: Number of files of a batch tagged concurrently. Messages are still produced file by file in the
+                input order: all the tags of a file, then its stats (see `FileTagger.tag_files_with_stats`), then its
+                Progress. With a single worker the whole batch is handed
+                to `file_tagger.tag_files`, which lets frame models batch frames across files.
+            worker_type: "thread" for models that release the GIL (decoding, most native inference runtimes), "process"
+                for pure python ones. Worker processes are forked so that `file_tagger` does not need to be picklable,
+                right away, as forking is only safe before the caller starts other threads. They exit on `close`. Each
+                worker process gets `1 / num_workers` of the decode budget (see `configure_decode_budget`).
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be >= 1")
+        if worker_type not in ("thread", "process"):
+            raise ValueError(f"Unknown worker_type: {worker_type}")
+
         class NewTagMessageProducer(TagMessageProducer):
+            def __init__(self):
+                self.executor = _make_executor(file_tagger, num_workers, worker_type) if num_workers > 1 else None
+
             def produce(self, files: List[str]) -> Iterator[Message]:
-                for fname in files:
-                    tags = file_tagger.tag(fname)
+                if num_workers == 1 or len(files) <= 1:
+                    for fname, tags, stats in file_tagger.tag_files_with_stats(files):
+                        yield from tags
+                        yield from stats
+
+                        yield Progress(source_media=fname)
+                    return
 
-                    for tag in tags:
-                        yield tag
+                if self.executor is None:
+                    raise RuntimeError("The producer is closed")
+                if worker_type == "thread":
+                    futures = [self.executor.submit(_tag_with_stats, file_tagger, fname) for fname in files]
+                else:
+                    futures = [self.executor.submit(_tag_in_worker, fname) for fname in files]
+                try:
+                    for fname, future in zip(files, futures):
+                        tags, stats = future.result()
+                        yield from tags
+                        yield from stats
 
-                    yield Progress(source_media=fname)
+                        yield Progress(source_media=fname)
+                finally:
+                    # on error (or if the consumer stops early) don't start tagging the remaining files
+                    for future in futures:
+                        future.cancel()
+
+            def close(self) -> None:
+                if self.executor is not None:
+                    self.executor.shutdown(cancel_futures=True)
+                    self.executor = None
 
         return NewTagMessageProducer()
     
@@ -37,13 +96,137 @@ class TagMessageProducer(ABC):
     def from_model(
         model: Union[AVModel, FrameModel, BatchFrameModel], 
         fps: float=1.0, 
-        allow_single_frame: bool=True
+        allow_single_frame: bool=True,
+        batch_size: int=32,
+        queue_depth: int=2,
+        reuse_frame_buffers: bool=False,
+        frame_size: Optional[Tuple[int, int]]=None,
+        max_side: Optional[int]=None,
+        interpolation: Optional[str]=None,
+        sampling: str="auto",
+        decode_workers: int=0,
+        cross_file_batching: bool=False,
+        max_batch_latency: float=1.0,
+        max_gap: int=0,
+        dedup_threshold: Optional[float]=None,
+        frame_cache: Optional[FrameCache]=None,
+        memory_governor: Optional[MemoryGovernor]=None,
+        result_cache: Optional[ResultCache]=None,
+        model_version: str="",
+        num_workers: int=1,
+        worker_type: str="thread",
     ) -> 'TagMessageProducer':
         if isinstance(model, AVModel):
-            file_tagger = FileTagger.from_video_model(model)
+            file_tagger = FileTagger.from_video_model(model, result_cache=result_cache, model_version=model_version)
         elif isinstance(model, (FrameModel, BatchFrameModel)):
-            file_tagger = FileTagger.from_frame_model(model, fps, allow_single_frame)
+            file_tagger = FileTagger.from_frame_model(
+                model,
+                fps,
+                allow_single_frame,
+                batch_size=batch_size,
+                queue_depth=queue_depth,
+                reuse_frame_buffers=reuse_frame_buffers,
+                frame_size=frame_size,
+                max_side=max_side,
+                interpolation=interpolation,
+                sampling=sampling,
+                decode_workers=decode_workers,
+                cross_file_batching=cross_file_batching,
+                max_batch_latency=max_batch_latency,
+                max_gap=max_gap,
+                dedup_threshold=dedup_threshold,
+                frame_cache=frame_cache,
+                memory_governor=memory_governor,
+                result_cache=result_cache,
+                model_version=model_version,
+            )
         else:
             raise ValueError("Model must be either AVModel, FrameModel, or BatchFrameModel")
 
-        return TagMessageProducer.from_file_tagger(file_tagger)
\ No newline at end of file
+        return TagMessageProducer.from_file_tagger(file_tagger, num_workers=num_workers, worker_type=worker_type)
+
+    @staticmethod
+    def from_frame_models(
+        frame_models: Dict[str, Union[FrameModel, BatchFrameModel]],
+        fps: Dict[str, float],
+        allow_single_frame: bool=True,
+        batch_size: int=32,
+        queue_depth: int=2,
+        frame_size: Optional[Tuple[int, int]]=None,
+        max_side: Optional[int]=None,
+        interpolation: Optional[str]=None,
+        cross_file_batching: bool=False,
+        max_batch_latency: float=1.0,
+        max_gap: int=0,
+        dedup_threshold: Optional[float]=None,
+        memory_governor: Optional[MemoryGovernor]=None,
+        num_workers: int=1,
+        worker_type: str="thread",
+    ) -> 'TagMessageProducer':
+        """
+        Runs several frame models over the same videos, decoding each video once, see `AVModel.from_frame_models`. The
+        tags of each model have its name as track.
+        """
+        batched = {
+            name: BatchFrameModel.from_frame_model(m) if isinstance(m, FrameModel) else m
+            for name, m in frame_models.items()
+        }
+        video_model = AVModel.from_frame_models(
+            batched,
+            fps,
+            allow_single_frame,
+            batch_size=batch_size,
+            queue_depth=queue_depth,
+            frame_size=frame_size,
+            max_side=max_side,
+            interpolation=interpolation,
+            cross_file_batching=cross_file_batching,
+            max_batch_latency=max_batch_latency,
+            max_gap=max_gap,
+            dedup_threshold=dedup_threshold,
+            memory_governor=memory_governor,
+        )
+        return TagMessageProducer.from_file_tagger(
+            FileTagger.from_video_model(video_model), num_workers=num_workers, worker_type=worker_type
+        )
+
+# set in forked worker processes by _make_executor
+_worker_file_tagger: Optional[FileTagger] = None
+
+def _init_worker(file_tagger: FileTagger, num_workers: int) -> None:
+    global _worker_file_tagger
+    _worker_file_tagger = file_tagger
+    budget = get_decode_budget()
+    if budget is not None:
+        # the budget configured in the parent is for all the workers, each gets its share rather than a copy of it
+        configure_decode_budget(
+            max(1, budget.threads // num_workers),
+            max(1, budget.max_decoders // num_workers),
+            budget.thread_type,
+        )
+    split_memory_budgets(num_workers)
+    # the decode workers started by the parent (see AVModel's decode_workers) can't be used from here
+    restart_decode_workers()
+
+def _tag_with_stats(file_tagger: FileTagger, fname: str) -> Tuple[TagList, List[Stat]]:
+    [(_, tags, stats)] = file_tagger.tag_files_with_stats([fname])
+    return tags, stats
+
+def _tag_in_worker(fname: str) -> Tuple[TagList, List[Stat]]:
+    return _tag_with_stats(_worker_file_tagger, fname)
+
+def _make_executor(file_tagger: FileTagger, num_workers: int, worker_type: str) -> Executor:
+    if worker_type == "thread":
+        return ThreadPoolExecutor(max_workers=num_workers)
+    # with fork the initializer arguments are inherited rather than pickled
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(file_tagger, num_workers),
+    )
+    # forked workers are all started on the first submit, do it now rather than from a process that may be running
+    # other threads by the time files are tagged (e.g. the stdin reader or decoding threads), whose locks the workers
+    # would inherit
+    executor.submit(int).result()
+    return executor
\ No newline at end of file
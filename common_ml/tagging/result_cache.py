@@ -0,0 +1,114 @@
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+import ujson
+from loguru import logger
+
+from common_ml.media_info import file_key
+from common_ml.tagging.messages import Message, Tag, Stat
+from common_ml.tagging.models.tag_types import TagTable
+from common_ml.utils.cache import DiskCache, LRUCache
+
+# bump when the stored format or the tags produced for the same inputs change
+_FORMAT_VERSION = 1
+
+class ResultCache:
+    """
+    Tags produced for a file, stored on local disk and keyed by the file's content, the model and the parameters that
+    affect its output. Re-tagging the same content, even under another path, is served from the cache without decoding.
+
+    The cache is shared by every process using the same directory and bounded to `max_bytes`, least recently used
+    entries are evicted first. `hits` and `misses` count lookups in this process.
+    """
+    def __init__(self, directory: str, max_bytes: int=1024**3):
+        self._cache = DiskCache(directory, max_bytes, name="results.sqlite")
+        # content hashes by file_key, so that files aren't read again while they don't change
+        self._hashes = LRUCache(maxsize=4096)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path: str, model_id: str, params: Dict[str, Any]) -> Optional[str]:
+        """The cache key of tagging `path` with `model_id` and `params`, None if `path` is not a local file."""
+        content = self._content_hash(path)
+        if content is None:
+            return None
+        return ujson.dumps([_FORMAT_VERSION, content, model_id, params], sort_keys=True)
+
+    def get(self, key: Optional[str], source_media: str) -> Optional[List[Message]]:
+        """The cached tags for `key`, with `source_media` set to the file being tagged, or None on a miss."""
+        tags = None
+        if key is not None:
+            try:
+                raw = self._cache.get(key)
+                tags = _decode_tags(raw, source_media) if raw is not None else None
+            except (sqlite3.Error, ValueError, TypeError, KeyError) as e:
+                logger.warning(f"Ignoring result cache entry for {source_media}: {e}")
+        with self._lock:
+            if tags is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tags
+
+    def put(self, key: Optional[str], tags: List[Message]) -> None:
+        if key is None:
+            return
+        try:
+            self._cache.put(key, _encode_tags(tags))
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to write result cache entry: {e}")
+
+    def stat(self, source_media: str, hit: bool) -> Stat:
+        with self._lock:
+            return Stat(
+                name="result_cache",
+                stats={"hit": int(hit), "hits": self.hits, "misses": self.misses},
+                source_media=source_media,
+            )
+
+    def _content_hash(self, path: str) -> Optional[str]:
+        fkey = file_key(path)
+        if fkey is None:
+            return None
+        digest = self._hashes.get(fkey)
+        if digest is None:
+            h = hashlib.blake2b(digest_size=20)
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+            digest = h.hexdigest()
+            self._hashes.put(fkey, digest)
+        return digest
+
+def _encode_tags(tags: List[Message]) -> bytes:
+    items = []
+    for t in tags:
+        if isinstance(t, TagTable):
+            data = t.to_dict()
+            del data["source_media"]
+            items.append({"table": data})
+        elif isinstance(t, Tag):
+            data = t.to_dict()
+            del data["source_media"]
+            items.append({"tag": data})
+        elif isinstance(t, Stat):
+            # describes the run that produced the tags, not the content
+            continue
+        else:
+            raise ValueError(f"Can't cache {type(t).__name__} messages")
+    return ujson.dumps(items, escape_forward_slashes=False).encode("utf-8")
+
+def _decode_tags(raw: bytes, source_media: str) -> List[Message]:
+    tags = []
+    for item in ujson.loads(raw):
+        if "table" in item:
+            tags.append(TagTable.from_dict({**item["table"], "source_media": source_media}))
+        else:
+            tags.append(Tag.from_dict({**item["tag"], "source_media": source_media}))
+    return tags
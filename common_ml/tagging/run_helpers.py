@@ -1,10 +1,10 @@
 
 import argparse
 import traceback
-from typing import Union, Any, Dict
+from typing import Union, Any, Dict, List, Optional, Tuple
 import json
-from queue import Queue
-from dataclasses import asdict
+import ujson
+from queue import Queue, Empty
 import threading
 import time
 import sys
@@ -14,6 +14,11 @@ from loguru import logger
 from common_ml.tagging.producer import TagMessageProducer
 from common_ml.tagging.models.frame_based import FrameModel, BatchFrameModel
 from common_ml.tagging.models.av import AVModel
+from common_ml.tagging.models.tag_types import TagTable
+from common_ml.tagging.result_cache import ResultCache
+from common_ml.frame_cache import FrameCache
+from common_ml.utils.memory import MemoryGovernor
+from common_ml.video_processing import configure_decode_budget
 from common_ml.tagging.file_tagger import *
 from common_ml.tagging.producer import *
 from common_ml.tagging.messages import *
@@ -53,14 +58,80 @@ def run_default(
     ## for frame models only
     fps = params.get("fps", 1) # rate at which to tag the source media in the case of video
     allow_single_frame = params.get("allow_single_frame", True) # configure whether two consecutive identical frames must exist to generate a tag
+    batch_size = params.get("batch_size", 32) # max number of frames decoded and tagged at once, bounds memory use for long videos
+    queue_depth = params.get("queue_depth", 2) # number of frame batches decoded in the background while the model runs, 0 to disable
+    reuse_frame_buffers = params.get("reuse_frame_buffers", False) # decode into pre-allocated buffers, the model must not hold on to frames
+    frame_size = params.get("frame_size") # [width, height] to resize frames to while decoding
+    max_side = params.get("max_side") # downscale frames while decoding so the longest side is at most this
+    interpolation = params.get("interpolation") # resize interpolation, e.g. "BILINEAR", "AREA", "BICUBIC"
+    sampling = params.get("sampling", "auto") # "sequential", "seek" or "auto": seek between keyframes for sparse sampling
+    decode_workers = params.get("decode_workers", 0) # decode segments of each video in this many processes, for long videos
+    cross_file_batching = params.get("cross_file_batching", False) # fill model batches with frames from several files
+    max_batch_latency = params.get("max_batch_latency", 1.0) # seconds before a partial cross file batch is tagged anyway
+    max_gap = params.get("max_gap", 0) # sampled frames a tag may be missing from and still be merged into one video tag
+    dedup_threshold = params.get("dedup_threshold") # reuse the tags of the last tagged frame for frames this similar to it
+    frame_cache_dir = params.get("frame_cache_dir") # share decoded frames with other models on the host through this directory
+    frame_cache_max_bytes = params.get("frame_cache_max_bytes", 16 * 1024**3) # size limit of the frame cache
+    max_frame_bytes = params.get("max_frame_bytes") # bytes of decoded frames held at once by the workers of a process, decoding waits beyond it
+    ## for all models, except TagMessageProducer
+    result_cache_dir = params.get("result_cache_dir") # reuse the tags of already tagged content stored in this directory
+    result_cache_max_bytes = params.get("result_cache_max_bytes", 1024**3) # size limit of the result cache
+    model_version = params.get("model_version", "") # part of the result cache key, change it when the model changes
+    num_workers = params.get("num_workers", 1) # number of files of a batch tagged concurrently
+    worker_type = params.get("worker_type", "thread") # "thread" or "process" (for models holding the GIL)
+    decode_threads = params.get("decode_threads") # total decoder threads, e.g. the cores left to the model, unlimited if unset
+    max_decoders = params.get("max_decoders", num_workers) # videos decoded at once, sharing decode_threads
+    decode_thread_type = params.get("decode_thread_type", "AUTO") # FFmpeg threading: "AUTO", "FRAME" or "SLICE"
     
 
+    if decode_threads is not None:
+        configure_decode_budget(decode_threads, max_decoders, decode_thread_type)
+    result_cache = ResultCache(result_cache_dir, result_cache_max_bytes) if result_cache_dir else None
+    frame_cache = FrameCache(frame_cache_dir, frame_cache_max_bytes) if frame_cache_dir else None
+    memory_governor = MemoryGovernor(max_frame_bytes) if max_frame_bytes else None
+
     if isinstance(model, TagMessageProducer):
         start_loop_from_producer(model, output_path=args.output_path, continue_on_error=continue_on_error, batch_timeout=batch_timeout, batch_limit=batch_limit)
     elif isinstance(model, AVModel):
-        start_loop_from_av_model(model, output_path=args.output_path, continue_on_error=continue_on_error, batch_timeout=batch_timeout, batch_limit=batch_limit)
+        start_loop_from_av_model(
+            model,
+            output_path=args.output_path,
+            continue_on_error=continue_on_error,
+            batch_timeout=batch_timeout,
+            batch_limit=batch_limit,
+            result_cache=result_cache,
+            model_version=model_version,
+            num_workers=num_workers,
+            worker_type=worker_type,
+        )
     elif isinstance(model, (FrameModel, BatchFrameModel)):
-        start_loop_from_frame_model(model, output_path=args.output_path, continue_on_error=continue_on_error, batch_timeout=batch_timeout, fps=fps, allow_single_frame=allow_single_frame, batch_limit=batch_limit)
+        start_loop_from_frame_model(
+            model,
+            output_path=args.output_path,
+            continue_on_error=continue_on_error,
+            batch_timeout=batch_timeout,
+            fps=fps,
+            allow_single_frame=allow_single_frame,
+            batch_limit=batch_limit,
+            batch_size=batch_size,
+            queue_depth=queue_depth,
+            reuse_frame_buffers=reuse_frame_buffers,
+            frame_size=frame_size,
+            max_side=max_side,
+            interpolation=interpolation,
+            sampling=sampling,
+            decode_workers=decode_workers,
+            cross_file_batching=cross_file_batching,
+            max_batch_latency=max_batch_latency,
+            max_gap=max_gap,
+            dedup_threshold=dedup_threshold,
+            frame_cache=frame_cache,
+            memory_governor=memory_governor,
+            result_cache=result_cache,
+            model_version=model_version,
+            num_workers=num_workers,
+            worker_type=worker_type,
+        )
     else:
         raise ValueError(f"Unsupported model type: {type(model)}")
 
@@ -99,27 +170,80 @@ def get_params() -> Dict[str, Any]:
 class AbortTaggingException(Exception):
     pass
 
-def write_message(msg: Message, fout):
+def _encode_message(msg: Message) -> str:
+    if isinstance(msg, TagTable):
+        return "".join(
+            ujson.dumps({"type": "tag", "data": data}, escape_forward_slashes=False) + "\n" for data in msg.to_dicts()
+        )
     if isinstance(msg, Tag):
-        fout.write(json.dumps({"type": "tag", "data": asdict(msg)}) + "\n")
+        msg_type = "tag"
     elif isinstance(msg, Progress):
-        fout.write(json.dumps({"type": "progress", "data": asdict(msg)}) + "\n")
+        msg_type = "progress"
     elif isinstance(msg, Error):
-        fout.write(json.dumps({"type": "error", "data": asdict(msg)}) + "\n")
+        msg_type = "error"
     elif isinstance(msg, ProgressRatio):
-        fout.write(json.dumps({"type": "progress_ratio", "data": asdict(msg)}) + "\n")
+        msg_type = "progress_ratio"
+    elif isinstance(msg, Stat):
+        msg_type = "stat"
     else:
         raise ValueError(f"Unnexpected message type: {msg}")
+    return ujson.dumps({"type": msg_type, "data": msg.to_dict()}, escape_forward_slashes=False) + "\n"
+
+def write_message(msg: Message, fout):
+    fout.write(_encode_message(msg))
     fout.flush()
 
+class MessageWriter:
+    """
+    Writes messages to `fout` as jsonl, buffering the lines and flushing them with a single write.
+
+    The buffer is flushed on every Progress, ProgressRatio and Error message, so the runtime always sees all the tags
+    of a file before its progress message, and an error as soon as it happens. In between, it is flushed once it holds
+    `max_buffer_bytes` of output or when a message is written more than `max_delay` seconds after the last flush.
+    """
+    def __init__(self, fout, max_buffer_bytes: int=1024**2, max_delay: float=1.0):
+        self.fout = fout
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_delay = max_delay
+        self._lines = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, msg: Message) -> None:
+        line = _encode_message(msg)
+        self._lines.append(line)
+        self._size += len(line)
+        if not isinstance(msg, (Tag, TagTable)) \
+                or self._size >= self.max_buffer_bytes \
+                or time.monotonic() - self._last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._lines:
+            self.fout.write("".join(self._lines))
+            self._lines = []
+            self._size = 0
+        self.fout.flush()
+        self._last_flush = time.monotonic()
+
 def start_loop_from_av_model(
     model: AVModel, 
     output_path: str,
     continue_on_error: bool=False,
     batch_timeout: float=0.2,
     batch_limit: Optional[int]=None,
+    result_cache: Optional[ResultCache]=None,
+    model_version: str="",
+    num_workers: int=1,
+    worker_type: str="thread",
 ) -> None:
-    producer = TagMessageProducer.from_model(model)
+    producer = TagMessageProducer.from_model(
+        model,
+        result_cache=result_cache,
+        model_version=model_version,
+        num_workers=num_workers,
+        worker_type=worker_type,
+    )
     start_loop_from_producer(
         producer=producer,
         output_path=output_path,
@@ -136,8 +260,48 @@ def start_loop_from_frame_model(
     fps: float=1,
     allow_single_frame: bool=True,
     batch_limit: Optional[int]=None,
+    batch_size: int=32,
+    queue_depth: int=2,
+    reuse_frame_buffers: bool=False,
+    frame_size: Optional[Tuple[int, int]]=None,
+    max_side: Optional[int]=None,
+    interpolation: Optional[str]=None,
+    sampling: str="auto",
+    decode_workers: int=0,
+    cross_file_batching: bool=False,
+    max_batch_latency: float=1.0,
+    max_gap: int=0,
+    dedup_threshold: Optional[float]=None,
+    frame_cache: Optional[FrameCache]=None,
+    memory_governor: Optional[MemoryGovernor]=None,
+    result_cache: Optional[ResultCache]=None,
+    model_version: str="",
+    num_workers: int=1,
+    worker_type: str="thread",
 ) -> None:
-    producer = TagMessageProducer.from_model(model, fps=fps, allow_single_frame=allow_single_frame)
+    producer = TagMessageProducer.from_model(
+        model,
+        fps=fps,
+        allow_single_frame=allow_single_frame,
+        batch_size=batch_size,
+        queue_depth=queue_depth,
+        reuse_frame_buffers=reuse_frame_buffers,
+        frame_size=frame_size,
+        max_side=max_side,
+        interpolation=interpolation,
+        sampling=sampling,
+        decode_workers=decode_workers,
+        cross_file_batching=cross_file_batching,
+        max_batch_latency=max_batch_latency,
+        max_gap=max_gap,
+        dedup_threshold=dedup_threshold,
+        frame_cache=frame_cache,
+        memory_governor=memory_governor,
+        result_cache=result_cache,
+        model_version=model_version,
+        num_workers=num_workers,
+        worker_type=worker_type,
+    )
     start_loop_from_producer(
         producer=producer,
         output_path=output_path,
@@ -155,15 +319,18 @@ def start_loop_from_producer(
 ) -> None:
     """
     Live mode: reads file paths from stdin and processes them in batches
+
+    A batch is dispatched as soon as it holds `batch_limit` files, otherwise `batch_timeout` seconds after its first file
+    was read from stdin. The loop blocks on stdin while idle instead of polling.
     
     Args:
         model: The model to use for tagging, can be AVModel, FrameModel, or BatchFrameModel
         output_path: The file path to write the output tags (.jsonl format)
-        batch_timeout: Timeout for batching files
-        fps: Frames per second, only relevant or FrameModel or BatchFrameModel when processing videos
-        allow_single_frame: Whether to allow processing of single-frame videos, only relevant for FrameModel or BatchFrameModel
+        batch_timeout: Time in seconds to wait for more files after the first file of a batch arrives
+        batch_limit: Maximum number of files in a batch
     """
     
+    # items are (arrival time, file path), or None once stdin is closed
     file_queue = Queue()
     
     def stdin_reader():
@@ -172,28 +339,28 @@ def start_loop_from_producer(
             for line in sys.stdin:
                 line = line.strip()
                 if line:
-                    file_queue.put(line)
+                    file_queue.put((time.monotonic(), line))
         except (EOFError, KeyboardInterrupt):
             pass
         finally:
             print("Stopping stdin reader", file=sys.stderr)
             file_queue.put(None)
 
-    def process_batch(files: List[str], fd):
+    def process_batch(files: List[str], writer: MessageWriter):
         print(f"Processing batch of {len(files)} files...", file=sys.stderr)
         for fname in files:
             print(f"Got {fname}")
-        write_messages(lambda: producer.produce(files), fd)
+        write_messages(lambda: producer.produce(files), writer)
         print(f"Completed batch of {len(files)} files", file=sys.stderr)
     
-    def finalize(fd):
+    def finalize(writer: MessageWriter):
         print("Calling producer finalization")
-        write_messages(producer.on_completion, fd)
+        write_messages(producer.on_completion, writer)
     
-    def write_messages(gen_fn, fd):
+    def write_messages(gen_fn, writer: MessageWriter):
         try:
             for msg in gen_fn():
-                write_message(msg, fd)
+                writer.write(msg)
                 if isinstance(msg, Error):
                     raise AbortTaggingException("Received an error response from the producer")
         except AbortTaggingException:
@@ -201,50 +368,56 @@ def start_loop_from_producer(
                 # we already wrote the error
                 raise
         except Exception as e:
-            write_message(Error(message=str(e)), fd)
+            writer.write(Error(message=str(e)))
             if not continue_on_error:
                 raise
+        finally:
+            writer.flush()
     
     reader_thread = threading.Thread(target=stdin_reader, daemon=True)
     reader_thread.start()
-    
-    current_batch = []
 
     fdout = open(output_path, 'a')
+    writer = MessageWriter(fdout)
     
-    while True:
+    try:
+        while True:
+            batch, eof = _collect_batch(file_queue, batch_timeout, batch_limit)
+            if batch:
+                process_batch(batch, writer)
+            if eof:
+                finalize(writer)
+                return
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception as e:
+        logger.opt(exception=e).error("Error in main loop")
+        raise e
+    finally:
+        producer.close()
+        fdout.close()
+
+def _collect_batch(file_queue: Queue, batch_timeout: float, batch_limit: Optional[int]) -> Tuple[List[str], bool]:
+    """
+    Blocks until a batch of files is ready and returns it, along with whether stdin was closed.
+
+    The deadline is measured from the arrival time of the first file, so files that queued up while the previous batch
+    was being processed are dispatched right away.
+    """
+    batch = []
+    item = file_queue.get()
+    if item is None:
+        return batch, True
+    first_arrival, file_path = item
+    batch.append(file_path)
+    deadline = first_arrival + batch_timeout
+    while batch_limit is None or len(batch) < batch_limit:
+        remaining = deadline - time.monotonic()
         try:
-            while not file_queue.empty():
-                file_path = file_queue.get_nowait()
-                
-                # last batch
-                if file_path is None:
-                    if current_batch:
-                        process_batch(current_batch, fdout)
-                    finalize(fdout)
-                    fdout.close()
-                    return
-                
-                # add to current batch to process
-                current_batch.append(file_path)
-                if batch_limit is not None and len(current_batch) >= batch_limit:
-                    process_batch(current_batch, fdout)
-                    current_batch = []
-            
-            if current_batch:
-                process_batch(current_batch, fdout)
-                current_batch = []
-            
-            if not reader_thread.is_alive() and file_queue.empty():
-                finalize(fdout)
-                break
-            
-            time.sleep(batch_timeout)
-        except (KeyboardInterrupt, SystemExit):
+            item = file_queue.get(timeout=remaining) if remaining > 0 else file_queue.get_nowait()
+        except Empty:
             break
-        except Exception as e:
-            logger.opt(exception=e).error("Error in main loop")
-            fdout.close()
-            raise e
-
-    fdout.close()
\ No newline at end of file
+        if item is None:
+            return batch, True
+        batch.append(item[1])
+    return batch, False
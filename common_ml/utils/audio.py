@@ -3,6 +3,8 @@ import os
 from dataclasses import dataclass
 from typing import List
 
+from common_ml.media_info import probe
+
 @dataclass
 class AudioPart:
     path: str
@@ -53,13 +55,8 @@ class AudioStitcher:
         self.total_duration = current_offset
 
     def _get_duration(self, file_path: str) -> float:
-        """Helper to call ffprobe and extract duration."""
-        cmd = [
-            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', file_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return float(result.stdout.strip())
+        """Helper to probe the container duration."""
+        return probe(file_path).duration
 
     def stitch(self, start_time: float, end_time: float) -> bytes:
         """
@@ -0,0 +1,77 @@
+import threading
+from queue import Empty, Queue, Full
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# yielded by `prefetch` instead of an item that wasn't ready in time
+IDLE = object()
+
+_DONE = object()
+
+class _Raised:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+def prefetch(iterable: Iterable[T], depth: int, wait: Optional[Callable[[], Optional[float]]]=None) -> Iterator[T]:
+    """
+    Iterates `iterable` on a background thread, keeping up to `depth` items ready ahead of the consumer.
+
+    Useful to overlap work that releases the GIL (e.g. decoding with PyAV) with the work done on the items. Items are
+    yielded in order and an exception raised by the producer is re-raised in the consumer. If the consumer stops early
+    the producer thread is signalled to stop and the source iterator is closed.
+
+    If `wait` is given, it is called before waiting for each item and returns the seconds to wait for it at most, or
+    None to wait as long as it takes. `IDLE` is yielded if the item isn't ready by then, so that the consumer can meet
+    a deadline of its own while the producer is slow.
+    """
+    if depth <= 0:
+        raise ValueError("depth must be > 0")
+
+    q: Queue = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def worker():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put(item):
+                    break
+        except BaseException as e:
+            put(_Raised(e))
+            return
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+        put(_DONE)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            try:
+                item = q.get(timeout=wait() if wait is not None else None)
+            except Empty:
+                yield IDLE
+                continue
+            if item is _DONE:
+                break
+            if isinstance(item, _Raised):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        # the producer may be waiting for the queued items to be released (e.g. by a MemoryGovernor)
+        while not q.empty():
+            q.get_nowait()
+        thread.join()
@@ -0,0 +1,144 @@
+import threading
+import time
+import weakref
+from typing import Dict, Hashable, Optional
+
+STAGES = ("decode", "model")
+
+# every governor of the process, see `split_memory_budgets`
+_governors: 'weakref.WeakSet[MemoryGovernor]' = weakref.WeakSet()
+
+class FrameLease:
+    """
+    Bytes of one batch of frames accounted by a `MemoryGovernor`, from decoding until the model is done with them.
+    """
+    __slots__ = ("governor", "nbytes", "owner", "stage")
+
+    def __init__(self, governor: 'MemoryGovernor', nbytes: int, owner: Hashable, stage: str):
+        self.governor = governor
+        self.nbytes = nbytes
+        self.owner = owner
+        self.stage = stage
+
+    def move(self, stage: str) -> None:
+        """Accounts the frames under another stage, e.g. once the model starts on them."""
+        self.governor._move(self, stage)
+
+    def release(self) -> None:
+        """The frames are no longer referenced, releasing them twice is a no-op."""
+        self.governor._release(self)
+
+    def __del__(self):
+        # batches dropped without being tagged, e.g. still queued when tagging failed, must not hold on to the budget
+        if self.stage is not None:
+            self.release()
+
+class MemoryGovernor:
+    """
+    Bounds the bytes of decoded frames alive at once across every pipeline sharing it, e.g. the tagging workers of a
+    process.
+
+    Decoders `acquire` a lease for each batch they produce, which blocks while the frames already in flight plus the
+    new batch would exceed `max_bytes`, so decoding waits for the model instead of piling up batches. A decoder that
+    is waiting holds the batch it just decoded, the bound is thus exceeded by at most one batch per decoder. A batch
+    larger than `max_bytes` on its own is let through once nothing else is in flight, so that it can't stall forever.
+
+    In flight bytes are broken down by stage ("decode": decoded and queued, "model": being tagged), and the peak of the
+    total is recorded overall and for every owner (e.g. file) while it has frames in flight.
+    """
+    def __init__(self, max_bytes: int):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be > 0")
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.high_water = 0
+        self.wait_seconds = 0.0
+        self.bytes_by_stage: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self._owner_bytes: Dict[Hashable, int] = {}
+        self._owner_peak: Dict[Hashable, int] = {}
+        self._cond = threading.Condition()
+        _governors.add(self)
+
+    def acquire(
+        self,
+        nbytes: int,
+        owner: Hashable=None,
+        stage: str="decode",
+        timeout: Optional[float]=None,
+    ) -> FrameLease:
+        """
+        Waits until `nbytes` more fit in the budget and accounts them to `owner` under `stage`.
+
+        Raises:
+          TimeoutError: if they still don't fit after `timeout` seconds.
+        """
+        if stage not in self.bytes_by_stage:
+            raise ValueError(f"Unknown stage: {stage}")
+        def fits() -> bool:
+            return self.in_use == 0 or self.in_use + nbytes <= self.max_bytes
+
+        start = time.monotonic()
+        with self._cond:
+            if not self._cond.wait_for(fits, timeout=timeout):
+                raise TimeoutError(f"{nbytes} bytes of frames don't fit in the memory budget")
+            self.wait_seconds += time.monotonic() - start
+
+            self.in_use += nbytes
+            self.bytes_by_stage[stage] += nbytes
+            self._owner_bytes[owner] = self._owner_bytes.get(owner, 0) + nbytes
+            self.high_water = max(self.high_water, self.in_use)
+            for active in self._owner_bytes:
+                self._owner_peak[active] = max(self._owner_peak.get(active, 0), self.in_use)
+        return FrameLease(self, nbytes, owner, stage)
+
+    def _move(self, lease: FrameLease, stage: str) -> None:
+        if stage not in self.bytes_by_stage:
+            raise ValueError(f"Unknown stage: {stage}")
+        with self._cond:
+            if lease.stage is None:
+                return
+            self.bytes_by_stage[lease.stage] -= lease.nbytes
+            self.bytes_by_stage[stage] += lease.nbytes
+            lease.stage = stage
+
+    def _release(self, lease: FrameLease) -> None:
+        with self._cond:
+            if lease.stage is None:
+                return
+            self.in_use -= lease.nbytes
+            self.bytes_by_stage[lease.stage] -= lease.nbytes
+            lease.stage = None
+            remaining = self._owner_bytes[lease.owner] - lease.nbytes
+            if remaining:
+                self._owner_bytes[lease.owner] = remaining
+            else:
+                del self._owner_bytes[lease.owner]
+            self._cond.notify_all()
+
+    def pop_high_water(self, owner: Hashable) -> int:
+        """
+        The peak of the bytes in flight, across all owners, while `owner` had frames in flight, and forgets it.
+        """
+        with self._cond:
+            return self._owner_peak.pop(owner, 0)
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "max_bytes": self.max_bytes,
+                "in_use": self.in_use,
+                "high_water": self.high_water,
+                "wait_seconds": self.wait_seconds,
+                **{f"{stage}_bytes": nbytes for stage, nbytes in self.bytes_by_stage.items()},
+            }
+
+def split_memory_budgets(parts: int) -> None:
+    """
+    Divides the budget of every governor of this process by `parts`. Called from each of `parts` forked processes, so
+    that they share the budget of the governors they inherited rather than each getting a copy of all of it.
+    """
+    if parts <= 0:
+        raise ValueError("parts must be > 0")
+    for governor in list(_governors):
+        with governor._cond:
+            governor.max_bytes = max(1, governor.max_bytes // parts)
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+@dataclass(frozen=True)
+class FrameHandle:
+    """
+    Descriptor of an array stored in a `SlabPool` slab, cheap to send to another process.
+    """
+    slab: int
+    shape: Tuple[int, ...]
+    dtype: str
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+class SlabPool:
+    """
+    A fixed pool of equally sized shared memory slabs used to hand frame batches to other processes by descriptor only,
+    instead of pickling the arrays through a pipe.
+
+    The producer gets a slab with `allocate` (and decodes into it) or `put` (which copies), sends the returned
+    `FrameHandle` to one or more consumers, each of which gets a view with `get` and calls `release` when done. A slab
+    is reused once it has been released as many times as the `refs` it was allocated with. `allocate` blocks while
+    every slab is in use, which bounds the memory held by in flight batches.
+
+    The pool must be passed to the other processes when they are started (as a `Process` argument or pool initializer
+    argument), forked processes use the parent's mappings and spawned ones attach to the slabs by name. Processes started
+    before the pool can only fill slabs allocated for them, with `attach` and the slab's `slab_name`. The process that
+    created the pool frees the slabs with `close`.
+    """
+    def __init__(self, num_slabs: int, slab_bytes: int, ctx: Optional[multiprocessing.context.BaseContext]=None):
+        if num_slabs <= 0:
+            raise ValueError("num_slabs must be > 0")
+        if slab_bytes <= 0:
+            raise ValueError("slab_bytes must be > 0")
+        ctx = ctx or multiprocessing.get_context()
+        self.slab_bytes = slab_bytes
+        self._slabs = [SharedMemory(create=True, size=slab_bytes) for _ in range(num_slabs)]
+        self._owner_pid = os.getpid()
+        # references left on each slab, 0 when free
+        self._refs = ctx.Array("i", num_slabs)
+        self._free = ctx.Semaphore(num_slabs)
+
+    def __getstate__(self):
+        return {
+            "slab_bytes": self.slab_bytes,
+            "names": [shm.name for shm in self._slabs],
+            "owner_pid": self._owner_pid,
+            "refs": self._refs,
+            "free": self._free,
+        }
+
+    def __setstate__(self, state):
+        self.slab_bytes = state["slab_bytes"]
+        # processes started by multiprocessing share the creator's resource tracker, so attaching doesn't change who
+        # frees the slabs
+        self._slabs = [SharedMemory(name=name) for name in state["names"]]
+        self._owner_pid = state["owner_pid"]
+        self._refs = state["refs"]
+        self._free = state["free"]
+
+    @property
+    def num_slabs(self) -> int:
+        return len(self._slabs)
+
+    def allocate(
+        self,
+        shape: Tuple[int, ...],
+        dtype=np.uint8,
+        refs: int=1,
+        timeout: Optional[float]=None,
+    ) -> Tuple[FrameHandle, np.ndarray]:
+        """
+        Reserves a slab for an array of `shape` and returns its handle and a writable view of it.
+
+        Args:
+          refs: number of `release` calls after which the slab is free again, e.g. the number of consumers.
+          timeout: seconds to wait for a free slab, forever if None.
+
+        Raises:
+          ValueError: if the array doesn't fit in a slab.
+          TimeoutError: if no slab was freed within `timeout`.
+        """
+        if refs <= 0:
+            raise ValueError("refs must be > 0")
+        handle_dtype = np.dtype(dtype).str
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if nbytes > self.slab_bytes:
+            raise ValueError(f"{nbytes} bytes don't fit in a {self.slab_bytes} bytes slab")
+        if not self._free.acquire(timeout=timeout):
+            raise TimeoutError("No free slab")
+        with self._refs.get_lock():
+            slab = next(i for i, r in enumerate(self._refs) if r == 0)
+            self._refs[slab] = refs
+        handle = FrameHandle(slab=slab, shape=tuple(int(d) for d in shape), dtype=handle_dtype)
+        return handle, self.get(handle)
+
+    def put(self, frames: np.ndarray, refs: int=1, timeout: Optional[float]=None) -> FrameHandle:
+        """Copies `frames` into a free slab, see `allocate`."""
+        handle, view = self.allocate(frames.shape, frames.dtype, refs=refs, timeout=timeout)
+        np.copyto(view, frames)
+        return handle
+
+    def get(self, handle: FrameHandle) -> np.ndarray:
+        """A view of the array in the slab, valid until the handle is released."""
+        return np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=self._slabs[handle.slab].buf)
+
+    def slab_name(self, handle: FrameHandle) -> str:
+        """Name of the shared memory block holding the handle's slab, see `attach`."""
+        return self._slabs[handle.slab].name
+
+    def release(self, handle: FrameHandle) -> None:
+        with self._refs.get_lock():
+            refs = self._refs[handle.slab]
+            if refs <= 0:
+                raise ValueError(f"Slab {handle.slab} is not in use")
+            self._refs[handle.slab] = refs - 1
+        if refs == 1:
+            self._free.release()
+
+    def in_use(self) -> int:
+        """Number of slabs currently allocated."""
+        with self._refs.get_lock():
+            return sum(1 for r in self._refs if r > 0)
+
+    def close(self) -> None:
+        """Unmaps the slabs, and frees them if this is the process that created the pool."""
+        for shm in self._slabs:
+            shm.close()
+            if os.getpid() == self._owner_pid:
+                shm.unlink()
+        self._slabs = []
+
+@contextmanager
+def attach(slab_name: str, handle: FrameHandle) -> Iterator[np.ndarray]:
+    """
+    A view of the array of `handle` in the slab named `slab_name` (see `SlabPool.slab_name`), for a process the pool
+    wasn't passed to. The slab remains owned by the pool. Delete the view before leaving the context, the slab can't be
+    unmapped while it is referenced.
+    """
+    shm = SharedMemory(name=slab_name)
+    try:
+        yield np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+    finally:
+        shm.close()
@@ -1,180 +1,961 @@
 
-from functools import lru_cache
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+import bisect
+import multiprocessing
+import multiprocessing.util
+from multiprocessing import resource_tracker
+import threading
 
 import numpy as np
-from typing import Tuple, List
+from typing import Any, Callable, Deque, Dict, Hashable, Iterator, Optional, Tuple, List
 from fractions import Fraction
 import subprocess
-import json
 import os
 from loguru import logger
 import av
 
-@lru_cache(maxsize=2048)
-def get_fps(video_file: str) -> float:
-    cmd = ["ffprobe", "-v", "quiet", "-select_streams", "v",
-            "-show_entries", "stream=r_frame_rate,avg_frame_rate",
-            "-print_format", "json", video_file]
+from common_ml.media_info import probe
+from common_ml.utils.memory import MemoryGovernor
+from common_ml.utils.shared_frames import FrameHandle, SlabPool, attach
+
+@dataclass(frozen=True)
+class DecodeBudget:
+    """
+    Process wide limits on the threads used by video decoders, see `configure_decode_budget`.
+    """
+    threads: int                # decoder threads in total
+    max_decoders: int           # decoders open at once, each gets threads // max_decoders threads
+    thread_type: str = "AUTO"   # FFmpeg threading: "AUTO", "FRAME" or "SLICE"
+
+    @property
+    def threads_per_decoder(self) -> int:
+        return max(1, self.threads // self.max_decoders)
+
+_decode_budget: Optional[DecodeBudget] = None
+_decoder_slots: Optional[threading.Semaphore] = None
+
+def configure_decode_budget(threads: Optional[int], max_decoders: int=1, thread_type: str="AUTO") -> None:
+    """
+    Limits the decoders of this process to `max_decoders` open at once with `threads // max_decoders` threads each, so
+    that decoding several files concurrently (e.g. with several tagging workers) never uses more than `threads` threads.
+    Opening a decoder beyond `max_decoders` waits for another one to be closed. Pass None to remove the limits, in which
+    case FFmpeg picks the thread count of every decoder on its own.
+
+    Decoders already open keep their threads. Decode worker processes (see `iter_frame_batches`) split the threads of
+    the decoder that started them.
+    """
+    global _decode_budget, _decoder_slots
+    if threads is None:
+        _decode_budget, _decoder_slots = None, None
+        return
+    if threads <= 0:
+        raise ValueError("threads must be > 0")
+    if max_decoders <= 0:
+        raise ValueError("max_decoders must be > 0")
+    if thread_type not in ("AUTO", "FRAME", "SLICE"):
+        raise ValueError(f"Unknown thread_type: {thread_type}")
+    _decode_budget = DecodeBudget(threads=threads, max_decoders=max_decoders, thread_type=thread_type)
+    _decoder_slots = threading.Semaphore(max_decoders)
+
+def get_decode_budget() -> Optional[DecodeBudget]:
+    return _decode_budget
+
+@contextmanager
+def _decoder_slot() -> Iterator[Optional[int]]:
+    """
+    Holds one of the decoders of the budget, waiting for one to be free, and yields its thread count. Yields None if
+    no budget is configured.
+    """
+    budget, slots = _decode_budget, _decoder_slots
+    if budget is None:
+        yield None
+        return
+    slots.acquire()
     try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        raise Exception(e.output.decode("utf-8"))
-    
-    output = json.loads(output)
-    
-    if len(output["streams"]) > 1:
-        logger.warning(f"Found multiple streams in {video_file}... using the first one")
+        yield budget.threads_per_decoder
+    finally:
+        slots.release()
 
-    stream_info = output["streams"][0]
+@contextmanager
+def _open_video(video_file: str, thread_count: Optional[int]=None) -> Iterator[av.container.InputContainer]:
+    """
+    Opens `video_file` to decode its first video stream within the decode budget.
 
-    fps = float(Fraction(stream_info["avg_frame_rate"]))
-    if stream_info["r_frame_rate"] != stream_info["avg_frame_rate"]:
-        logger.error(f"{video_file} has variable frame rate, defaulting to average fps.")
+    Args:
+      thread_count: use this many threads without taking a slot of the budget, for decoders that are part of one
+        already holding a slot
+    """
+    with ExitStack() as stack:
+        if thread_count is None:
+            thread_count = stack.enter_context(_decoder_slot())
+        container = stack.enter_context(av.open(video_file))
+        stream = container.streams.video[0]
+        budget = _decode_budget
+        stream.thread_type = budget.thread_type if budget is not None else "AUTO"
+        if thread_count is not None:
+            stream.thread_count = thread_count
+        yield container
 
+def get_fps(video_file: str) -> float:
+    """
+    Average frame rate of the first video stream.
+    """
+    fps = probe(video_file).fps
+    if fps is None:
+        raise ValueError(f"No video stream with a frame rate found in {video_file}")
     return fps
 
-@lru_cache(maxsize=2048)
 def get_duration(video_file: str) -> float:
-    cmd = ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
-            "-print_format", "json", video_file]
-    try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        raise Exception(e.output.decode("utf-8"))
-
-    output = json.loads(output)
-    return float(output["format"]["duration"])
+    """
+    Duration of the container in seconds.
+    """
+    return probe(video_file).duration
 
 # input can be either downloadUrl or filename
 def get_key_frames(video_file: str) -> Tuple[np.ndarray, List[int], List[float]]:
-    cmd = ["ffprobe", "-v", "quiet", "-select_streams", "v", "-show_frames",
-            "-show_entries", "frame=width,height,pict_type,pkt_pts_time,pts_time",
-            "-print_format", "json", video_file]
-    try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        raise Exception(e.output.decode("utf-8"))
-    except FileNotFoundError as e:
-        raise FileNotFoundError("ffprobe not found in PATH. Make sure ffmpeg is installed.")
-    
-    output = json.loads(output)
-    if "frames" not in output or len(output["frames"]) == 0:
+    """
+    Returns:
+      frames:  (N, H, W, 3) uint8 RGB keyframes
+      indices: List[int] global 0-indexed frame numbers (presentation order)
+      times:   List[float] source timestamps (seconds) of each keyframe
+    """
+    frames_out, idx_out, t_out = [], [], []
+    for frame, idx, t in iter_key_frames(video_file):
+        if frames_out and frame.shape != frames_out[0].shape:
+            raise RuntimeError("Variable resolution not supported in this helper.")
+        frames_out.append(frame)
+        idx_out.append(idx)
+        t_out.append(t)
+
+    if not frames_out:
         raise Exception(f"No frames found in {video_file}")
-    w, h = output["frames"][0]["width"], output["frames"][0]["height"]
-    # some versions do not specify pkt_pts_time, use pts_time in that case
-    timestamp_key = "pkt_pts_time" if "pkt_pts_time" in output["frames"][0] else "pts_time"
 
-    timestamps = [float(f[timestamp_key]) for f in output["frames"] if f["pict_type"] == 'I']
-    f_pos = [i for i, f in enumerate(output["frames"]) if f["pict_type"] == 'I']
+    return np.stack(frames_out), idx_out, t_out
 
-    cmd = ["ffmpeg", "-nostdin", "-i", video_file,
-            "-vf", "select='eq(pict_type,I)'", "-vsync", "2",
-            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{w}x{h}", "pipe:"]
+def iter_key_frames(video_file: str) -> Iterator[Tuple[np.ndarray, int, float]]:
+    """
+    Yields (frame, global_idx, time) for every keyframe of the video, in presentation order, in a single pass.
 
-    process = subprocess.Popen(cmd, stderr=-1, stdout=-1)
-    out, err = process.communicate()
-    retcode = process.poll()
-    if retcode:
-        raise Exception(f"ffmpeg error: {err.decode('utf-8')}")
+    Only keyframe packets are sent to the decoder (with skip_frame="NONKEY"), the other packets are demuxed to count
+    frames but never decoded. A keyframe is yielded as soon as the next keyframe packet has been demuxed, at which
+    point every frame presented before it is known.
+    """
+    with _open_video(video_file) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = "NONKEY"
+
+        seen_pts: List[int] = []        # sorted pts of every demuxed frame so far
+        n_packets = 0
+        pending: List[list] = []        # [pts, global_idx or None, decoded frame or None], in decode order
+
+        def decode(packet: av.Packet) -> None:
+            for f in packet.decode():
+                for entry in pending:
+                    if entry[2] is None and (f.pts is None or entry[0] is None or entry[0] == f.pts):
+                        entry[2] = f
+                        break
+
+        def resolve() -> None:
+            for entry in pending:
+                if entry[1] is None:
+                    entry[1] = bisect.bisect_left(seen_pts, entry[0])
+
+        def ready() -> Iterator[Tuple[np.ndarray, int, float]]:
+            while pending and pending[0][1] is not None and pending[0][2] is not None:
+                _, idx, f = pending.pop(0)
+                t = float(f.time) if f.time is not None else idx / get_fps(video_file)
+                yield f.to_ndarray(format="rgb24"), idx, t
+
+        for packet in container.demux(stream):
+            if packet.size == 0:
+                # flush packet, drain the decoder
+                decode(packet)
+                continue
 
-    frames = np.frombuffer(out, np.uint8)
-    frames = frames.reshape((-1, h, w, 3))
+            if packet.is_keyframe:
+                # every frame presented before the earlier keyframes has been demuxed by now
+                resolve()
+                # without a pts, fall back to the decode order position
+                pending.append([packet.pts, None if packet.pts is not None else n_packets, None])
 
-    assert len(timestamps) == frames.shape[0] == len(f_pos), "Key frames returned and key frames extracted from file metadata do not match"
+            if packet.pts is not None:
+                bisect.insort(seen_pts, packet.pts)
+            n_packets += 1
 
-    sorted_frames = sorted(((frame, pos, ts) for frame, pos, ts in zip(frames, f_pos, timestamps)), key=lambda x: x[1])
-    frames, f_pos, timestamps = zip(*sorted_frames)
-    return np.stack(frames), list(f_pos), list(timestamps)
+            if packet.is_keyframe:
+                decode(packet)
+            yield from ready()
 
-def get_frames(
+        resolve()
+        missing = [entry for entry in pending if entry[2] is None]
+        if missing:
+            logger.warning(f"{len(missing)} keyframes of {video_file} could not be decoded")
+            pending = [entry for entry in pending if entry[2] is not None]
+        yield from ready()
+
+class _FrameSampler:
+    """
+    Selects, from a stream of decoded frames in presentation order, the frame nearest to each point of a regular
+    time grid anchored at the first frame's timestamp.
+
+    Frames are pushed one at a time and the selected ones are returned as soon as they are known, so callers never
+    need to hold more than the previous frame.
+    """
+    def __init__(self, fps: float):
+        if fps <= 0:
+            raise ValueError("sample_fps must be > 0")
+        self.dt = 1.0 / fps
+        self.prev = None            # (frame, global_idx, time)
+        self.target_t = None
+        self.last_selected_idx = -1
+
+    def push(self, frame: Any, idx: int, t: float) -> List[Tuple[Any, int, float]]:
+        if self.prev is None:
+            self.prev = (frame, idx, t)
+            # Anchor the sampling grid at the first frame's timestamp
+            self.target_t = t
+            return []
+
+        prev = self.prev
+        cur = (frame, idx, t)
+        selected = []
+
+        # Emit samples for all targets that fall up to current frame time
+        while self.target_t <= t:
+            choose_prev = abs(prev[2] - self.target_t) <= abs(t - self.target_t)
+            sel = prev if choose_prev else cur
+
+            if sel[1] != self.last_selected_idx:  # de-dup if two targets hit same frame
+                selected.append(sel)
+                self.last_selected_idx = sel[1]
+
+            self.target_t += self.dt
+
+        self.prev = cur
+        return selected
+
+@dataclass
+class _PacketIndex:
+    """
+    Presentation timestamps of every frame of a video stream, collected by demuxing without decoding.
+    """
+    pts: List[int]              # sorted, i.e. in presentation order
+    key_pts: List[int]          # sorted pts of the keyframes
+    time_base: Fraction
+
+    def times(self) -> List[float]:
+        # same as VideoFrame.time for the decoded frames
+        return [float(pts * self.time_base) for pts in self.pts]
+
+    def keyframe_before(self, pts: int) -> int:
+        i = bisect.bisect_right(self.key_pts, pts) - 1
+        return self.key_pts[max(i, 0)]
+
+def _scan_packets(video_file: str, max_keyframes: Optional[int]=None) -> Optional[_PacketIndex]:
+    """
+    Demuxes the first video stream without decoding it.
+
+    Returns None if some packet has no pts, in which case frame timestamps can only be known by decoding.
+
+    Args:
+      max_keyframes: stop after this many keyframes have been seen, useful to cheaply estimate the GOP length
+    """
+    with av.open(video_file) as container:
+        stream = container.streams.video[0]
+        if stream.time_base is None:
+            return None
+        pts, key_pts = [], []
+        for packet in container.demux(stream):
+            if packet.size == 0:
+                # flush packet
+                continue
+            if packet.pts is None:
+                return None
+            if packet.is_keyframe:
+                if max_keyframes is not None and len(key_pts) == max_keyframes:
+                    break
+                key_pts.append(packet.pts)
+            pts.append(packet.pts)
+        return _PacketIndex(pts=sorted(pts), key_pts=sorted(key_pts), time_base=stream.time_base)
+
+def _gop_seconds(video_file: str) -> float:
+    """
+    Estimates the interval between keyframes from the start of the stream, inf if there is at most one keyframe.
+    """
+    index = _scan_packets(video_file, max_keyframes=4)
+    if index is None or len(index.key_pts) < 2:
+        return float("inf")
+    return float((index.key_pts[-1] - index.key_pts[0]) * index.time_base) / (len(index.key_pts) - 1)
+
+def _iter_sampled_frames(
     video_file: str,
     fps: float,
-) -> Tuple[np.ndarray, List[int], List[float]]:
+    sampling: str="auto",
+) -> Iterator[Tuple[av.VideoFrame, int, float]]:
     """
+    Yields (frame, global_idx, time) for each frame selected by a `_FrameSampler`.
+
     Args:
-      video_file: path to video
-      sample_fps: sampling rate in Hz (frames/sec)
+      sampling: "sequential" decodes every frame of the stream, "seek" decodes only from the keyframe preceding each
+        selected frame up to it, "auto" seeks if the sampling interval is longer than the GOP.
+    """
+    if sampling not in ("auto", "sequential", "seek"):
+        raise ValueError(f"Unknown sampling mode: {sampling}")
+    if fps <= 0:
+        raise ValueError("sample_fps must be > 0")
 
-    Returns:
-      frames:  (N, H, W, 3) uint8 RGB frames
-      indices: List[int] global 0-indexed frame numbers (presentation order)
-      times:   List[float] source timestamps (seconds) of each selected frame
+    if sampling == "auto":
+        sampling = "seek" if 1.0 / fps > _gop_seconds(video_file) else "sequential"
 
-    Notes:
-      - Accurate for CFR and VFR: select by nearest timestamp to a regular time grid.
-      - Single decode pass; no ffprobe crawl.
-      - Timestamps come from frame.time or pts*time_base; if missing, fallback to idx / get_fps().
+    if sampling == "seek":
+        index = _scan_packets(video_file)
+        if index is not None:
+            yield from _iter_seek_sampled_frames(video_file, fps, index)
+            return
+        logger.warning(f"{video_file} has packets without timestamps, falling back to sequential decoding.")
+
+    yield from _iter_sequential_sampled_frames(video_file, fps)
+
+def _iter_seek_sampled_frames(
+    video_file: str,
+    fps: float,
+    index: _PacketIndex,
+) -> Iterator[Tuple[av.VideoFrame, int, float]]:
     """
-    sample_fps = fps
-    if sample_fps <= 0:
-        raise ValueError("sample_fps must be > 0")
-    dt = 1.0 / sample_fps
+    Selects frames from the packet timestamps up front, then only decodes the GOPs containing them.
+    """
+    yield from _iter_seek_frames(video_file, _seek_targets(fps, index))
+
+def _seek_targets(fps: float, index: _PacketIndex) -> List[Tuple[int, float, int, int]]:
+    """
+    (global_idx, time, pts, pts of the preceding keyframe) of the frames a `_FrameSampler` selects from the packet
+    timestamps.
+    """
+    sampler = _FrameSampler(fps)
+    targets = []
+    for idx, t in enumerate(index.times()):
+        for _, sel_idx, sel_t in sampler.push(None, idx, t):
+            pts = index.pts[sel_idx]
+            targets.append((sel_idx, sel_t, pts, index.keyframe_before(pts)))
+    return targets
+
+def _iter_seek_frames(
+    video_file: str,
+    targets: List[Tuple[int, float, int, int]],
+    thread_count: Optional[int]=None,
+) -> Iterator[Tuple[av.VideoFrame, int, float]]:
+    """
+    Decodes the frames given by `_seek_targets`: seeks to the keyframe preceding a target unless it is already being
+    decoded and decodes up to it.
+
+    Args:
+      thread_count: decoder threads, for a decoder that is part of one already holding a slot of the decode budget
+    """
+    with _open_video(video_file, thread_count) as container:
+        stream = container.streams.video[0]
+
+        frames = None
+        last_pts = None
+        for idx, t, target_pts, key_pts in targets:
+            if frames is None or last_pts is None or key_pts > last_pts:
+                container.seek(key_pts, stream=stream)
+                frames = container.decode(stream)
+
+            f = None
+            for f in frames:
+                last_pts = f.pts
+                if f.pts is not None and f.pts >= target_pts:
+                    break
+            if f is None or f.pts != target_pts:
+                raise RuntimeError(f"Could not decode frame {idx} (pts={target_pts}) of {video_file} after seeking")
+
+            yield f, idx, t
+
+def _iter_sequential_sampled_frames(video_file: str, fps: float) -> Iterator[Tuple[av.VideoFrame, int, float]]:
+    """
+    Decodes `video_file` once and yields (frame, global_idx, time) for each frame selected by a `_FrameSampler`.
+    """
+    sampler = _FrameSampler(fps)
+    for f, global_idx, t in _iter_decoded_frames(video_file):
+        yield from sampler.push(f, global_idx, t)
+
+def _iter_decoded_frames(video_file: str) -> Iterator[Tuple[av.VideoFrame, int, float]]:
+    """
+    Decodes every frame of `video_file` and yields (frame, global_idx, time) in presentation order.
+    """
+    with _open_video(video_file) as container:
+        stream = container.streams.video[0]
+
+        time_base = float(stream.time_base) if stream.time_base else None
+        true_fps = None
+
+        global_idx = -1
+        for packet in container.demux(stream):
+            for f in packet.decode():
+                global_idx += 1
+                if f.time is not None:
+                    t = float(f.time)
+                elif f.pts is not None and time_base is not None:
+                    t = float(f.pts) * time_base
+                else:
+                    # Fallback only if the stream gives no usable timestamps.
+                    if true_fps is None:
+                        true_fps = get_fps(video_file)
+                    t = global_idx / true_fps
+
+                yield f, global_idx, t
+
+class FrameBufferRing:
+    """
+    A ring of pre-allocated (batch_size, H, W, 3) uint8 buffers that decoded frames are written into directly.
+
+    Buffers are allocated on first use, once the frame size is known, and handed out in round robin order, so in steady
+    state decoding performs no large numpy allocations. A buffer is overwritten `num_buffers` batches after it was
+    handed out: consumers must be done with a batch by then, or copy it.
+    """
+    def __init__(self, num_buffers: int, batch_size: int):
+        if num_buffers <= 0:
+            raise ValueError("num_buffers must be > 0")
+        self.num_buffers = num_buffers
+        self.batch_size = batch_size
+        self.shape = None
+        self._buffers: List[np.ndarray] = []
+        self._next = 0
+
+    def next_buffer(self, shape: Tuple[int, int, int]) -> np.ndarray:
+        if self.shape is None:
+            self.shape = shape
+        elif shape != self.shape:
+            raise RuntimeError("Variable resolution not supported in this helper.")
 
-    container = av.open(video_file)
-    stream = container.streams.video[0]
-    stream.thread_type = "AUTO"
+        if len(self._buffers) < self.num_buffers:
+            self._buffers.append(np.empty((self.batch_size, *shape), dtype=np.uint8))
+            return self._buffers[-1]
 
-    true_fps = get_fps(video_file)
+        buf = self._buffers[self._next]
+        self._next = (self._next + 1) % self.num_buffers
+        return buf
 
-    time_base = float(stream.time_base) if stream.time_base else None
+def resize_dims(
+    width: int,
+    height: int,
+    size: Optional[Tuple[int, int]]=None,
+    max_side: Optional[int]=None,
+) -> Tuple[int, int]:
+    """
+    Returns the (width, height) a (width, height) frame should be resized to.
 
-    def frame_time(idx: int, f: av.VideoFrame) -> float:
-        if f.time is not None:
-            return float(f.time)
-        if f.pts is not None and time_base is not None:
-            return float(f.pts) * time_base
-        # Fallback only if the stream gives no usable timestamps.
-        return idx / true_fps
+    Args:
+      size: exact (width, height) output size
+      max_side: scale down, preserving aspect ratio, so that the longest side is at most max_side. Never upscales.
+    """
+    if size is not None and max_side is not None:
+        raise ValueError("Only one of size and max_side can be specified")
+    if size is not None:
+        return int(size[0]), int(size[1])
+    if max_side is not None:
+        if max_side <= 0:
+            raise ValueError("max_side must be > 0")
+        scale = max_side / max(width, height)
+        if scale < 1:
+            return max(1, round(width * scale)), max(1, round(height * scale))
+    return width, height
+
+# swscale interpolations that frames can be resized with
+INTERPOLATIONS = ("FAST_BILINEAR", "BILINEAR", "BICUBIC", "POINT", "AREA", "LANCZOS")
+
+def check_interpolation(interpolation: Optional[str]) -> None:
+    """Raises a ValueError if `interpolation` is neither None (the default, "BILINEAR") nor one of `INTERPOLATIONS`."""
+    if interpolation is not None and interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation: {interpolation}, expected one of {', '.join(INTERPOLATIONS)}")
+
+def _to_rgb(
+    frame: av.VideoFrame,
+    size: Optional[Tuple[int, int]]=None,
+    max_side: Optional[int]=None,
+    interpolation: Optional[str]=None,
+) -> av.VideoFrame:
+    """
+    Converts a decoded frame to rgb24, resizing it in the same swscale call so the full resolution RGB frame is never
+    materialized.
+    """
+    if size is None and max_side is None:
+        return frame.reformat(format="rgb24")
+    width, height = resize_dims(frame.width, frame.height, size, max_side)
+    if (width, height) == (frame.width, frame.height):
+        return frame.reformat(format="rgb24")
+    return frame.reformat(width=width, height=height, format="rgb24", interpolation=interpolation)
+
+def _copy_rgb_into(frame: av.VideoFrame, out: np.ndarray) -> None:
+    """
+    Copies an rgb24 frame into `out` (H, W, 3) straight from the frame's plane, skipping the line padding.
+    """
+    plane = frame.planes[0]
+    src = np.frombuffer(plane, dtype=np.uint8).reshape(frame.height, plane.line_size)
+    np.copyto(out.reshape(frame.height, frame.width * 3), src[:, :frame.width * 3])
+
+def iter_frame_batches(
+    video_file: str,
+    fps: float,
+    batch_size: int=32,
+    reuse_buffers: int=0,
+    size: Optional[Tuple[int, int]]=None,
+    max_side: Optional[int]=None,
+    interpolation: Optional[str]=None,
+    sampling: str="auto",
+    decode_workers: int=0,
+    memory_governor: Optional[MemoryGovernor]=None,
+    memory_owner: Hashable=None,
+) -> Iterator[Tuple[np.ndarray, List[int], List[float]]]:
+    """
+    Streaming version of `get_frames`: decodes the video once and yields the sampled frames in chunks of at most
+    `batch_size`, so peak memory is bounded by the batch rather than by the length of the video.
+
+    Args:
+      video_file: path to video
+      fps: sampling rate in Hz (frames/sec)
+      batch_size: maximum number of frames per yielded chunk
+      reuse_buffers: if > 0, frames are decoded into a `FrameBufferRing` of this many buffers and the yielded frames
+        are views into it, valid until `reuse_buffers` more batches have been pulled from the iterator.
+      size: resize frames to this exact (width, height) while decoding
+      max_side: downscale frames while decoding so that their longest side is at most max_side
+      interpolation: swscale interpolation used when resizing, e.g. "BILINEAR" (default), "AREA", "BICUBIC"
+      sampling: "sequential" decodes every frame, "seek" seeks to the keyframe preceding each sampled frame and only
+        decodes from there, "auto" (default) seeks when the sampling interval is longer than the GOP. All modes select
+        the same frames.
+      decode_workers: if > 1, split the video at keyframes into segments decoded in this many worker processes, see
+        `_iter_parallel_frame_batches`. The frames are the same as with serial decoding, `reuse_buffers` and
+        `sampling` are ignored.
+      memory_governor: accounts the shared memory the `decode_workers` decode into to `memory_owner`, and holds less
+        of it to fit the budget. The yielded batches are left to the caller to account.
+
+    Yields:
+      frames:  (n, H, W, 3) uint8 RGB frames, 1 <= n <= batch_size
+      indices: List[int] global 0-indexed frame numbers (presentation order)
+      times:   List[float] source timestamps (seconds) of each selected frame
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be > 0")
+    check_interpolation(interpolation)
+
+    if decode_workers > 1:
+        index = _scan_packets(video_file)
+        segments = _split_segments(_seek_targets(fps, index), batch_size) if index is not None else None
+        if index is None:
+            logger.warning(f"{video_file} has packets without timestamps, falling back to serial decoding.")
+        elif not segments:
+            return
+        elif max(len(segment) for segment in segments) > _MAX_SEGMENT_BATCHES * batch_size:
+            # segments are only cut between GOPs, the frames of a longer one would all be held at once
+            logger.warning(f"{video_file} has too many sampled frames between keyframes, falling back to serial "
+                "decoding.")
+        else:
+            width, height = resize_dims(*probe(video_file).resolution, size, max_side)
+            frame_bytes = height * width * 3
+            # up to two segments in flight per worker
+            num_slabs = 2 * decode_workers
+            if memory_governor is not None:
+                # the slabs are held until the whole video is decoded, a batch must still fit next to them
+                max_segment_bytes = max(len(segment) for segment in segments) * frame_bytes
+                num_slabs = min(num_slabs, (memory_governor.max_bytes - batch_size * frame_bytes) // max_segment_bytes)
+            if num_slabs < 1:
+                logger.warning(f"{video_file} segments don't fit in the memory budget, falling back to serial "
+                    "decoding.")
+            else:
+                yield from _iter_parallel_frame_batches(
+                    video_file, segments, (height, width, 3), num_slabs, batch_size, decode_workers, size, max_side,
+                    interpolation, memory_governor, memory_owner,
+                )
+                return
+
+    def convert(f: av.VideoFrame) -> av.VideoFrame:
+        return _to_rgb(f, size, max_side, interpolation)
+
+    if reuse_buffers > 0:
+        ring = FrameBufferRing(reuse_buffers, batch_size)
+        yield from _iter_frame_batches_into(video_file, fps, ring, convert, sampling)
+        return
 
     frames_out: List[np.ndarray] = []
     idx_out: List[int] = []
     t_out: List[float] = []
+    shape = None
 
-    prev = None                # (frame, global_idx, time)
-    global_idx = -1
-    target_t = None
-    last_selected_idx = -1
-
-    for packet in container.demux(stream):
-        for f in packet.decode():
-            global_idx += 1
-            t = frame_time(global_idx, f)
-
-            if prev is None:
-                prev = (f, global_idx, t)
-                # Anchor the sampling grid at the first frame's timestamp
-                if target_t is None:
-                    target_t = t
-                continue
+    for f, idx, t in _iter_sampled_frames(video_file, fps, sampling):
+        rgb = convert(f).to_ndarray()
+        if shape is None:
+            shape = rgb.shape
+        elif rgb.shape != shape:
+            raise RuntimeError("Variable resolution not supported in this helper.")
+        frames_out.append(rgb)
+        idx_out.append(idx)
+        t_out.append(t)
 
-            cur = (f, global_idx, t)
+        if len(frames_out) == batch_size:
+            yield np.stack(frames_out, axis=0), idx_out, t_out
+            frames_out, idx_out, t_out = [], [], []
 
-            # Emit samples for all targets that fall up to current frame time
-            while target_t <= cur[2]:
-                choose_prev = abs(prev[2] - target_t) <= abs(cur[2] - target_t)
-                sel = prev if choose_prev else cur
+    if frames_out:
+        yield np.stack(frames_out, axis=0), idx_out, t_out
 
-                if sel[1] != last_selected_idx:  # de-dup if two targets hit same frame
-                    rgb = sel[0].to_ndarray(format="rgb24")
-                    frames_out.append(rgb)
-                    idx_out.append(sel[1])
-                    t_out.append(sel[2])
-                    last_selected_idx = sel[1]
+def _iter_frame_batches_into(
+    video_file: str,
+    fps: float,
+    ring: FrameBufferRing,
+    convert: Callable[[av.VideoFrame], av.VideoFrame],
+    sampling: str,
+) -> Iterator[Tuple[np.ndarray, List[int], List[float]]]:
+    buf = None
+    n = 0
+    idx_out: List[int] = []
+    t_out: List[float] = []
 
-                target_t += dt
+    for f, idx, t in _iter_sampled_frames(video_file, fps, sampling):
+        rgb = convert(f)
+        if buf is None:
+            buf = ring.next_buffer((rgb.height, rgb.width, 3))
+        elif (rgb.height, rgb.width, 3) != ring.shape:
+            raise RuntimeError("Variable resolution not supported in this helper.")
+        _copy_rgb_into(rgb, buf[n])
+        n += 1
+        idx_out.append(idx)
+        t_out.append(t)
 
-            prev = cur
+        if n == ring.batch_size:
+            yield buf, idx_out, t_out
+            buf, n, idx_out, t_out = None, 0, [], []
 
-    container.close()
+    if n > 0:
+        yield buf[:n], idx_out, t_out
 
-    if frames_out:
-        h, w = frames_out[0].shape[:2]
-        if any(f.shape[:2] != (h, w) for f in frames_out):
-            raise RuntimeError("Variable resolution not supported in this helper.")
-        frames = np.stack(frames_out, axis=0)
-    else:
-        frames = np.empty((0, 0, 0, 3), dtype=np.uint8)
+def iter_multi_rate_frame_batches(
+    video_file: str,
+    fps: Dict[str, float],
+    batch_size: int=32,
+    size: Optional[Tuple[int, int]]=None,
+    max_side: Optional[int]=None,
+    interpolation: Optional[str]=None,
+) -> Iterator[Tuple[str, np.ndarray, List[int], List[float]]]:
+    """
+    Decodes the video once and samples it at several rates, e.g. for several models that each need their own fps.
+
+    Every decoded frame is pushed to one `_FrameSampler` per key of `fps`, and only the frames selected by at least one
+    of them are converted to RGB, once. The batches of a key are the same as `iter_frame_batches(video_file, fps[key],
+    batch_size, sampling="sequential", ...)`, and the batches of different keys are interleaved in decoding order.
 
+    Yields:
+      key:     the key of `fps` the batch was sampled for
+      frames:  (n, H, W, 3) uint8 RGB frames, 1 <= n <= batch_size
+      indices: List[int] global 0-indexed frame numbers (presentation order)
+      times:   List[float] source timestamps (seconds) of each selected frame
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be > 0")
+    check_interpolation(interpolation)
+    samplers = {key: _FrameSampler(rate) for key, rate in fps.items()}
+    pending = {key: ([], [], []) for key in fps}
+    shape = None
+    # a sampler only ever selects the previous or the current frame, so those are the only conversions worth keeping
+    converted: Dict[int, np.ndarray] = {}
+
+    for f, idx, t in _iter_decoded_frames(video_file):
+        for i in [i for i in converted if i < idx - 1]:
+            del converted[i]
+        for key, sampler in samplers.items():
+            frames_out, idx_out, t_out = pending[key]
+            for sel, sel_idx, sel_t in sampler.push(f, idx, t):
+                rgb = converted.get(sel_idx)
+                if rgb is None:
+                    rgb = converted[sel_idx] = _to_rgb(sel, size, max_side, interpolation).to_ndarray()
+                if shape is None:
+                    shape = rgb.shape
+                elif rgb.shape != shape:
+                    raise RuntimeError("Variable resolution not supported in this helper.")
+                frames_out.append(rgb)
+                idx_out.append(sel_idx)
+                t_out.append(sel_t)
+
+                if len(frames_out) == batch_size:
+                    yield key, np.stack(frames_out, axis=0), idx_out, t_out
+                    frames_out, idx_out, t_out = pending[key] = ([], [], [])
+
+    for key, (frames_out, idx_out, t_out) in pending.items():
+        if frames_out:
+            yield key, np.stack(frames_out, axis=0), idx_out, t_out
+
+# longest segment, in batches, that is decoded in parallel, as every segment in flight holds a slab of that size
+_MAX_SEGMENT_BATCHES = 4
+
+def _split_segments(
+    targets: List[Tuple[int, float, int, int]],
+    min_frames: int,
+) -> List[List[Tuple[int, float, int, int]]]:
+    """
+    Splits `_seek_targets` into consecutive segments of at least `min_frames` frames (but the last), only cutting
+    between frames that follow different keyframes so that no GOP is decoded by two segments.
+    """
+    segments, current = [], []
+    for target in targets:
+        if len(current) >= min_frames and target[3] != current[-1][3]:
+            segments.append(current)
+            current = []
+        current.append(target)
+    if current:
+        segments.append(current)
+    return segments
+
+def _decode_segment(
+    video_file: str,
+    targets: List[Tuple[int, float, int, int]],
+    size: Optional[Tuple[int, int]],
+    max_side: Optional[int],
+    interpolation: Optional[str],
+    thread_count: Optional[int],
+    slab_name: str,
+    handle: FrameHandle,
+) -> Tuple[List[int], List[float]]:
+    """
+    Runs in a decode worker process: decodes one segment given by `_split_segments` into the slab allocated for it,
+    whose `handle` has room for exactly its frames.
+    """
+    idx_out, t_out = [], []
+    with attach(slab_name, handle) as out:
+        for f, idx, t in _iter_seek_frames(video_file, targets, thread_count):
+            rgb = _to_rgb(f, size, max_side, interpolation)
+            if (rgb.height, rgb.width) != out.shape[1:3]:
+                raise RuntimeError("Variable resolution not supported in this helper.")
+            _copy_rgb_into(rgb, out[len(idx_out)])
+            idx_out.append(idx)
+            t_out.append(t)
+        del out
+    return idx_out, t_out
+
+# (pid of the process that started it, number of workers, pool), see _get_decode_pool
+_decode_pool: Optional[Tuple[int, int, ProcessPoolExecutor]] = None
+_decode_pool_lock = threading.Lock()
+
+def start_decode_workers(num_workers: int) -> None:
+    """
+    Starts the worker processes of `iter_frame_batches(..., decode_workers=num_workers)`, otherwise started by the first
+    such call. Workers are forked, so call this from the main thread before starting other threads (e.g. the ones
+    decoding in the background in `AVModel`), whose locks the workers would inherit.
+
+    The workers are shared by every parallel decode of the process and shut down at exit, or by `stop_decode_workers`.
+    """
+    _get_decode_pool(num_workers)
+
+def restart_decode_workers() -> None:
+    """
+    Starts this process' own decode workers if it was forked from one that had started some, e.g. in the initializer of
+    a worker process. Inherited workers belong to the parent.
+    """
+    with _decode_pool_lock:
+        pool = _decode_pool
+    if pool is not None and pool[0] != os.getpid():
+        _get_decode_pool(pool[1])
+
+def stop_decode_workers() -> None:
+    """Shuts down the decode workers of this process, if any."""
+    global _decode_pool
+    with _decode_pool_lock:
+        pool, _decode_pool = _decode_pool, None
+    if pool is not None and pool[0] == os.getpid():
+        pool[2].shutdown(cancel_futures=True)
+
+def _reset_decode_pool_lock() -> None:
+    global _decode_pool_lock
+    # another thread of the parent may have held it while forking
+    _decode_pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_decode_pool_lock)
+
+def _get_decode_pool(num_workers: int) -> ProcessPoolExecutor:
+    """
+    The process pool shared by every parallel decode, started with `num_workers` workers on first use. A single pool is
+    kept: it is replaced by a larger one if more workers are asked for, and the previous one shuts down once its
+    pending segments are decoded.
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        old = _decode_pool
+        if old is not None and old[0] == os.getpid() and old[1] >= num_workers:
+            return old[2]
+        # the workers attach to the parent's slabs (see _reassemble_segments), they must share its resource tracker
+        # rather than start their own, which would free the slabs when the workers exit
+        resource_tracker.ensure_running()
+        # forked so that it works from scripts without a __main__ guard, workers only use PyAV and numpy
+        pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"))
+        # forked workers are all started on the first submit, do it now rather than when the first segment is sent,
+        # possibly from a background thread
+        pool.submit(int).result()
+        _decode_pool = (os.getpid(), num_workers, pool)
+        if old is None or old[0] != os.getpid():
+            # unlike atexit, also runs when a process started by multiprocessing exits, before it waits for its children
+            # (the workers) and before the pool's queues are closed (priority 10)
+            multiprocessing.util.Finalize(None, stop_decode_workers, exitpriority=20)
+    # a pool inherited from the parent process is not ours to shut down
+    if old is not None and old[0] == os.getpid():
+        old[2].shutdown(wait=False)
+    return pool
+
+def _iter_parallel_frame_batches(
+    video_file: str,
+    segments: List[List[Tuple[int, float, int, int]]],
+    frame_shape: Tuple[int, int, int],
+    num_slabs: int,
+    batch_size: int,
+    num_workers: int,
+    size: Optional[Tuple[int, int]],
+    max_side: Optional[int],
+    interpolation: Optional[str],
+    memory_governor: Optional[MemoryGovernor],
+    memory_owner: Hashable,
+) -> Iterator[Tuple[np.ndarray, List[int], List[float]]]:
+    """
+    Decodes a video in segments on `num_workers` processes and yields the same batches as `iter_frame_batches`.
+
+    The frames to sample are selected up front from the packet timestamps, as with seek sampling, and split at keyframes
+    into `segments` of about `batch_size` frames (see `_split_segments`). Workers decode the segments independently,
+    seeking to their first keyframe, and the segments are put back in order with their global frame indices and
+    timestamps. Up to `num_slabs` segments are in flight, each in a slab sized for the longest segment, which bounds
+    memory use regardless of the length of the video as long as the segments are (`iter_frame_batches` decodes serially
+    when a segment exceeds `_MAX_SEGMENT_BATCHES` batches).
+    """
+    slab_bytes = max(len(segment) for segment in segments) * int(np.prod(frame_shape))
+    with ExitStack() as stack:
+        if memory_governor is not None:
+            lease = memory_governor.acquire(num_slabs * slab_bytes, owner=memory_owner)
+            stack.callback(lease.release)
+        # the workers write each segment into a shared memory slab instead of pickling the frames back
+        slabs = SlabPool(num_slabs, slab_bytes)
+        stack.callback(slabs.close)
+        # the workers count as a single decoder of the budget and share its threads
+        threads = stack.enter_context(_decoder_slot())
+        thread_count = max(1, threads // num_workers) if threads is not None else None
+        yield from _reassemble_segments(
+            ((video_file, segment, size, max_side, interpolation, thread_count) for segment in segments),
+            (len(segment) for segment in segments),
+            frame_shape,
+            slabs,
+            batch_size,
+            num_workers,
+        )
+
+def _reassemble_segments(
+    segment_args: Iterator[tuple],
+    segment_lengths: Iterator[int],
+    frame_shape: Tuple[int, int, int],
+    slabs: SlabPool,
+    batch_size: int,
+    num_workers: int,
+) -> Iterator[Tuple[np.ndarray, List[int], List[float]]]:
+    """
+    Runs `_decode_segment` on each of `segment_args` in the decode pool, into a slab of `slabs` for the
+    `segment_lengths` frames of `frame_shape` of the segment, and yields the frames in order, in batches of
+    `batch_size`, one segment per slab in flight.
+
+    The frames are copied out of the slabs once, which is intended: batches are cut across segments, and consumers
+    keep them for longer than a slab can be held back (prefetch queues, cross file batching), so the slabs are freed
+    for the next segments right away.
+    """
+    pending: Deque[Tuple[FrameHandle, Future]] = deque()
+
+    def submit() -> None:
+        args = next(segment_args, None)
+        if args is not None:
+            handle, _ = slabs.allocate((next(segment_lengths), *frame_shape))
+            # the pool may be replaced by a larger one while decoding
+            future = _get_decode_pool(num_workers).submit(_decode_segment, *args, slabs.slab_name(handle), handle)
+            pending.append((handle, future))
+
+    frames_out: List[np.ndarray] = []
+    idx_out: List[int] = []
+    t_out: List[float] = []
+    num_out = 0
+    try:
+        for _ in range(slabs.num_slabs):
+            submit()
+        while pending:
+            handle, future = pending[0]
+            indices, times = future.result()
+            pending.popleft()
+            frames = slabs.get(handle).copy()
+            slabs.release(handle)
+            submit()
+            frames_out.append(frames)
+            idx_out.extend(indices)
+            t_out.extend(times)
+            num_out += len(frames)
+            if num_out < batch_size:
+                continue
+
+            # cut the segments into batches of exactly batch_size, like serial decoding
+            all_frames = np.concatenate(frames_out, axis=0) if len(frames_out) > 1 else frames_out[0]
+            n = num_out - num_out % batch_size
+            for i in range(0, n, batch_size):
+                yield all_frames[i:i + batch_size], idx_out[i:i + batch_size], t_out[i:i + batch_size]
+            frames_out = [all_frames[n:]] if n < num_out else []
+            idx_out, t_out, num_out = idx_out[n:], t_out[n:], num_out - n
+        if num_out > 0:
+            yield np.concatenate(frames_out, axis=0), idx_out, t_out
+    finally:
+        # on error, or if the consumer stops early, don't decode the remaining segments
+        for _, future in pending:
+            future.cancel()
+        # segments already being decoded still write to their slab
+        wait([future for _, future in pending])
+
+def get_frames(
+    video_file: str,
+    fps: float,
+    size: Optional[Tuple[int, int]]=None,
+    max_side: Optional[int]=None,
+    interpolation: Optional[str]=None,
+    sampling: str="auto",
+    decode_workers: int=0,
+) -> Tuple[np.ndarray, List[int], List[float]]:
+    """
+    Args:
+      video_file: path to video
+      sample_fps: sampling rate in Hz (frames/sec)
+      size: resize frames to this exact (width, height) while decoding
+      max_side: downscale frames while decoding so that their longest side is at most max_side
+      interpolation: swscale interpolation used when resizing, e.g. "BILINEAR" (default), "AREA", "BICUBIC"
+      sampling: "sequential", "seek" or "auto", see `iter_frame_batches`
+      decode_workers: decode segments of the video in this many processes, see `iter_frame_batches`
+
+    Returns:
+      frames:  (N, H, W, 3) uint8 RGB frames
+      indices: List[int] global 0-indexed frame numbers (presentation order)
+      times:   List[float] source timestamps (seconds) of each selected frame
+
+    Notes:
+      - Accurate for CFR and VFR: select by nearest timestamp to a regular time grid.
+      - Single decode pass; no ffprobe crawl. For sparse sampling grids only the GOPs containing sampled frames are
+        decoded.
+      - Timestamps come from frame.time or pts*time_base; if missing, fallback to idx / get_fps().
+      - Materializes every sampled frame, prefer `iter_frame_batches` for long videos.
+    """
+    batches = list(iter_frame_batches(
+        video_file,
+        fps,
+        batch_size=256,
+        size=size,
+        max_side=max_side,
+        interpolation=interpolation,
+        sampling=sampling,
+        decode_workers=decode_workers,
+    ))
+
+    if not batches:
+        return np.empty((0, 0, 0, 3), dtype=np.uint8), [], []
+
+    frames = np.concatenate([b[0] for b in batches], axis=0)
+    idx_out = [i for b in batches for i in b[1]]
+    t_out = [t for b in batches for t in b[2]]
     return frames, idx_out, t_out
 
 def unfrag_video(video_file: str, output_file: str):
@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+from common_ml.utils.concurrency import IDLE, prefetch
+
+def test_prefetch_order():
+    assert list(prefetch(range(100), depth=3)) == list(range(100))
+
+def test_prefetch_exception():
+    def gen():
+        yield 1
+        raise RuntimeError("decode failed")
+
+    it = prefetch(gen(), depth=2)
+    assert next(it) == 1
+    with pytest.raises(RuntimeError, match="decode failed"):
+        next(it)
+
+def test_prefetch_early_stop():
+    closed = threading.Event()
+    produced = []
+
+    def gen():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    it = prefetch(gen(), depth=2)
+    assert next(it) == 0
+    time.sleep(0.1)
+    # the producer is held back by the queue depth
+    assert len(produced) <= 4
+    it.close()
+    assert closed.wait(timeout=1)
+
+def test_prefetch_wait():
+    def gen():
+        yield 1
+        time.sleep(0.5)
+        yield 2
+
+    items = list(prefetch(gen(), depth=2, wait=lambda: 0.05))
+    assert items[0] == 1 and items[-1] == 2
+    assert IDLE in items[1:-1]
@@ -1,10 +1,17 @@
 
 
+import time
+
+import pytest
+
 from common_ml.tagging.run_helpers import *
 from common_ml.tagging.messages import *
-from common_ml.tagging.models.av import AVModel
+from common_ml.tagging.models.av import AVModel, TagWithPos
 from common_ml.tagging.models.frame_based import FrameModel
+from common_ml.tagging.models.tag_types import FrameTag, TagTable
 from common_ml.tagging.file_tagger import *
+from common_ml.video_processing import get_fps, get_frames
+from common_ml.utils.memory import MemoryGovernor
 
 
 def test_video_tag(video_model: AVModel, test_videos: List[str]):
@@ -78,4 +85,254 @@ def test_frame_tag_videos_single_false(frame_model: FrameModel, test_videos: Lis
 
     for tag in video_tags:
         # we shouldn't have single frame video tags.
-        assert tag.end_time > tag.start_time + 1000
\ No newline at end of file
+        assert tag.end_time > tag.start_time + 1000
+
+def test_frame_tag_videos_pipelined(frame_model: FrameModel, test_videos: List[str]):
+    serial = FileTagger.from_frame_model(type(frame_model)(), fps=2, allow_single_frame=True, batch_size=5, queue_depth=0)
+    pipelined = FileTagger.from_frame_model(type(frame_model)(), fps=2, allow_single_frame=True, batch_size=5, queue_depth=3)
+
+    for fname in test_videos:
+        assert serial.tag(fname) == pipelined.tag(fname)
+
+def test_frame_tag_resize(test_videos: List[str], test_images: List[str]):
+    shapes = []
+
+    class ShapeModel(BatchFrameModel):
+        def tag_frames(self, imgs):
+            shapes.append(imgs.shape[1:])
+            return [[] for _ in imgs]
+
+    file_tagger = FileTagger.from_frame_model(ShapeModel(), fps=1, max_side=320)
+    file_tagger.tag(test_videos[0])
+    file_tagger.tag(test_images[-1])
+
+    assert len(shapes) > 1
+    assert all(max(shape[:2]) == 320 for shape in shapes)
+
+def test_frame_tag_unknown_interpolation(frame_model: FrameModel, test_videos: List[str]):
+    with pytest.raises(ValueError):
+        FileTagger.from_frame_model(frame_model, fps=1, max_side=320, interpolation="NEAREST")
+    with pytest.raises(ValueError):
+        AVModel.from_frame_model(BatchFrameModel.from_frame_model(frame_model), 1, True, interpolation="NEAREST").tag(test_videos[0])
+
+def test_cross_file_batching(test_videos: List[str], test_images: List[str]):
+    batch_sizes = []
+
+    class CountingModel(BatchFrameModel):
+        def __init__(self):
+            self.n = 0
+
+        def tag_frames(self, imgs):
+            batch_sizes.append(len(imgs))
+            tags = []
+            for _ in imgs:
+                tags.append([FrameTag(tag=str(self.n // 3), box={})])
+                self.n += 1
+            return tags
+
+    # 30 frames per video at 1 fps
+    files = test_videos + test_images[-1:] + test_videos
+    per_file = FileTagger.from_frame_model(CountingModel(), fps=1, batch_size=16)
+    expected = list(per_file.tag_files(files))
+    assert batch_sizes == [16, 14, 16, 14, 1, 16, 14, 16, 14]
+
+    batch_sizes.clear()
+    cross_file = FileTagger.from_frame_model(CountingModel(), fps=1, batch_size=16, cross_file_batching=True, max_batch_latency=60)
+    result = list(cross_file.tag_files(files))
+    # the image is tagged on its own, in between the two runs of videos
+    assert batch_sizes == [16, 16, 16, 12, 1, 16, 16, 16, 12]
+
+    assert [f for f, _ in result] == files
+    assert result == expected
+
+@pytest.mark.parametrize("fan_out", [False, True])
+def test_cross_file_batching_latency(test_videos: List[str], monkeypatch, fan_out: bool):
+    from common_ml.tagging.models import av as av_module
+
+    # the second file takes a while to open, the partial batch of the first one must not wait for it
+    resumed = []
+    def slow_decode(decode):
+        def wrapped(fpath, *args, **kwargs):
+            if fpath == test_videos[1]:
+                time.sleep(1)
+                resumed.append(time.monotonic())
+            yield from decode(fpath, *args, **kwargs)
+        return wrapped
+    monkeypatch.setattr(av_module, "iter_frame_batches", slow_decode(av_module.iter_frame_batches))
+    monkeypatch.setattr(av_module, "iter_multi_rate_frame_batches", slow_decode(av_module.iter_multi_rate_frame_batches))
+
+    calls = []
+    class TimingModel(BatchFrameModel):
+        def tag_frames(self, imgs):
+            calls.append((len(imgs), time.monotonic()))
+            return [[] for _ in imgs]
+
+    kwargs = dict(batch_size=64, cross_file_batching=True, max_batch_latency=0.2)
+    if fan_out:
+        model = AVModel.from_frame_models({"timing": TimingModel()}, {"timing": 1}, True, **kwargs)
+    else:
+        model = AVModel.from_frame_model(TimingModel(), 1, True, **kwargs)
+    assert [f for f, _ in model.tag_files(test_videos)] == test_videos
+
+    # 30 frames per video at 1 fps
+    assert [n for n, _ in calls] == [30, 30]
+    assert calls[0][1] < resumed[0]
+
+def test_combine_adjacent(frame_model: FrameModel):
+    def frame_tag(label: str, pos: int) -> TagWithPos:
+        return TagWithPos(pos=pos, tag=Tag(tag=label, start_time=pos * 1000, end_time=pos * 1000, source_media="1.mp4",
+            frame_info=FrameInfo(frame_idx=pos, box={})))
+
+    # b appears twice on frame 1, a is missing from frame 3
+    tags = [frame_tag("b", 0), frame_tag("a", 1), frame_tag("b", 1), frame_tag("b", 1), frame_tag("a", 2), frame_tag("a", 4)]
+
+    def combine(allow_single_frame: bool, max_gap: int) -> List[Tuple[str, int, int]]:
+        model = AVModel.from_frame_model(BatchFrameModel.from_frame_model(frame_model), 1, allow_single_frame, max_gap=max_gap)
+        return [(t.tag, t.start_time, t.end_time) for t in model._combine_adjacent(tags, allow_single_frame, 1)]
+
+    assert combine(True, 0) == [("b", 0, 2000), ("b", 1000, 2000), ("a", 1000, 3000), ("a", 4000, 5000)]
+    assert combine(False, 0) == [("b", 0, 2000), ("a", 1000, 3000)]
+    assert combine(False, 1) == [("b", 0, 2000), ("a", 1000, 5000)]
+
+def test_frame_tag_timestamps(frame_model: FrameModel, test_videos: List[str]):
+    # frame level tags carry the decoded timestamps, not frame_idx / average fps
+    file_tagger = FileTagger.from_frame_model(frame_model, fps=2, allow_single_frame=True)
+    tags = [t for t in file_tagger.tag(test_videos[0]) if t.frame_info is not None]
+    _, indices, times = get_frames(test_videos[0], 2)
+    expected = {idx: round(t * 1000) for idx, t in zip(indices, times)}
+    assert len(tags) > 0
+    assert all(t.start_time == t.end_time == expected[t.frame_info.frame_idx] for t in tags)
+    assert any(t.start_time != round(t.frame_info.frame_idx / get_fps(test_videos[0]) * 1000) for t in tags)
+
+class BrightnessModel(BatchFrameModel):
+    """Tags each frame with its quantized brightness, counting the frames it is run on."""
+    def __init__(self, as_table: bool=False):
+        self.frames_tagged = 0
+        self.as_table = as_table
+
+    def tag_frames(self, imgs: np.ndarray):
+        self.frames_tagged += len(imgs)
+        tags = [[FrameTag(tag=f"brightness_{int(img.mean()) // 16}", box={"x1": 0, "y1": 0, "x2": 1, "y2": 1})] for img in imgs]
+        return TagTable.from_frame_tags(tags) if self.as_table else tags
+
+@pytest.mark.parametrize("as_table", [False, True])
+def test_frame_dedup(test_videos: List[str], as_table: bool):
+    def tag(threshold: Optional[float]):
+        frame_model = BrightnessModel(as_table)
+        model = AVModel.from_frame_model(frame_model, 2, True, batch_size=8, dedup_threshold=threshold)
+        tags = []
+        model.file_stats = []
+        for _, file_tags, stats in model.tag_files_with_stats(test_videos):
+            for t in file_tags:
+                tags.extend(t.to_tags() if isinstance(t, TagTable) else [t])
+            model.file_stats.extend(stats)
+        return tags, frame_model.frames_tagged, model
+
+    expected, num_frames, model = tag(None)
+    assert model.file_stats == []
+
+    # only identical frames are skipped
+    tags, _, model = tag(0.0)
+    assert tags == expected
+    assert model.dedup_stats.frames == num_frames
+
+    # everything looks the same, the model only runs on the first frame of each file
+    tags, frames_tagged, model = tag(1.0)
+    assert frames_tagged == len(test_videos)
+    assert model.dedup_stats.skipped == num_frames - len(test_videos)
+    assert model.dedup_stats.hit_rate > 0.9
+    # the same counts are reported for each file
+    assert [(s.name, s.source_media) for s in model.file_stats] == [("dedup", fpath) for fpath in test_videos]
+    assert sum(s.stats["frames"] for s in model.file_stats) == num_frames
+    assert sum(s.stats["skipped"] for s in model.file_stats) == num_frames - len(test_videos)
+    frame_tags = [t for t in tags if t.frame_info is not None]
+    assert len(frame_tags) == len([t for t in expected if t.frame_info is not None])
+    for fpath in test_videos:
+        first = next(t for t in expected if t.source_media == fpath)
+        assert {t.tag for t in frame_tags if t.source_media == fpath} == {first.tag}
+
+    # in between, fewer frames are tagged and most tags are unchanged
+    tags, frames_tagged, model = tag(0.05)
+    assert frames_tagged < num_frames
+    assert model.dedup_stats.skipped == num_frames - frames_tagged
+
+def test_frame_models_fan_out(test_videos: List[str], monkeypatch):
+    from common_ml import video_processing
+
+    decoded = []
+    decode = video_processing._iter_decoded_frames
+    monkeypatch.setattr(video_processing, "_iter_decoded_frames", lambda f: decoded.append(f) or decode(f))
+
+    rates = {"dark": 1, "bright": 4, "table": 2}
+    models = {"dark": BrightnessModel(), "bright": BrightnessModel(), "table": BrightnessModel(as_table=True)}
+    fan_out = AVModel.from_frame_models(models, rates, True, batch_size=8, cross_file_batching=True)
+    results = list(fan_out.tag_files(test_videos))
+    # each file is decoded once for every model
+    assert decoded == test_videos
+
+    singles = {
+        name: AVModel.from_frame_model(BrightnessModel(name == "table"), rates[name], True, batch_size=8, track=name)
+        for name in models
+    }
+    expected = {name: dict(model.tag_files(test_videos)) for name, model in singles.items()}
+    def expand(tags):
+        return [r for t in tags for r in (t.to_tags() if isinstance(t, TagTable) else [t])]
+
+    assert [fpath for fpath, _ in results] == test_videos
+    for fpath, tags in results:
+        assert expand(tags) == expand(t for name in models for t in expected[name][fpath])
+        assert {t.track for t in expand(tags)} == set(models)
+
+class FailingModel(BatchFrameModel):
+    def tag_frames(self, imgs: np.ndarray):
+        raise RuntimeError("model failed")
+
+def test_frame_models_fan_out_error(test_videos: List[str]):
+    model = AVModel.from_frame_models({"ok": BrightnessModel(), "failing": FailingModel()}, {"ok": 1, "failing": 1}, True)
+    with pytest.raises(RuntimeError, match="model failed"):
+        list(model.tag_files(test_videos))
+
+def test_frame_tag_parallel_decode(test_videos: List[str]):
+    serial = AVModel.from_frame_model(BrightnessModel(), 2, True, batch_size=8)
+    parallel = AVModel.from_frame_model(BrightnessModel(), 2, True, batch_size=8, decode_workers=2)
+    assert list(parallel.tag_files(test_videos)) == list(serial.tag_files(test_videos))
+
+class SlowModel(BrightnessModel):
+    def tag_frames(self, imgs: np.ndarray):
+        time.sleep(0.01)
+        return super().tag_frames(imgs)
+
+def test_frame_memory_governor(test_videos: List[str]):
+    frame_bytes = get_frames(test_videos[0], 1)[0][0].nbytes
+    governor = MemoryGovernor(max_bytes=4 * frame_bytes)
+    model = AVModel.from_frame_model(SlowModel(), 2, True, batch_size=2, queue_depth=8, memory_governor=governor)
+    results = list(model.tag_files_with_stats(test_videos))
+    expected = list(AVModel.from_frame_model(BrightnessModel(), 2, True, batch_size=2).tag_files(test_videos))
+
+    for (fpath, tags, stats), (_, expected_tags) in zip(results, expected):
+        [stat] = stats
+        assert stat.name == "frame_memory" and stat.source_media == fpath
+        assert 0 < stat.stats["high_water_bytes"] <= 6 * frame_bytes
+        assert tags == expected_tags
+    # the decoder was held back by the model, by at most one batch over the budget
+    assert 0 < governor.high_water <= 6 * frame_bytes
+    assert governor.in_use == 0
+
+    fan_out = AVModel.from_frame_models({"a": SlowModel(), "b": BrightnessModel()}, {"a": 2, "b": 1}, True,
+        memory_governor=governor)
+    for fpath, tags, stats in fan_out.tag_files_with_stats(test_videos):
+        assert [stat.name for stat in stats] == ["frame_memory"] and stats[0].source_media == fpath
+        assert not any(isinstance(t, Stat) for t in tags)
+
+def test_frame_memory_governor_errors(test_videos: List[str]):
+    governor = MemoryGovernor(max_bytes=1)
+    model = AVModel.from_frame_model(FailingModel(), 2, True, batch_size=2, memory_governor=governor)
+    with pytest.raises(RuntimeError, match="model failed"):
+        list(model.tag_files(test_videos))
+    fan_out = AVModel.from_frame_models({"ok": BrightnessModel(), "failing": FailingModel()}, {"ok": 2, "failing": 2}, True,
+        memory_governor=governor)
+    with pytest.raises(RuntimeError, match="model failed"):
+        list(fan_out.tag_files(test_videos))
+    assert governor.in_use == 0
+    # the peaks of the files that failed are not kept around
+    assert governor._owner_peak == {}
@@ -0,0 +1,79 @@
+import os
+from typing import List
+
+import numpy as np
+
+import common_ml.frame_cache as frame_cache_module
+from common_ml.frame_cache import FrameCache
+from common_ml.tagging.models.av import AVModel
+from common_ml.tagging.models.frame_based import BatchFrameModel, FrameModel
+from common_ml.video_processing import iter_frame_batches
+
+def _collect(batches):
+    batches = list(batches)
+    return np.concatenate([b[0] for b in batches]), sum((b[1] for b in batches), []), sum((b[2] for b in batches), [])
+
+def test_frame_cache(test_videos: List[str], test_folder: str):
+    video = test_videos[0]
+    expected = _collect(iter_frame_batches(video, 2, 16, max_side=128))
+
+    cache = FrameCache(test_folder, 1024**3)
+    first = _collect(cache.iter_frame_batches(video, 2, 16, max_side=128))
+    assert cache.total_bytes() > expected[0].nbytes
+
+    # another instance, e.g. in another process, maps the entry instead of decoding
+    batches = list(FrameCache(test_folder, 1024**3).iter_frame_batches(video, 2, 16, max_side=128))
+    assert all(isinstance(frames, np.memmap) and not frames.flags.writeable for frames, _, _ in batches)
+    assert max(len(frames) for frames, _, _ in batches) == 16
+    second = _collect(batches)
+
+    for out in (first, second):
+        assert np.array_equal(out[0], expected[0])
+        assert out[1] == expected[1] and out[2] == expected[2]
+
+def test_frame_cache_evicted_while_loading(test_videos: List[str], test_folder: str, monkeypatch):
+    video = test_videos[0]
+    expected = _collect(FrameCache(test_folder, 1024**3).iter_frame_batches(video, 1, max_side=64))
+
+    # another process removes the entry between mapping it and touching it
+    def evicted(path, *args, **kwargs):
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(frame_cache_module.os, "utime", evicted)
+    frames, indices, times = _collect(FrameCache(test_folder, 1024**3).iter_frame_batches(video, 1, max_side=64))
+    assert np.array_equal(frames, expected[0]) and indices == expected[1] and times == expected[2]
+
+def test_frame_cache_eviction(test_videos: List[str], test_folder: str):
+    entry_bytes = _collect(iter_frame_batches(test_videos[0], 1, max_side=64))[0].nbytes
+    cache = FrameCache(test_folder, int(entry_bytes * 1.5))
+
+    _collect(cache.iter_frame_batches(test_videos[0], 1, max_side=64))
+    _collect(cache.iter_frame_batches(test_videos[1], 1, max_side=64))
+    entries = [f for f in os.listdir(test_folder) if f.endswith(".frames")]
+    assert len(entries) == 1
+    assert cache.total_bytes() <= cache.max_bytes
+
+    # too large to be cached at all, but all the frames are still returned
+    frames, _, _ = _collect(cache.iter_frame_batches(test_videos[0], 1, max_side=256))
+    assert frames.nbytes > cache.max_bytes
+    assert [f for f in os.listdir(test_folder) if f.endswith(".frames")] == entries
+    assert not [f for f in os.listdir(test_folder) if f.endswith(".tmp")]
+
+def test_av_model_frame_cache(frame_model: FrameModel, test_videos: List[str], test_folder: str, monkeypatch):
+    decoded = []
+    def counting_decode(video_file, *args, **kwargs):
+        decoded.append(video_file)
+        return iter_frame_batches(video_file, *args, **kwargs)
+    monkeypatch.setattr(frame_cache_module, "iter_frame_batches", counting_decode)
+
+    cache = FrameCache(test_folder, 1024**3)
+    results = []
+    for _ in range(3):
+        frame_model.call_count = 0
+        model = AVModel.from_frame_model(BatchFrameModel.from_frame_model(frame_model), 1, True, frame_cache=cache)
+        results.append(dict(model.tag_files(test_videos)))
+        # only the first run decodes, the later ones map the cached frames
+        assert decoded == test_videos
+    frame_model.call_count = 0
+    expected = dict(AVModel.from_frame_model(BatchFrameModel.from_frame_model(frame_model), 1, True).tag_files(test_videos))
+    assert all(r == expected for r in results)
@@ -1,3 +1,4 @@
+import io
 import json
 import os
 import sys
@@ -7,7 +8,7 @@ from typing import Iterator
 from unittest.mock import patch
 
 from common_ml.tagging.producer import TagMessageProducer
-from common_ml.tagging.run_helpers import start_loop_from_frame_model, start_loop_from_producer, run_default
+from common_ml.tagging.run_helpers import start_loop_from_frame_model, start_loop_from_producer, run_default, write_message, MessageWriter
 from common_ml.tagging.models.frame_based import *
 from common_ml.tagging.messages import *
 
@@ -324,4 +325,108 @@ def test_loop_with_progress(frame_model: FrameModel, test_videos: List[str], tes
 
     finally:
         write_pipe.close()
-        proc.join(timeout=5)
\ No newline at end of file
+        proc.join(timeout=5)
+
+def _run_latency_loop(output_path, read_fd, write_fd, batch_timeout, batch_limit):
+    os.close(write_fd)
+    sys.stdin = os.fdopen(read_fd, 'r')
+
+    class EchoProducer(TagMessageProducer):
+        def produce(self, files: List[str]) -> Iterator[Message]:
+            for f in files:
+                yield Tag(start_time=0, end_time=0, tag="seen", source_media=f)
+                yield Progress(source_media=f)
+
+    start_loop_from_producer(EchoProducer(), output_path, batch_timeout=batch_timeout, batch_limit=batch_limit)
+
+def _first_tag_latency(test_folder: str, files: List[str], batch_timeout: float, batch_limit: Optional[int]) -> float:
+    """Seconds from writing `files` to stdin until the first tag shows up in the output file."""
+    output_path = os.path.join(test_folder, f"latency_{batch_timeout}_{batch_limit}.jsonl")
+    open(output_path, "w").close()
+
+    read_fd, write_fd = os.pipe()
+    proc = multiprocessing.Process(target=_run_latency_loop, args=(output_path, read_fd, write_fd, batch_timeout, batch_limit))
+    proc.start()
+    os.close(read_fd)
+    write_pipe = os.fdopen(write_fd, 'w')
+    try:
+        # let the loop start up and block on stdin
+        time.sleep(0.5)
+        start = time.monotonic()
+        write_pipe.write("\n".join(files) + "\n")
+        write_pipe.flush()
+        while time.monotonic() - start < 10:
+            with open(output_path, "r") as f:
+                if '"tag"' in f.read():
+                    return time.monotonic() - start
+            time.sleep(0.005)
+        raise AssertionError("no tag was written")
+    finally:
+        write_pipe.close()
+        proc.join(timeout=5)
+
+def test_loop_latency(test_videos: List[str], test_folder: str):
+    # a full batch is dispatched right away, regardless of the timeout
+    full_batch = _first_tag_latency(test_folder, test_videos, batch_timeout=5, batch_limit=len(test_videos))
+    assert full_batch < 1
+
+    # a partial batch waits for the timeout, counted from its first file, and no longer
+    partial_batch = _first_tag_latency(test_folder, test_videos[:1], batch_timeout=0.5, batch_limit=None)
+    assert 0.5 <= partial_batch < 1.5
+    assert full_batch < partial_batch
+
+class _CountingFile(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        super().flush()
+
+def test_message_writer():
+    messages = [
+        Tag(start_time=0, end_time=1000, tag="a/b", source_media="/tmp/1.mp4", additional_info={"score": 0.5},
+            frame_info=FrameInfo(frame_idx=0, box={"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4})),
+        Tag(start_time=1000, end_time=2000, tag="é", source_media="/tmp/1.mp4"),
+        Progress(source_media="/tmp/1.mp4"),
+        ProgressRatio(progress=0.5),
+        Tag(start_time=0, end_time=1000, tag="c", source_media="/tmp/2.mp4"),
+        Error(message="oops", source_media="/tmp/2.mp4"),
+    ]
+
+    expected = _CountingFile()
+    for msg in messages:
+        write_message(msg, expected)
+
+    out = _CountingFile()
+    writer = MessageWriter(out)
+    writer.write(messages[0])
+    writer.write(messages[1])
+    # tags are buffered until the progress message of their file
+    assert out.getvalue() == ""
+    writer.write(messages[2])
+    assert out.getvalue().count("\n") == 3
+    for msg in messages[3:]:
+        writer.write(msg)
+
+    assert out.flushes == 3
+    assert [json.loads(l) for l in out.getvalue().splitlines()] == [json.loads(l) for l in expected.getvalue().splitlines()]
+    assert json.loads(out.getvalue().splitlines()[0])["data"]["source_media"] == "/tmp/1.mp4"
+
+def test_message_writer_thresholds():
+    out = _CountingFile()
+    writer = MessageWriter(out, max_buffer_bytes=500, max_delay=3600)
+    for i in range(10):
+        writer.write(Tag(start_time=i, end_time=i + 1, tag="a", source_media="1.mp4"))
+    assert 0 < out.flushes < 10
+    writer.flush()
+    assert len(out.getvalue().splitlines()) == 10
+
+    out = _CountingFile()
+    writer = MessageWriter(out, max_delay=0.05)
+    writer.write(Tag(start_time=0, end_time=1, tag="a", source_media="1.mp4"))
+    assert out.getvalue() == ""
+    time.sleep(0.1)
+    writer.write(Tag(start_time=1, end_time=2, tag="a", source_media="1.mp4"))
+    assert len(out.getvalue().splitlines()) == 2
@@ -0,0 +1,116 @@
+import os
+import shutil
+import multiprocessing
+
+import pytest
+
+from common_ml import media_info
+from common_ml.media_info import probe
+from common_ml.utils.cache import DiskCache
+from common_ml.video_processing import get_fps, get_duration
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "test-data")
+
+def test_probe():
+    info = probe(os.path.join(TEST_DATA, "1.mp4"))
+
+    assert info.resolution == (640, 272)
+    assert info.fps == pytest.approx(23.97, abs=0.01)
+    assert info.duration == pytest.approx(30.03, abs=0.01)
+    assert info.time_base is not None
+    assert [s.type for s in info.streams] == ["video"]
+    assert info.audio is None
+
+    assert get_fps(os.path.join(TEST_DATA, "1.mp4")) == info.fps
+    assert get_duration(os.path.join(TEST_DATA, "1.mp4")) == info.duration
+
+def test_probe_cache(test_folder: str):
+    path = os.path.join(test_folder, "part.mp4")
+    shutil.copy(os.path.join(TEST_DATA, "1.mp4"), path)
+
+    info = probe(path)
+    assert probe(path) is info
+
+    # reusing the path for other content must not serve the stale entry
+    shutil.copy(os.path.join(TEST_DATA, "2.mp4"), path)
+    os.utime(path, ns=(0, 0))
+    new_info = probe(path)
+    assert new_info is not info
+    assert new_info.duration == probe(os.path.join(TEST_DATA, "2.mp4")).duration
+
+def test_probe_cache_url(monkeypatch):
+    url = "https://example.com/video.mp4"
+    info = probe(os.path.join(TEST_DATA, "1.mp4"))
+    calls = []
+    def fake_probe(path):
+        calls.append(path)
+        return info
+    monkeypatch.setattr(media_info, "_probe", fake_probe)
+    media_info.clear_cache()
+
+    # urls have no (size, mtime), they are memoized by path
+    assert probe(url) is info
+    assert probe(url) is info
+    assert calls == [url]
+
+def _probe_in_subprocess(path: str, cache_dir: str, out):
+    from common_ml import media_info
+    media_info.configure_disk_cache(cache_dir)
+    # a fresh process has nothing in memory, the result can only come from disk
+    media_info._probe = None
+    out.put(media_info.probe(path).duration)
+
+def test_probe_disk_cache(test_folder: str):
+    path = os.path.join(test_folder, "part.mp4")
+    shutil.copy(os.path.join(TEST_DATA, "1.mp4"), path)
+    cache_dir = os.path.join(test_folder, "cache")
+
+    media_info.configure_disk_cache(cache_dir)
+    try:
+        media_info.clear_cache()
+        info = probe(path)
+
+        ctx = multiprocessing.get_context("spawn")
+        out = ctx.Queue()
+        proc = ctx.Process(target=_probe_in_subprocess, args=(path, cache_dir, out))
+        proc.start()
+        assert out.get(timeout=30) == info.duration
+        proc.join()
+
+        media_info.clear_cache()
+        assert probe(path) == info
+    finally:
+        media_info.configure_disk_cache(None)
+
+@pytest.mark.parametrize("broken", ["not_a_directory", "corrupt"])
+def test_probe_disk_cache_unusable(test_folder: str, monkeypatch, broken: str):
+    if broken == "not_a_directory":
+        with open(os.path.join(test_folder, "file"), "w") as f:
+            f.write("x")
+        cache_dir = os.path.join(test_folder, "file", "cache")
+    else:
+        cache_dir = os.path.join(test_folder, "cache")
+        os.makedirs(cache_dir)
+        with open(os.path.join(cache_dir, "probe.sqlite"), "wb") as f:
+            f.write(b"not a database" * 100)
+    monkeypatch.setenv(media_info.CACHE_DIR_ENV, cache_dir)
+    monkeypatch.setattr(media_info, "_disk_cache_configured", False)
+    media_info.clear_cache()
+    try:
+        # falls back to probing, and doesn't try to open the cache again
+        assert probe(os.path.join(TEST_DATA, "1.mp4")).resolution == (640, 272)
+        assert media_info._disk_cache_configured and media_info._disk_cache is None
+    finally:
+        media_info.configure_disk_cache(None)
+
+def test_disk_cache_eviction(test_folder: str):
+    cache = DiskCache(test_folder, max_bytes=100)
+    cache.put("a", b"x" * 40)
+    cache.put("b", b"x" * 40)
+    assert cache.get("a") is not None
+    evicted = cache.put("c", b"x" * 40)
+
+    # "b" is the least recently used
+    assert evicted == ["b"]
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.total_bytes() == 80
@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+from common_ml.utils.memory import MemoryGovernor
+
+def test_memory_governor_backpressure():
+    governor = MemoryGovernor(max_bytes=100)
+    first = governor.acquire(60, owner="a")
+    second = governor.acquire(40, owner="b")
+    assert governor.stats()["decode_bytes"] == 100
+
+    # a third batch waits until the model is done with one of them
+    with pytest.raises(TimeoutError):
+        governor.acquire(10, owner="b", timeout=0.05)
+    acquired = threading.Event()
+    leases = []
+    thread = threading.Thread(target=lambda: leases.append(governor.acquire(10, owner="b")) or acquired.set())
+    thread.start()
+    first.move("model")
+    assert governor.stats()["model_bytes"] == 60 and governor.stats()["decode_bytes"] == 40
+    assert not acquired.wait(timeout=0.1)
+    first.release()
+    assert acquired.wait(timeout=5)
+    thread.join()
+
+    assert governor.high_water == 100
+    assert governor.pop_high_water("a") == 100
+    assert governor.pop_high_water("a") == 0
+    second.release()
+    second.release()
+    assert governor.in_use == 10
+
+def test_memory_governor_oversized_batch():
+    governor = MemoryGovernor(max_bytes=100)
+    # too large for the budget, but let through when nothing else is in flight
+    lease = governor.acquire(150)
+    with pytest.raises(TimeoutError):
+        governor.acquire(1, timeout=0.05)
+    # dropping a lease releases it
+    del lease
+    assert governor.in_use == 0
+    governor.acquire(1, timeout=0.05)
@@ -0,0 +1,44 @@
+import json
+from dataclasses import asdict
+
+import pytest
+
+from common_ml.tagging.messages import *
+
+MESSAGES = [
+    Tag(start_time=0, end_time=1000, tag="a/b", source_media="/tmp/1.mp4", track="object_detection",
+        additional_info={"score": 0.5, "nested": {"x": [1, 2]}},
+        frame_info=FrameInfo(frame_idx=3, box={"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4})),
+    Tag(start_time=1000, end_time=2000, tag="é", source_media="1.mp4"),
+    Progress(source_media="1.mp4"),
+    ProgressRatio(progress=0.25),
+    Error(message="oops"),
+    Error(message="oops", source_media="1.mp4"),
+    Stat(name="result_cache", stats={"hit": 1, "hits": 3, "misses": 1}, source_media="1.mp4"),
+]
+
+def test_to_dict_matches_asdict():
+    for msg in MESSAGES:
+        assert msg.to_dict() == asdict(msg)
+        assert list(msg.to_dict()) == list(asdict(msg))
+        assert json.loads(msg.to_json()) == asdict(msg)
+
+def test_to_dict_does_not_copy():
+    tag = MESSAGES[0]
+    data = tag.to_dict()
+    assert data["additional_info"] is tag.additional_info
+    assert data["frame_info"]["box"] is tag.frame_info.box
+
+def test_from_dict_round_trip():
+    for msg in MESSAGES:
+        assert type(msg).from_dict(json.loads(msg.to_json())) == msg
+    # optional fields may be omitted
+    assert Tag.from_dict({"start_time": 0, "end_time": 1, "tag": "a", "source_media": "1.mp4"}) == \
+        Tag(start_time=0, end_time=1, tag="a", source_media="1.mp4")
+
+def test_message_is_abstract():
+    class NoDict(Message):
+        pass
+
+    with pytest.raises(TypeError):
+        NoDict()
@@ -1,4 +1,6 @@
 
+import multiprocessing
+import time
 from typing import List
 
 import pytest
@@ -7,6 +9,8 @@ from common_ml.tagging.messages import *
 from common_ml.tagging.file_tagger import FileTagger
 from common_ml.tagging.models.frame_based import FrameModel
 from common_ml.tagging.producer import *
+from common_ml.utils.memory import MemoryGovernor
+from common_ml.video_processing import configure_decode_budget, get_decode_budget
 
 
 def test_message_producer(frame_model: FrameModel, test_videos: List[str], test_images: List[str]):
@@ -58,4 +62,116 @@ def test_producer_error(frame_model: FrameModel, test_videos: List[str]):
     producer = TagMessageProducer.from_file_tagger(new_tagger)
     with pytest.raises(Exception):
         # it should error the whole thing
-        list(producer.produce(test_videos))
\ No newline at end of file
+        list(producer.produce(test_videos))
+
+@pytest.mark.parametrize("worker_type", ["thread", "process"])
+def test_parallel_producer(test_videos: List[str], worker_type: str):
+    # files being tagged at once, shared with the forked workers
+    ctx = multiprocessing.get_context("fork")
+    active, max_active = ctx.Value("i", 0), ctx.Value("i", 0)
+
+    class SlowTagger(FileTagger):
+        def tag(self, file: str) -> List[Tag]:
+            with active.get_lock():
+                active.value += 1
+                max_active.value = max(max_active.value, active.value)
+            # the first file is the slowest, its messages must still come first
+            time.sleep(0.5 if file == files[0] else 0.1)
+            with active.get_lock():
+                active.value -= 1
+            return [Tag(start_time=i, end_time=i + 1, tag=str(i), source_media=file) for i in range(3)]
+
+    files = test_videos * 3
+    serial = list(TagMessageProducer.from_file_tagger(SlowTagger()).produce(files))
+    assert max_active.value == 1
+
+    producer = TagMessageProducer.from_file_tagger(SlowTagger(), num_workers=4, worker_type=worker_type)
+    try:
+        parallel = list(producer.produce(files))
+    finally:
+        producer.close()
+    assert max_active.value > 1
+
+    assert parallel == serial
+    progress = [msg.source_media for msg in parallel if isinstance(msg, Progress)]
+    assert progress == files
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_producer_stats(test_videos: List[str], num_workers: int):
+    class StatTagger(FileTagger):
+        def tag(self, file: str) -> List[Tag]:
+            return list(self.tag_files_with_stats([file]))[0][1]
+
+        def tag_files_with_stats(self, files: List[str]):
+            for file in files:
+                tags = [Tag(start_time=0, end_time=1, tag="a", source_media=file)]
+                yield file, tags, [Stat(name="test", stats={"n": 1}, source_media=file)]
+
+    producer = TagMessageProducer.from_file_tagger(StatTagger(), num_workers=num_workers)
+    messages = list(producer.produce(test_videos))
+    producer.close()
+    # each file's stats come after its tags, before its progress
+    assert [type(msg) for msg in messages] == [Tag, Stat, Progress] * len(test_videos)
+    assert [msg.source_media for msg in messages] == [f for f in test_videos for _ in range(3)]
+
+def test_parallel_producer_error(frame_model: FrameModel, test_videos: List[str]):
+    class ErrorTagger(FileTagger):
+        def tag(self, file: str) -> List[Tag]:
+            if file == test_videos[1]:
+                raise RuntimeError("i'm panicking")
+            return [Tag(start_time=0, end_time=1, tag="a", source_media=file)]
+
+    producer = TagMessageProducer.from_file_tagger(ErrorTagger(), num_workers=2)
+    messages = []
+    with pytest.raises(RuntimeError):
+        for msg in producer.produce(test_videos):
+            messages.append(msg)
+    producer.close()
+    # the first file's messages were produced before the error
+    assert messages[-1] == Progress(source_media=test_videos[0])
+
+def test_process_producer_decode_workers(test_videos: List[str]):
+    class BrightnessModel(FrameModel):
+        def tag_frame(self, img):
+            return [FrameTag(tag=f"brightness_{int(img.mean()) // 16}", box={"x1": 0, "y1": 0, "x2": 1, "y2": 1})]
+
+    def tagger(decode_workers: int) -> FileTagger:
+        return FileTagger.from_frame_model(BrightnessModel(), fps=1, allow_single_frame=True, decode_workers=decode_workers)
+
+    expected = list(TagMessageProducer.from_file_tagger(tagger(0)).produce(test_videos))
+    # the tagging workers are forked after the decode workers were started, and start their own
+    producer = TagMessageProducer.from_file_tagger(tagger(2), num_workers=2, worker_type="process")
+    assert list(producer.produce(test_videos)) == expected
+    producer.close()
+
+def test_process_producer_decode_budget(test_videos: List[str]):
+    class BudgetTagger(FileTagger):
+        def tag(self, file: str) -> List[Tag]:
+            budget = get_decode_budget()
+            return [Tag(start_time=0, end_time=1, tag=f"{budget.threads}/{budget.max_decoders}", source_media=file)]
+
+    configure_decode_budget(threads=8, max_decoders=4)
+    try:
+        producer = TagMessageProducer.from_file_tagger(BudgetTagger(), num_workers=2, worker_type="process")
+        tags = [msg.tag for msg in producer.produce(test_videos) if isinstance(msg, Tag)]
+        producer.close()
+    finally:
+        configure_decode_budget(None)
+    # the workers share the budget rather than each getting all of it
+    assert tags == ["4/2", "4/2"]
+
+def test_process_producer_memory_budget(test_videos: List[str]):
+    class GovernedTagger(FileTagger):
+        def __init__(self):
+            self.memory_governor = MemoryGovernor(max_bytes=1000)
+
+        def tag(self, file: str) -> List[Tag]:
+            return [Tag(start_time=0, end_time=1, tag=str(self.memory_governor.max_bytes), source_media=file)]
+
+    tagger = GovernedTagger()
+    producer = TagMessageProducer.from_file_tagger(tagger, num_workers=2, worker_type="process")
+    tags = [msg.tag for msg in producer.produce(test_videos) if isinstance(msg, Tag)]
+    producer.close()
+    # each worker gets its share of the governor it inherited
+    assert tags == ["500", "500"]
+    assert tagger.memory_governor.max_bytes == 1000
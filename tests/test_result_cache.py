@@ -0,0 +1,78 @@
+import os
+import shutil
+from typing import List
+
+import numpy as np
+
+from common_ml.tagging.file_tagger import FileTagger
+from common_ml.tagging.messages import Stat, Tag
+from common_ml.tagging.models.frame_based import BatchFrameModel
+from common_ml.tagging.models.tag_types import FrameTag, TagTable
+from common_ml.tagging.result_cache import ResultCache
+
+class CountingModel(BatchFrameModel):
+    def __init__(self, as_table: bool=False):
+        self.frames_tagged = 0
+        self.as_table = as_table
+
+    def tag_frames(self, imgs: np.ndarray):
+        self.frames_tagged += len(imgs)
+        tags = [[FrameTag(tag=f"brightness_{int(img.mean()) // 16}", box={"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4})] for img in imgs]
+        return TagTable.from_frame_tags(tags) if self.as_table else tags
+
+def _tag(model: BatchFrameModel, files: List[str], cache_dir: str, fps: float=1):
+    tagger = FileTagger.from_frame_model(model, fps=fps, result_cache=ResultCache(cache_dir))
+    return list(tagger.tag_files_with_stats(files))
+
+def _expand(tags) -> List[Tag]:
+    out = []
+    for t in tags:
+        out.extend(t.to_tags() if isinstance(t, TagTable) else [t])
+    return out
+
+def test_result_cache(test_videos: List[str], test_folder: str):
+    for as_table in (False, True):
+        cache_dir = os.path.join(test_folder, f"cache_{as_table}")
+
+        model = CountingModel(as_table)
+        first = _tag(model, test_videos, cache_dir)
+        assert model.frames_tagged > 0
+        for _, tags, stats in first:
+            assert not any(isinstance(t, Stat) for t in tags)
+            assert isinstance(stats[-1], Stat) and stats[-1].stats["hit"] == 0
+
+        # a new process would start with an empty in memory state, only the directory is shared
+        model = CountingModel(as_table)
+        second = _tag(model, test_videos, cache_dir)
+        assert model.frames_tagged == 0
+        for (fpath, tags, stats), (_, expected, _) in zip(second, first):
+            assert stats[-1].stats["hit"] == 1
+            assert stats[-1].source_media == fpath
+            assert _expand(tags) == _expand(expected)
+        # running counts, as of each file
+        assert [stats[-1].stats for _, _, stats in second] == [{"hit": 1, "hits": 1, "misses": 0}, {"hit": 1, "hits": 2, "misses": 0}]
+
+        # the same content under another path is a hit, with the new path as source_media
+        copy = os.path.join(test_folder, "copy.mp4")
+        shutil.copy(test_videos[0], copy)
+        model = CountingModel(as_table)
+        [(_, tags, stats)] = _tag(model, [copy], cache_dir)
+        assert model.frames_tagged == 0 and stats[-1].stats["hit"] == 1
+        assert all(t.source_media == copy for t in _expand(tags))
+        os.remove(copy)
+
+        # other parameters are a miss
+        model = CountingModel(as_table)
+        third = _tag(model, test_videos[:1], cache_dir, fps=2)
+        assert model.frames_tagged > 0 and third[0][2][-1].stats["hit"] == 0
+
+def test_result_cache_partial(test_videos: List[str], test_folder: str):
+    model = CountingModel()
+    _tag(model, test_videos[:1], test_folder)
+    first_count = model.frames_tagged
+
+    model = CountingModel()
+    tags = _tag(model, test_videos, test_folder)
+    assert [fpath for fpath, _, _ in tags] == test_videos
+    assert [s[-1].stats["hit"] for _, _, s in tags] == [1, 0]
+    assert 0 < model.frames_tagged <= first_count * 2
@@ -0,0 +1,62 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from common_ml.utils.shared_frames import SlabPool
+
+def _consume(pool: SlabPool, handles, results):
+    while True:
+        handle = handles.get()
+        if handle is None:
+            break
+        frames = pool.get(handle)
+        results.put((handle.slab, int(frames.sum()), frames.shape))
+        pool.release(handle)
+
+@pytest.mark.parametrize("method", ["fork", "spawn"])
+def test_slab_pool_workers(method: str):
+    ctx = multiprocessing.get_context(method)
+    pool = SlabPool(num_slabs=2, slab_bytes=4 * 48 * 64 * 3, ctx=ctx)
+    handles, results = ctx.Queue(), ctx.Queue()
+    workers = [ctx.Process(target=_consume, args=(pool, handles, results)) for _ in range(2)]
+    for w in workers:
+        w.start()
+    try:
+        expected = []
+        for i in range(10):
+            frames = np.full((4, 48, 64, 3), i, dtype=np.uint8)
+            # blocks until a worker released a slab
+            handles.put(pool.put(frames, timeout=10))
+            expected.append(int(frames.sum()))
+        for _ in workers:
+            handles.put(None)
+        received = [results.get(timeout=10) for _ in range(10)]
+        for w in workers:
+            w.join(timeout=10)
+        assert sorted(r[1] for r in received) == sorted(expected)
+        assert all(r[2] == (4, 48, 64, 3) for r in received)
+        assert pool.in_use() == 0
+    finally:
+        pool.close()
+
+def test_slab_pool_refs():
+    pool = SlabPool(num_slabs=1, slab_bytes=1024)
+    try:
+        handle, view = pool.allocate((16, 16), np.float32, refs=2)
+        view[:] = 1.5
+        assert pool.get(handle).sum() == 16 * 16 * 1.5
+        pool.release(handle)
+        # still referenced once
+        with pytest.raises(TimeoutError):
+            pool.allocate((8,), timeout=0.01)
+        pool.release(handle)
+        assert pool.in_use() == 0
+        with pytest.raises(ValueError):
+            pool.release(handle)
+        with pytest.raises(ValueError):
+            pool.allocate((2048,))
+        handle, _ = pool.allocate((8,), timeout=0.01)
+        assert handle.nbytes == 8
+    finally:
+        pool.close()
@@ -0,0 +1,76 @@
+import json
+from typing import List
+
+import numpy as np
+
+from common_ml.tagging.models.av import AVModel
+from common_ml.tagging.models.frame_based import BatchFrameModel, FrameModel
+from common_ml.tagging.models.tag_types import FrameTag, Tag, TagTable
+from common_ml.tagging.run_helpers import MessageWriter, write_message
+
+class TableFrameModel(BatchFrameModel):
+    """Returns the tags of `model` as a TagTable."""
+    def __init__(self, model: BatchFrameModel):
+        self.model = model
+
+    def tag_frames(self, imgs: np.ndarray) -> TagTable:
+        return TagTable.from_frame_tags(self.model.tag_frames(imgs))
+
+def test_frame_tags_round_trip():
+    frame_tags = [
+        [FrameTag(tag="a", box={"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4}, additional_info={"score": 1})],
+        [],
+        [FrameTag(tag="b", box={"x1": 0.0, "y1": 0.0, "x2": 1.0, "y2": 1.0}),
+            FrameTag(tag="a", box={"x1": 0.5, "y1": 0.5, "x2": 0.6, "y2": 0.7})],
+    ]
+    table = TagTable.from_frame_tags(frame_tags)
+    assert len(table) == 3
+    assert table.labels == ["a", "b"]
+    assert table.frames.tolist() == [0, 2, 2]
+    assert table.to_frame_tags(3) == frame_tags
+
+    merged = TagTable.concatenate([table.take(np.array([1])), table])
+    assert sorted(merged.labels) == ["a", "b"]
+    assert [merged.labels[i] for i in merged.label_ids] == ["b", "a", "b", "a"]
+
+def _tag_all(model: AVModel, videos: List[str]):
+    return {fpath: tags for fpath, tags in model.tag_files(videos)}
+
+def test_tag_table_dict_round_trip():
+    table = TagTable.from_frame_tags([[FrameTag(tag="a", box={"x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4})], []])
+    table.times = np.array([40])
+    table.source_media = "1.mp4"
+    copy = TagTable.from_dict(json.loads(json.dumps(table.to_dict())))
+    assert list(copy.to_dicts()) == list(table.to_dicts())
+
+def test_av_model_with_tag_table(frame_model: FrameModel, test_videos: List[str]):
+    for allow_single_frame in (True, False):
+        expected = _tag_all(AVModel.from_frame_model(BatchFrameModel.from_frame_model(frame_model), 2, allow_single_frame), test_videos)
+        frame_model.call_count = 0
+        actual = _tag_all(AVModel.from_frame_model(TableFrameModel(BatchFrameModel.from_frame_model(frame_model)), 2, allow_single_frame), test_videos)
+        frame_model.call_count = 0
+
+        for fpath in test_videos:
+            table, combined = actual[fpath][0], actual[fpath][1:]
+            assert isinstance(table, TagTable)
+            frame_level = [t for t in expected[fpath] if t.frame_info is not None]
+            assert table.to_tags() == frame_level
+            assert combined == expected[fpath][len(frame_level):]
+            assert len(combined) > 0
+
+def test_write_tag_table(frame_model: FrameModel, test_videos: List[str], test_folder: str):
+    model = AVModel.from_frame_model(TableFrameModel(BatchFrameModel.from_frame_model(frame_model)), 1, True)
+    table = model.tag(test_videos[0])[0]
+
+    with open(f"{test_folder}/table.jsonl", "w") as f:
+        writer = MessageWriter(f)
+        writer.write(table)
+        writer.flush()
+    with open(f"{test_folder}/tags.jsonl", "w") as f:
+        for tag in table.to_tags():
+            write_message(tag, f)
+
+    with open(f"{test_folder}/table.jsonl") as f1, open(f"{test_folder}/tags.jsonl") as f2:
+        lines = f1.readlines()
+        assert len(lines) == len(table)
+        assert [json.loads(l) for l in lines] == [json.loads(l) for l in f2.readlines()]
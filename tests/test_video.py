@@ -1,8 +1,16 @@
 
 import pytest
+import multiprocessing
 import os
+import threading
+import numpy as np
+import av
 
-from common_ml.video_processing import get_frames
+from common_ml import video_processing
+from common_ml.utils.memory import MemoryGovernor
+from common_ml.video_processing import (
+    configure_decode_budget, get_frames, get_key_frames, iter_frame_batches, iter_multi_rate_frame_batches, resize_dims
+)
 
 TEST_DATA = os.path.join(os.path.dirname(__file__), "test-data")
 
@@ -10,4 +18,259 @@ def test_get_frames():
     video_path = os.path.join(TEST_DATA, "1.mp4")
     frames, _, _ = get_frames(video_path, fps=1)
     
-    assert len(frames) > 0
\ No newline at end of file
+    assert len(frames) > 0
+
+def test_iter_frame_batches():
+    video_path = os.path.join(TEST_DATA, "1.mp4")
+    frames, indices, times = get_frames(video_path, fps=2)
+
+    batches = list(iter_frame_batches(video_path, fps=2, batch_size=7))
+    assert all(0 < len(b[0]) <= 7 for b in batches)
+    assert all(len(b[0]) == 7 for b in batches[:-1])
+
+    assert np.array_equal(np.concatenate([b[0] for b in batches]), frames)
+    assert [i for b in batches for i in b[1]] == indices
+    assert [t for b in batches for t in b[2]] == times
+
+def test_iter_frame_batches_reuse_buffers():
+    video_path = os.path.join(TEST_DATA, "1.mp4")
+    frames, indices, times = get_frames(video_path, fps=2)
+
+    batches = []
+    buffers = set()
+    for b_frames, b_indices, b_times in iter_frame_batches(video_path, fps=2, batch_size=7, reuse_buffers=2):
+        buffers.add(id(b_frames.base if b_frames.base is not None else b_frames))
+        # the views get overwritten once the ring wraps around
+        batches.append((b_frames.copy(), b_indices, b_times))
+
+    assert len(buffers) <= 2
+    assert np.array_equal(np.concatenate([b[0] for b in batches]), frames)
+    assert [i for b in batches for i in b[1]] == indices
+    assert [t for b in batches for t in b[2]] == times
+
+def test_get_frames_resize():
+    video_path = os.path.join(TEST_DATA, "1.mp4")
+    frames, indices, times = get_frames(video_path, fps=1)
+    assert frames.shape[1:] == (272, 640, 3)
+
+    small, small_indices, small_times = get_frames(video_path, fps=1, max_side=320, interpolation="AREA")
+    assert small.shape == (len(frames), 136, 320, 3)
+    assert small_indices == indices and small_times == times
+
+    fixed, _, _ = get_frames(video_path, fps=1, size=(224, 224))
+    assert fixed.shape == (len(frames), 224, 224, 3)
+
+    ring = next(iter_frame_batches(video_path, fps=1, reuse_buffers=1, max_side=320, interpolation="AREA"))
+    assert np.array_equal(ring[0], small[:len(ring[0])])
+
+def test_resize_dims():
+    assert resize_dims(3840, 2160, max_side=640) == (640, 360)
+    assert resize_dims(640, 272, max_side=1024) == (640, 272)
+    assert resize_dims(640, 272, size=(224, 224)) == (224, 224)
+    with pytest.raises(ValueError):
+        resize_dims(640, 272, size=(224, 224), max_side=224)
+
+@pytest.mark.parametrize("fps", [0.2, 1, 5])
+def test_get_frames_seek_sampling(fps: float):
+    for video in ["1.mp4", "2.mp4"]:
+        video_path = os.path.join(TEST_DATA, video)
+        frames, indices, times = get_frames(video_path, fps=fps, sampling="sequential")
+
+        for sampling in ["seek", "auto"]:
+            s_frames, s_indices, s_times = get_frames(video_path, fps=fps, sampling=sampling)
+            assert s_indices == indices
+            assert s_times == times
+            assert np.array_equal(s_frames, frames)
+
+def test_iter_multi_rate_frame_batches():
+    video_path = os.path.join(TEST_DATA, "1.mp4")
+    rates = {"slow": 0.5, "medium": 2, "fast": 5}
+    batches = {key: [] for key in rates}
+    for key, frames, indices, times in iter_multi_rate_frame_batches(video_path, rates, batch_size=7, max_side=320):
+        batches[key].append((frames, indices, times))
+
+    for key, fps in rates.items():
+        expected = list(iter_frame_batches(video_path, fps, batch_size=7, max_side=320, sampling="sequential"))
+        assert len(batches[key]) == len(expected)
+        for (frames, indices, times), (e_frames, e_indices, e_times) in zip(batches[key], expected):
+            assert indices == e_indices and times == e_times
+            assert np.array_equal(frames, e_frames)
+
+def test_get_key_frames():
+    video_path = os.path.join(TEST_DATA, "2.mp4")
+    frames, indices, times = get_key_frames(video_path)
+
+    with av.open(video_path) as container:
+        expected = [(i, f.time) for i, f in enumerate(container.decode(video=0)) if f.key_frame]
+
+    assert len(frames) == len(expected) > 1
+    assert indices == [i for i, _ in expected]
+    assert times == [t for _, t in expected]
+    assert frames.shape[1:] == (272, 640, 3)
+
+def _write_video(path: str, num_frames: int, fps: int, gop: int) -> None:
+    with av.open(path, "w") as container:
+        stream = container.add_stream("libx264", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+        stream.codec_context.gop_size = gop
+        for i in range(num_frames):
+            img = np.full((48, 64, 3), (i * 7) % 256, dtype=np.uint8)
+            img[:, i % 64] = 255
+            for packet in stream.encode(av.VideoFrame.from_ndarray(img, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+@pytest.mark.parametrize("fps", [0.5, 3, 25])
+def test_get_frames_parallel_decode(tmp_path, fps: float):
+    video_path = str(tmp_path / "synthetic.mp4")
+    _write_video(video_path, num_frames=300, fps=25, gop=12)
+    frames, indices, times = get_frames(video_path, fps=fps, sampling="sequential")
+
+    p_frames, p_indices, p_times = get_frames(video_path, fps=fps, decode_workers=3)
+    assert p_indices == indices
+    assert p_times == times
+    assert np.array_equal(p_frames, frames)
+
+    batches = list(iter_frame_batches(video_path, fps=fps, batch_size=7, decode_workers=2))
+    assert [len(b[0]) for b in batches] == [len(b[0]) for b in iter_frame_batches(video_path, fps=fps, batch_size=7)]
+    assert [i for b in batches for i in b[1]] == indices
+
+def test_parallel_decode_slabs(tmp_path, monkeypatch):
+    video_path = str(tmp_path / "synthetic.mp4")
+    _write_video(video_path, num_frames=300, fps=25, gop=12)
+    pools = []
+    class RecordingSlabPool(video_processing.SlabPool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+            self.allocated = 0
+
+        def allocate(self, *args, **kwargs):
+            self.allocated += 1
+            return super().allocate(*args, **kwargs)
+    monkeypatch.setattr(video_processing, "SlabPool", RecordingSlabPool)
+
+    # segments are handed back in shared memory, one slab per segment in flight
+    frames = np.concatenate([b[0] for b in iter_frame_batches(video_path, fps=25, batch_size=8, decode_workers=2)])
+    assert np.array_equal(frames, get_frames(video_path, fps=25, sampling="sequential")[0])
+    [pool] = pools
+    assert len(pool._refs) == 4 and pool.allocated > 4
+    # released and freed
+    assert pool.in_use() == 0 and not pool._slabs
+
+    # stopping early frees the slabs too
+    batches = iter_frame_batches(video_path, fps=25, batch_size=8, decode_workers=2)
+    next(batches)
+    batches.close()
+    assert not pools[1]._slabs
+
+def test_parallel_decode_long_gop(tmp_path, monkeypatch):
+    # a single GOP would be a single segment, held at once in a slab per segment in flight
+    video_path = str(tmp_path / "synthetic.mp4")
+    _write_video(video_path, num_frames=100, fps=25, gop=1000)
+    def no_parallel(*args, **kwargs):
+        raise AssertionError("decoded in parallel")
+    monkeypatch.setattr(video_processing, "_iter_parallel_frame_batches", no_parallel)
+
+    batches = list(iter_frame_batches(video_path, fps=25, batch_size=8, decode_workers=2))
+    expected = list(iter_frame_batches(video_path, fps=25, batch_size=8))
+    assert [b[1] for b in batches] == [b[1] for b in expected]
+
+def test_parallel_decode_memory_governor(tmp_path, monkeypatch):
+    video_path = str(tmp_path / "synthetic.mp4")
+    _write_video(video_path, num_frames=300, fps=25, gop=12)
+    index = video_processing._scan_packets(video_path)
+    segment_frames = max(len(s) for s in video_processing._split_segments(video_processing._seek_targets(25, index), 8))
+    frame_bytes = 48 * 64 * 3
+    expected = list(iter_frame_batches(video_path, fps=25, batch_size=8))
+
+    # room for a batch and 3 of the 4 slabs
+    governor = MemoryGovernor(max_bytes=(8 + 3 * segment_frames) * frame_bytes)
+    batches = iter_frame_batches(video_path, fps=25, batch_size=8, decode_workers=2, memory_governor=governor,
+        memory_owner="video")
+    first = next(batches)
+    assert governor.in_use == 3 * segment_frames * frame_bytes
+    assert [b[1] for b in [first, *batches]] == [b[1] for b in expected]
+    assert governor.in_use == 0 and governor.pop_high_water("video") == 3 * segment_frames * frame_bytes
+
+    # no room for a single slab next to a batch
+    def no_parallel(*args, **kwargs):
+        raise AssertionError("decoded in parallel")
+    monkeypatch.setattr(video_processing, "_iter_parallel_frame_batches", no_parallel)
+    governor = MemoryGovernor(max_bytes=(8 + segment_frames - 1) * frame_bytes)
+    batches = list(iter_frame_batches(video_path, fps=25, batch_size=8, decode_workers=2, memory_governor=governor))
+    assert [b[1] for b in batches] == [b[1] for b in expected]
+
+def _decode_in_fork(video_path: str) -> None:
+    video_processing.restart_decode_workers()
+    pid, num_workers, _ = video_processing._decode_pool
+    assert pid == os.getpid() and num_workers == 3
+    assert len(get_frames(video_path, fps=3, decode_workers=3)[0]) > 0
+
+def test_decode_workers_pool(tmp_path):
+    video_path = str(tmp_path / "synthetic.mp4")
+    _write_video(video_path, num_frames=100, fps=25, gop=12)
+    video_processing.stop_decode_workers()
+    try:
+        video_processing.start_decode_workers(2)
+        pool = video_processing._decode_pool[2]
+        get_frames(video_path, fps=3, decode_workers=2)
+        assert video_processing._decode_pool[2] is pool
+
+        # a single pool is kept, replaced when more workers are needed
+        get_frames(video_path, fps=3, decode_workers=3)
+        larger = video_processing._decode_pool[2]
+        assert larger is not pool and pool._shutdown_thread
+        get_frames(video_path, fps=3, decode_workers=2)
+        assert video_processing._decode_pool[2] is larger
+
+        # forked processes start their own
+        process = multiprocessing.get_context("fork").Process(target=_decode_in_fork, args=(video_path,))
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+        assert video_processing._decode_pool[2] is larger
+    finally:
+        video_processing.stop_decode_workers()
+    assert video_processing._decode_pool is None and larger._shutdown_thread
+
+@pytest.fixture
+def decode_budget():
+    yield configure_decode_budget
+    configure_decode_budget(None)
+
+def test_decode_budget(decode_budget):
+    video_path = os.path.join(TEST_DATA, "1.mp4")
+    frames, indices, times = get_frames(video_path, fps=2)
+
+    decode_budget(threads=4, max_decoders=2, thread_type="SLICE")
+    with video_processing._open_video(video_path) as container:
+        stream = container.streams.video[0]
+        assert stream.thread_count == 2
+        assert stream.thread_type.name == "SLICE"
+
+    b_frames, b_indices, b_times = get_frames(video_path, fps=2)
+    assert b_indices == indices and b_times == times
+    assert np.array_equal(b_frames, frames)
+
+def test_decode_budget_max_decoders(decode_budget):
+    video_path = os.path.join(TEST_DATA, "1.mp4")
+    decode_budget(threads=2, max_decoders=2)
+    first = iter_frame_batches(video_path, fps=1, batch_size=1, sampling="seek")
+    second = iter_frame_batches(video_path, fps=1, batch_size=1, sampling="sequential")
+    next(first)
+    next(second)
+
+    # both decoders are taken, a third one waits for one of them to be closed
+    opened = threading.Event()
+    def decode():
+        get_frames(video_path, fps=0.5)
+        opened.set()
+    thread = threading.Thread(target=decode)
+    thread.start()
+    assert not opened.wait(timeout=0.5)
+    first.close()
+    assert opened.wait(timeout=10)
+    thread.join()
+    second.close()